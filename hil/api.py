@@ -4,34 +4,58 @@ TODO: Spec out and document what sanitization is required.
 """
 import json
 import requests
+import threading
 import uuid
+from collections import OrderedDict
 
-from schema import Schema, Optional, SchemaError
+import flask
+import sqlalchemy
+from flask_sqlalchemy import SignallingSession
+
+from schema import Schema, Optional, SchemaError, And, Or, Use
+from sqlalchemy.orm import joinedload, subqueryload
 
 from hil import model, errors
+# journal must be loaded to notify the networking daemon of new actions, even
+# though we don't use it directly from this module.
+from hil import journal  # pylint: disable=unused-import
 from hil.model import db
-from hil.auth import get_auth_backend
+from hil.auth import get_auth_backend, issue_token, revoke_tokens, \
+    token_lifetime
 from hil.config import cfg
-from hil.rest import rest_call
+from hil.rest import rest_call, json_array, json_object, json_dumps, local, \
+    subrequest
 from hil.class_resolver import concrete_class_for
 from hil.network_allocator import get_network_allocator
 import logging
 
 
+# How many rows list calls fetch from the database at a time, as they
+# stream their results.
+QUERY_BATCH_SIZE = 500
+
+# Arguments accepted by every paginated list call; see `paginate`.
+PAGINATION_ARGS = {
+    Optional('limit'): And(Use(int), lambda n: n > 0),
+    Optional('after'): basestring,
+}
+
+
 # Project Code #
 ################
-@rest_call('GET', '/projects', Schema({}))
-def list_projects():
+@rest_call('GET', '/projects', Schema(PAGINATION_ARGS))
+def list_projects(limit=None, after=None):
     """List all projects.
 
     Returns a JSON array of strings representing a list of projects.
+    `limit` and `after` page through the list; see `paginate`.
 
     Example:  '["project1", "project2", "project3"]'
     """
     get_auth_backend().require_admin()
-    projects = model.Project.query.all()
-    projects = sorted([p.label for p in projects])
-    return json.dumps(projects)
+    query = paginate(db.session.query(model.Project.label),
+                     model.Project.label, limit, after)
+    return json_array(label for (label,) in query)
 
 
 @rest_call('PUT', '/project/<project>', Schema({'project': basestring}))
@@ -72,6 +96,7 @@ def project_delete(project):
         raise errors.BlockedError("Project can still access networks")
     if project.headnodes:
         raise errors.BlockedError("Project still has a headnode")
+    revoke_tokens(project=project)
     db.session.delete(project)
     db.session.commit()
 
@@ -404,7 +429,7 @@ def node_connect_network(node, nic, network, channel=None):
                                           uuid=unique_id,
                                           status='PENDING'))
     db.session.commit()
-    return json.dumps({'status_id': unique_id}), 202
+    return json_dumps({'status_id': unique_id}), 202
 
 
 @rest_call('POST', '/node/<node>/nic/<nic>/detach_network', Schema({
@@ -449,7 +474,7 @@ def node_detach_network(node, nic, network):
                                           new_network=None))
 
     db.session.commit()
-    return json.dumps({'status_id': unique_id}), 202
+    return json_dumps({'status_id': unique_id}), 202
 
 
 @rest_call('PUT', '/node/<node>/metadata/<label>', Schema({
@@ -679,26 +704,38 @@ def headnode_detach_network(headnode, hnic):
 # Network Code #
 ################
 
-@rest_call('GET', '/networks', Schema({}))
-def list_networks():
-    """Lists all networks"""
-    result = {}
-    # Admin Operation
-    if get_auth_backend().have_admin():
-        networks = db.session.query(model.Network).all()
-    else:
-        networks = db.session.query(model.Network).filter_by(access=None).all()
+@rest_call('GET', '/networks', Schema(dict(PAGINATION_ARGS, **{
+    Optional('project'): basestring,
+})))
+def list_networks(project=None, limit=None, after=None):
+    """Lists all networks
 
-    for n in networks:
+    If `project` is given, only networks that project has access to are
+    listed, including public ones. `limit` and `after` page through the
+    list; see `paginate`.
+    """
+    auth_backend = get_auth_backend()
+    query = db.session.query(model.Network) \
+        .options(subqueryload(model.Network.access))
+    if project is not None:
+        project = get_or_404(model.Project, project)
+        auth_backend.require_project_access(project)
+        query = query.filter(sqlalchemy.or_(
+            model.Network.access.contains(project),
+            ~model.Network.access.any()))
+    elif not auth_backend.have_admin():
+        query = query.filter_by(access=None)
+    networks = paginate(query, model.Network.label, limit, after)
+
+    def describe(n):
+        """Return the (label, info) pair to report for network `n`."""
         if n.access:
             projects = sorted([p.label for p in n.access])
-            result[n.label] = {'network_id': n.network_id,
-                               'projects': projects}
         else:
-            result[n.label] = {'network_id': n.network_id,
-                               'projects': None}
+            projects = None
+        return n.label, {'network_id': n.network_id, 'projects': projects}
 
-    return json.dumps(result, sort_keys=True)
+    return json_object(describe(n) for n in networks)
 
 
 @rest_call('GET', '/network/<network>/attachments', schema=Schema({
@@ -735,18 +772,31 @@ def list_network_attachments(network, project=None):
                 raise errors.AuthorizationError(
                     "You do not have access to this project.")
 
-    attachments = network.attachments
-    nodes = {}
-    for attachment in attachments:
-        if project is None or project is attachment.nic.owner.project:
-            node = {
-                'nic': attachment.nic.label,
-                'channel': attachment.channel,
-                'project': attachment.nic.owner.project.label
-            }
-            nodes[attachment.nic.owner.label] = node
+    query = db.session.query(model.Node.label,
+                             model.Nic.label,
+                             model.NetworkAttachment.channel,
+                             model.Project.label) \
+        .select_from(model.NetworkAttachment) \
+        .join(model.Nic, model.Node, model.Project) \
+        .filter(model.NetworkAttachment.network_id == network.id) \
+        .order_by(model.Node.label, model.NetworkAttachment.id)
+    if project is not None:
+        query = query.filter(model.Node.project_id == project.id)
+
+    def nodes():
+        """Generate (node, info) pairs, one per node.
+
+        If a node has more than one nic on the network, the last one wins.
+        """
+        last = None
+        for node, nic, channel, owner in query.yield_per(QUERY_BATCH_SIZE):
+            if last is not None and last[0] != node:
+                yield last
+            last = node, {'nic': nic, 'channel': channel, 'project': owner}
+        if last is not None:
+            yield last
 
-    return json.dumps(nodes, sort_keys=True)
+    return json_object(nodes())
 
 
 @rest_call('PUT', '/network/<network>', Schema({
@@ -840,7 +890,8 @@ def network_delete(network):
     db.session.commit()
 
 
-@rest_call('GET', '/network/<network>', Schema({'network': basestring}))
+@rest_call('GET', '/network/<network>', Schema({'network': basestring}),
+           etag=['network', 'project', 'network_attachment', 'nic', 'node'])
 def show_network(network):
     """Show details of a network.
 
@@ -887,7 +938,7 @@ def show_network(network):
                 connected_nodes[node].append(nic)
     result['connected-nodes'] = connected_nodes
 
-    return json.dumps(result, sort_keys=True)
+    return json_dumps(result)
 
 
 @rest_call('PUT', '/switch/<switch>', schema=Schema({
@@ -985,12 +1036,12 @@ def show_switch(switch):
     """
     get_auth_backend().require_admin()
     switch = get_or_404(model.Switch, switch)
-    return json.dumps({
+    return json_dumps({
         'name': switch.label,
         'ports': [{'label': port.label}
                   for port in switch.ports],
         'capabilities': switch.get_capabilities(),
-    }, sort_keys=True)
+    })
 
 
 @rest_call('GET', '/switch/<switch>/port/<path:port>', Schema({
@@ -1011,21 +1062,22 @@ def show_port(switch, port):
                       'networks': dict(
                         [(attachment.channel, attachment.network.label)
                          for attachment in nic.attachments])}
-    return json.dumps(return_obj)
+    return json_dumps(return_obj)
 
 
-@rest_call('GET', '/switches', Schema({}))
-def list_switches():
+@rest_call('GET', '/switches', Schema(PAGINATION_ARGS))
+def list_switches(limit=None, after=None):
     """List all switches.
 
     Returns a JSON array of strings representing a list of switches.
+    `limit` and `after` page through the list; see `paginate`.
 
     Example:  '["cisco3", "brocade1", "mock2"]'
     """
     get_auth_backend().require_admin()
-    switches = model.Switch.query.all()
-    snames = sorted([s.label for s in switches])
-    return json.dumps(snames)
+    query = paginate(db.session.query(model.Switch.label),
+                     model.Switch.label, limit, after)
+    return json_array(label for (label,) in query)
 
 
 @rest_call('POST', '/switch/<switch>/port/<path:port>/connect_nic', Schema({
@@ -1110,7 +1162,7 @@ def port_revert(switch, port):
 
     db.session.add(action)
     db.session.commit()
-    return json.dumps({'status_id': unique_id})
+    return json_dumps({'status_id': unique_id})
 
 
 @rest_call('GET', '/networking_action/<status_id>', Schema({
@@ -1137,24 +1189,59 @@ def show_networking_action(status_id):
     else:
         action_info['new_network'] = action.new_network.label
 
-    return json.dumps(action_info)
+    return json_dumps(action_info)
 
 
-@rest_call('GET', '/nodes/<is_free>', Schema({'is_free': basestring}))
-def list_nodes(is_free):
+@rest_call('GET', '/nodes/<is_free>', Schema(dict(PAGINATION_ARGS, **{
+    'is_free': basestring,
+    Optional('project'): basestring,
+    Optional('switch'): basestring,
+    Optional('metadata_key'): basestring,
+    Optional('metadata_value'): basestring,
+})), etag=['node', 'project', 'nic', 'port', 'switch', 'metadata'])
+def list_nodes(is_free, project=None, switch=None,
+               metadata_key=None, metadata_value=None,
+               limit=None, after=None):
     """List all nodes or all free nodes
 
+    The list may be narrowed further to nodes in `project`, nodes with a nic
+    on a port of `switch`, or nodes with metadata `metadata_key` (whose value
+    is the string `metadata_value`, if given). `limit` and `after` page
+    through the list; see `paginate`.
+
     Returns a JSON array of strings representing a list of nodes.
 
     Example:  '["node1", "node2", "node3"]'
     """
+    auth_backend = get_auth_backend()
+    query = db.session.query(model.Node.label)
+
     if is_free == "free":
-        nodes = model.Node.query.filter_by(project_id=None).all()
-    else:
-        nodes = model.Node.query.all()
+        query = query.filter(model.Node.project_id.is_(None))
+    if project is not None:
+        project = get_or_404(model.Project, project)
+        auth_backend.require_project_access(project)
+        query = query.filter(model.Node.project_id == project.id)
+    if switch is not None:
+        # Which port a nic is on is only visible to admins:
+        auth_backend.require_admin()
+        switch = get_or_404(model.Switch, switch)
+        query = query.filter(model.Node.nics.any(
+            model.Nic.port.has(model.Port.owner_id == switch.id)))
+    if metadata_value is not None and metadata_key is None:
+        raise errors.BadArgumentError(
+            "'metadata_value' requires 'metadata_key'.")
+    if metadata_key is not None:
+        # Metadata is only visible to admins and the node's project, so
+        # searching it is limited to admins:
+        auth_backend.require_admin()
+        match = model.Metadata.label == metadata_key
+        if metadata_value is not None:
+            match &= model.Metadata.value == json.dumps(metadata_value)
+        query = query.filter(model.Node.metadata.any(match))
 
-    nodes = sorted([n.label for n in nodes])
-    return json.dumps(nodes)
+    query = paginate(query, model.Node.label, limit, after)
+    return json_array(label for (label,) in query)
 
 
 @rest_call('GET', '/project/<project>/nodes', Schema({'project': basestring}))
@@ -1169,7 +1256,7 @@ def list_project_nodes(project):
     get_auth_backend().require_project_access(project)
     nodes = project.nodes
     nodes = [n.label for n in nodes]
-    return json.dumps(nodes)
+    return json_dumps(nodes)
 
 
 @rest_call('GET', '/project/<project>/networks', Schema({
@@ -1186,42 +1273,113 @@ def list_project_networks(project):
     get_auth_backend().require_project_access(project)
     networks = project.networks_access
     networks = sorted([n.label for n in networks])
-    return json.dumps(networks)
+    return json_dumps(networks)
 
 
-@rest_call('GET', '/node/<nodename>', Schema({'nodename': basestring}))
+@rest_call('GET', '/node/<nodename>', Schema({'nodename': basestring}),
+           etag=['node', 'project', 'nic', 'port', 'switch',
+                 'network_attachment', 'network', 'metadata'])
 def show_node(nodename):
     """Show the details of a node.
 
     Returns a JSON object representing a node.
     """
 
-    node = get_or_404(model.Node, nodename)
+    node = _node_details_query().filter_by(label=nodename).first()
+    if node is None:
+        raise errors.NotFoundError("Node %s does not exist." % nodename)
     if node.project is not None:
         get_auth_backend().require_project_access(node.project)
 
-    # build list of nics
-    nic = [{'label': n.label,
-            'macaddr': n.mac_addr,
-            'port': None if n.port is None else n.port.label,
-            'switch': None if n.port is None else n.port.owner.label,
-            'networks': dict([(attachment.channel,
-                               attachment.network.label)
-                             for attachment in n.attachments]),
-            } for n in node.nics]
-
-    # remove port and switch info if the user is not an admin
-    if not get_auth_backend().have_admin():
-        for nics in nic:
-            del nics['port']
-            del nics['switch']
-
-    return json.dumps({
+    return json_dumps(_node_details(node, get_auth_backend().have_admin()))
+
+
+@rest_call('GET', '/nodes/detail', Schema({
+    Optional('project'): basestring,
+    Optional('free'): And(Or('true', 'false'), Use(lambda v: v == 'true')),
+}))
+def list_nodes_detail(project=None, free=False):
+    """Show the details of many nodes at once.
+
+    With no arguments, lists every node the caller is allowed to see: that is,
+    every node `show_node` would succeed on. If `project` is given, only that
+    project's nodes are listed; if `free` is true, only free nodes are.
+
+    Returns a JSON object mapping node names to the same structure returned
+    by `show_node`.
+    """
+    auth_backend = get_auth_backend()
+    query = _node_details_query()
+
+    if project is not None and free:
+        raise errors.BadArgumentError(
+            "At most one of 'project' and 'free' may be specified.")
+    elif project is not None:
+        project = get_or_404(model.Project, project)
+        auth_backend.require_project_access(project)
+        query = query.filter_by(project_id=project.id)
+    elif free:
+        query = query.filter_by(project_id=None)
+
+    admin = auth_backend.have_admin()
+    access = {}
+
+    def nodes():
+        """Generate (label, details) pairs for the nodes to report."""
+        for node in paginate(query, model.Node.label):
+            if node.project_id is not None and not admin:
+                if node.project_id not in access:
+                    access[node.project_id] = \
+                        auth_backend.have_project_access(node.project)
+                if not access[node.project_id]:
+                    continue
+            yield node.label, _node_details(node, admin)
+
+    return json_object(nodes())
+
+
+def _node_details(node, admin):
+    """Return a dict describing `node`, as reported by `show_node`.
+
+    Port and switch information is only included if `admin` is True.
+    """
+    nics = []
+    for n in node.nics:
+        nic = {'label': n.label,
+               'macaddr': n.mac_addr,
+               'networks': dict([(attachment.channel,
+                                  attachment.network.label)
+                                 for attachment in n.attachments]),
+               }
+        if admin:
+            nic['port'] = None if n.port is None else n.port.label
+            nic['switch'] = None if n.port is None else n.port.owner.label
+        nics.append(nic)
+
+    return {
         'name': node.label,
         'project': None if node.project_id is None else node.project.label,
-        'nics': nic,
+        'nics': nics,
         'metadata': {m.label: m.value for m in node.metadata}
-    }, sort_keys=True)
+    }
+
+
+def _node_details_query():
+    """Return a query for nodes, which loads everything show_node needs.
+
+    Rather than loading each nic, port, switch, attachment and network
+    lazily, one at a time, they are all loaded up front, with a fixed number
+    of queries no matter how many of them there are.
+    """
+    return db.session.query(model.Node).options(
+        joinedload(model.Node.project),
+        subqueryload(model.Node.metadata),
+        subqueryload(model.Node.nics)
+        .joinedload(model.Nic.port)
+        .joinedload(model.Port.owner),
+        subqueryload(model.Node.nics)
+        .subqueryload(model.Nic.attachments)
+        .joinedload(model.NetworkAttachment.network))
 
 
 @rest_call('GET', '/project/<project>/headnodes', Schema({
@@ -1238,7 +1396,7 @@ def list_project_headnodes(project):
     get_auth_backend().require_project_access(project)
     headnodes = project.headnodes
     headnodes = sorted([hn.label for hn in headnodes])
-    return json.dumps(headnodes)
+    return json_dumps(headnodes)
 
 
 @rest_call('GET', '/headnode/<nodename>', Schema({
@@ -1251,14 +1409,14 @@ def show_headnode(nodename):
     """
     headnode = get_or_404(model.Headnode, nodename)
     get_auth_backend().require_project_access(headnode.project)
-    return json.dumps({
+    return json_dumps({
         'name': headnode.label,
         'project': headnode.project.label,
         'hnics': [n.label for n in headnode.hnics],
         'vncport': headnode.get_vncport(),
         'uuid': headnode.uuid,
         'base_img': headnode.base_img,
-    }, sort_keys=True)
+    })
 
 
 @rest_call('GET', '/headnode_images/', Schema({}))
@@ -1271,7 +1429,86 @@ def list_headnode_images():
     """
     valid_imgs = cfg.get('headnode', 'base_imgs')
     valid_imgs = sorted([img.strip() for img in valid_imgs.split(',')])
-    return json.dumps(valid_imgs)
+    return json_dumps(valid_imgs)
+
+
+# Batch code #
+##############
+@rest_call('POST', '/batch', Schema({
+    'calls': [{
+        'method': basestring,
+        'path': basestring,
+        Optional('body'): dict,
+    }],
+    Optional('atomic'): bool,
+}))
+def batch(calls, atomic=False):
+    """Make several API calls in one request.
+
+    `calls` is a list of the calls to make, in order. Each is an object
+    with the HTTP `method` and `path` of the call, and optionally its `body`.
+    Each call is handled as if it were made on its own, except that it is
+    not authenticated again; it is made with the access the batch itself
+    was authenticated with. See `hil.rest.subrequest`.
+
+    Returns a JSON array with an entry for each call made, which is an
+    object with the `status` code and `body` (as a string) of its response.
+
+    If `atomic` is false, every call is made, and each takes effect if it
+    succeeds. If `atomic` is true, the calls are made in a single database
+    transaction: they stop at the first one that fails, and none of them
+    take effect unless they all succeed. Effects outside of the database
+    (on OBMs, for example) are not undone.
+
+    Batches cannot be nested.
+    """
+    if getattr(local, 'in_batch', False):
+        raise errors.BadArgumentError('Batches cannot be nested.')
+    local.in_batch = True
+    session = db.session()
+    if atomic:
+        # API calls commit their changes as they go; in an atomic batch,
+        # just flush them, and commit everything together at the end.
+        session.info[model.DEFER_COMMIT] = True
+    results = []
+    failed = False
+    try:
+        for call in calls:
+            resp = subrequest(call['method'].upper(),
+                              call['path'],
+                              call.get('body'),
+                              reuse_auth=True)
+            results.append({'status': resp.status_code,
+                            'body': resp.get_data()})
+            if resp.status_code >= 400:
+                # Make sure nothing the failed call left in the session is
+                # committed by a later one:
+                db.session.rollback()
+                if atomic:
+                    failed = True
+                    break
+    finally:
+        local.in_batch = False
+        session.info.pop(model.DEFER_COMMIT, None)
+    if atomic and not failed:
+        db.session.commit()
+    return json_dumps(results)
+
+
+# Token code #
+##############
+@rest_call('POST', '/auth/token', Schema({}))
+def token_create():
+    """Issue a bearer token with the request's credentials.
+
+    Returns a JSON object with the `token`, and the number of seconds it is
+    valid for (`expires_in`). Until then, requests carrying the header
+    ``Authorization: Bearer <token>`` have the same access this request
+    had. A token cannot be used to obtain another one; see
+    `hil.auth.issue_token`.
+    """
+    token = issue_token()
+    return json_dumps({'token': token, 'expires_in': token_lifetime()})
 
 
 # Extension code #
@@ -1281,7 +1518,7 @@ def list_active_extensions():
     """List all active extensions"""
     get_auth_backend().require_admin()
     extensions = sorted([ext[0] for ext in cfg.items('extensions')])
-    return json.dumps(extensions)
+    return json_dumps(extensions)
 
 
 # Console code #
@@ -1328,7 +1565,7 @@ def absent_or_conflict(cls, name):
 
     Must be called within a request context.
     """
-    obj = db.session.query(cls).filter_by(label=name).first()
+    obj = _lookup(cls, name)
     if obj:
         raise errors.DuplicateError("%s %s already exists." % (cls.__name__,
                                                                name))
@@ -1347,18 +1584,188 @@ def get_or_404(cls, name):
 
     Must be called within a request context.
     """
-    obj = db.session.query(cls).filter_by(label=name).first()
+    obj = _lookup(cls, name)
     if not obj:
         raise errors.NotFoundError("%s %s does not exist." % (cls.__name__,
                                                               name))
     return obj
 
 
+def _lookup(cls, name, owner=None):
+    """Return the `cls` labeled `name`, or None if there isn't one.
+
+    If `owner` is not None, look for the one belonging to `owner` instead.
+
+    Objects found are remembered until the end of the request, so looking the
+    same one up again doesn't go back to the database. A remembered object is
+    only returned while it is still in the current session, under the same
+    label, and not deleted.
+
+    Top-level objects' ids may also be remembered across requests; see
+    `_LabelIdCache`.
+    """
+    if flask.has_app_context():
+        cache = getattr(local, 'lookup_cache', None)
+        if cache is None:
+            cache = local.lookup_cache = {}
+    else:
+        cache = {}
+    key = (cls, name, owner)
+    obj = cache.get(key)
+    if obj is not None and _is_current(obj, name, owner):
+        return obj
+
+    obj = None
+    if owner is None:
+        obj_id = _label_ids.get(cls, name)
+        if obj_id is not None:
+            obj = db.session.query(cls).get(obj_id)
+            if obj is None or obj.label != name:
+                _label_ids.discard(cls, name)
+                obj = None
+    if obj is None:
+        query = db.session.query(cls).filter_by(label=name)
+        if owner is not None:
+            query = query.filter_by(owner=owner)
+        obj = query.first()
+        if obj is not None and owner is None:
+            _label_ids.put(cls, name, obj.id)
+
+    if obj is not None:
+        cache[key] = obj
+    return obj
+
+
+def _is_current(obj, name, owner=None):
+    """Return whether `obj`, as remembered by `_lookup`, may be reused.
+
+    This never goes to the database; if it would have to (because `obj` has
+    been expired, e.g. by a commit) the answer is just False.
+    """
+    state = sqlalchemy.inspect(obj)
+    session = db.session()
+    if not state.persistent or state.session is not session or \
+            obj in session.deleted:
+        return False
+    if state.dict.get('label') != name:
+        return False
+    if owner is not None:
+        owner_state = sqlalchemy.inspect(owner)
+        if owner_state.identity is None or \
+                (state.dict.get('owner_id'),) != owner_state.identity:
+            return False
+    return True
+
+
+class _LabelIdCache(object):
+    """A cache of top-level objects' ids, keyed on (class, label).
+
+    This lets `_lookup` fetch objects by primary key, which is free if the
+    object is already in the session. Entries are checked against the object
+    they point to before use, so a stale one only costs a query; they are
+    also dropped when an object is deleted or renamed (see
+    `_forget_changed_labels`).
+
+    The cache holds at most ``[database] label_cache_size`` entries, the
+    least recently used being dropped first; it is disabled unless that
+    option is set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = None
+
+    def _max_size(self):
+        """Return the configured maximum size, reading it if need be."""
+        if self._size is None:
+            if cfg.has_option('database', 'label_cache_size'):
+                self._size = cfg.getint('database', 'label_cache_size')
+            else:
+                self._size = 0
+        return self._size
+
+    def get(self, cls, name):
+        """Return the id remembered for (`cls`, `name`), or None."""
+        if self._max_size() <= 0:
+            return None
+        with self._lock:
+            obj_id = self._entries.pop((cls, name), None)
+            if obj_id is not None:
+                self._entries[(cls, name)] = obj_id
+            return obj_id
+
+    def put(self, cls, name, obj_id):
+        """Remember that the `cls` labeled `name` has id `obj_id`."""
+        if self._max_size() <= 0:
+            return
+        with self._lock:
+            self._entries.pop((cls, name), None)
+            self._entries[(cls, name)] = obj_id
+            while len(self._entries) > self._max_size():
+                self._entries.popitem(last=False)
+
+    def discard(self, cls, name):
+        """Forget about (`cls`, `name`), and its superclasses'."""
+        with self._lock:
+            for base in cls.__mro__:
+                self._entries.pop((base, name), None)
+
+    def clear(self):
+        """Forget everything, and re-read the configured size on next use."""
+        with self._lock:
+            self._entries.clear()
+            self._size = None
+
+
+_label_ids = _LabelIdCache()
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'after_flush')
+def _forget_changed_labels(session, flush_context):
+    """Drop `_label_ids` entries for objects deleted or renamed by a flush."""
+    for obj in session.deleted:
+        label = sqlalchemy.inspect(obj).dict.get('label')
+        if label is not None:
+            _label_ids.discard(type(obj), label)
+    for obj in session.dirty:
+        attrs = sqlalchemy.inspect(obj).attrs
+        if 'label' in attrs.keys():
+            for label in attrs.label.history.deleted:
+                _label_ids.discard(type(obj), label)
+
+
+def paginate(query, column, limit=None, after=None):
+    """Order `query` by `column`, and iterate over one page of its results.
+
+    Pages are keyed on `column`, which must be unique: only rows whose
+    `column` sorts after `after` are returned, at most `limit` of them. To
+    fetch the next page, pass the last value of `column` on this one as
+    `after`. `None` for either disables that restriction.
+
+    Rows are fetched from the database `QUERY_BATCH_SIZE` at a time, as they
+    are iterated over, so only one batch is ever held in memory.
+    """
+    query = query.order_by(column)
+    while limit is None or limit > 0:
+        size = QUERY_BATCH_SIZE
+        if limit is not None:
+            size = min(size, limit)
+            limit -= size
+        batch = query
+        if after is not None:
+            batch = batch.filter(column > after)
+        rows = batch.limit(size).all()
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        after = getattr(rows[-1], column.key)
+
+
 def _namespaced_query(obj_outer, cls_inner, name_inner):
     """Helper function to search for subobjects of an object."""
-    return db.session.query(cls_inner) \
-        .filter_by(owner=obj_outer) \
-        .filter_by(label=name_inner).first()
+    return _lookup(cls_inner, name_inner, owner=obj_outer)
 
 
 def absent_child_or_conflict(obj_outer, cls_inner, name_inner):
@@ -1,9 +1,24 @@
-"""Authentication and authorization."""
+"""Authentication and authorization.
+
+Besides whatever credentials the auth backend accepts, any request may
+instead present a bearer token (``Authorization: Bearer <token>``), issued
+by ``POST /auth/token``. A token carries the claims of the request it was
+issued to -- admin access and the projects it could act as -- and is checked
+with a single indexed lookup, without involving the backend; see
+`authenticate` and `issue_token`.
+"""
 
 from hil.errors import AuthorizationError
 from hil import model
+from hil.config import cfg
 from abc import ABCMeta, abstractmethod
+from datetime import datetime, timedelta
 
+import base64
+import flask
+import hashlib
+import json
+import os
 import sys
 
 _auth_backend = None
@@ -20,10 +35,24 @@ class AuthBackend(object):
     and `_have_project_access`, and nothing else. Users of the AuthBackend must
     not invoke `_have_admin` and `_have_project_access`, preferring
     `have_admin` and `have_project_access`.
+
+    The wrappers remember the backend's answers for the rest of the request
+    (see `request_memo`), so a backend is asked about each project at most
+    once per request.
+
+    Backends which make their decisions from HIL's database should also set
+    `etag_tables`.
     """
 
     __metaclass__ = ABCMeta
 
+    # The names of the database tables the backend's decisions are made from.
+    # Conditional GETs (see the `etag` argument to `hil.rest.rest_call`) are
+    # answered without calling the API function, and so without checking
+    # authorization; the ETags therefore cover these tables too, so that a
+    # change in a user's access invalidates them.
+    etag_tables = ()
+
     @abstractmethod
     def authenticate(self):
         """Authenticate the api call, and prepare for later authorization checks.
@@ -64,13 +93,28 @@ class AuthBackend(object):
         the `have_*` and `require_*` wrappers handle this.
         """
 
+    def get_user(self):
+        """Return the name of the user the request is authenticated as.
+
+        Backends which know this should override this method; the default
+        returns None. It is recorded in tokens issued to the request.
+        """
+        return None
+
     def have_admin(self):
         """Check if the request is authorized to act as an administrator.
 
         Return True if so, False if not. This will be caled sometime after
         ``authenticate()``.
         """
-        return self._have_admin()
+        memo = request_memo()
+        if 'admin' not in memo:
+            token = _request_token()
+            if token is not None:
+                memo['admin'] = token.is_admin
+            else:
+                memo['admin'] = self._have_admin()
+        return memo['admin']
 
     def have_project_access(self, project):
         """Check if the request is authorized to act as the given project.
@@ -86,10 +130,20 @@ class AuthBackend(object):
         """
 
         if project is None:
-            return self._have_admin()
+            return self.have_admin()
 
         assert isinstance(project, model.Project)
-        return self._have_admin() or self._have_project_access(project)
+        if self.have_admin():
+            return True
+        memo = request_memo()
+        key = ('project', project)
+        if key not in memo:
+            token = _request_token()
+            if token is not None:
+                memo[key] = project.id in json.loads(token.project_ids)
+            else:
+                memo[key] = self._have_project_access(project)
+        return memo[key]
 
     def require_admin(self):
         """Ensure the request is authorized to act as an administrator.
@@ -124,3 +178,143 @@ def set_auth_backend(backend):
 def get_auth_backend():
     """Return the current auth backend."""
     return _auth_backend
+
+
+def request_memo():
+    """Return a dict for remembering authorization decisions in.
+
+    The dict lasts for the rest of the request; it is emptied whenever the
+    request is authenticated, and whenever ``hil.rest.local.auth`` is
+    replaced. Besides the `AuthBackend` wrappers, backends may use it to
+    remember anything they need to make their decisions. A backend which
+    changes the request's access other than by replacing
+    ``hil.rest.local.auth`` must clear it.
+    """
+    if not flask.has_app_context():
+        return {}
+    auth = getattr(flask.g, 'auth', None)
+    memo = getattr(flask.g, 'auth_memo', None)
+    if memo is None or memo[0] is not auth:
+        memo = flask.g.auth_memo = (auth, {})
+    return memo[1]
+
+
+def _request_token():
+    """Return the `AuthToken` the request authenticated with, if any."""
+    if not flask.has_app_context():
+        return None
+    return getattr(flask.g, 'auth_token', None)
+
+
+def _hash_token(token):
+    """Return the hash under which `token` is stored."""
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def _bearer_token():
+    """Return the bearer token the request was made with, or None."""
+    scheme, _, token = \
+        flask.request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return token
+
+
+def token_lifetime():
+    """Return how long issued tokens are valid for, in seconds.
+
+    This is ``[auth] token_lifetime``, which defaults to an hour.
+    """
+    if cfg.has_option('auth', 'token_lifetime'):
+        return cfg.getint('auth', 'token_lifetime')
+    return 3600
+
+
+def authenticate():
+    """Authenticate the current request.
+
+    If the request carries a bearer token, it is authenticated by that
+    alone; otherwise this defers to the auth backend's ``authenticate()``.
+    Returns whether authentication was successful.
+    """
+    flask.g.auth_token = None
+    flask.g.auth_memo = None
+    token = _bearer_token()
+    if token is None:
+        return get_auth_backend().authenticate()
+    flask.g.auth = None
+    row = model.AuthToken.query \
+        .filter_by(token_hash=_hash_token(token)).first()
+    if row is None or row.expires <= datetime.utcnow():
+        return False
+    flask.g.auth_token = row
+    return True
+
+
+def get_user():
+    """Return the name of the user the request is authenticated as.
+
+    This is None if it isn't known.
+    """
+    token = _request_token()
+    if token is not None:
+        return token.user
+    return get_auth_backend().get_user()
+
+
+def issue_token():
+    """Issue a token carrying the current request's claims.
+
+    Returns the token, which is only ever stored hashed. Tokens cannot be
+    used to obtain new ones; doing so raises an `AuthorizationError`.
+    Expired tokens are deleted as a side effect.
+    """
+    if _request_token() is not None:
+        raise AuthorizationError("A token cannot be used to obtain "
+                                 "another token.")
+    backend = get_auth_backend()
+    is_admin = backend.have_admin()
+    project_ids = []
+    if not is_admin:
+        project_ids = [project.id
+                       for project in model.Project.query
+                       if backend.have_project_access(project)]
+
+    now = datetime.utcnow()
+    model.AuthToken.query.filter(model.AuthToken.expires <= now) \
+        .delete(synchronize_session=False)
+    token = base64.urlsafe_b64encode(os.urandom(32)).rstrip('=')
+    model.db.session.add(model.AuthToken(
+        token_hash=_hash_token(token),
+        expires=now + timedelta(seconds=token_lifetime()),
+        user=backend.get_user(),
+        is_admin=is_admin,
+        project_ids=json.dumps(project_ids),
+    ))
+    model.db.session.commit()
+    return token
+
+
+def revoke_tokens(user=None, project=None):
+    """Revoke the tokens issued to `user`, or granting access to `project`.
+
+    `user` is a user name, `project` a `model.Project`. Tokens carry the
+    claims they were issued with, so anything which takes away a user's
+    access (or, for the database backend, changes their password) must
+    call this; so must deleting a project, since its id may be reused.
+    The caller is responsible for committing.
+    """
+    query = model.AuthToken.query
+    if user is not None:
+        query.filter_by(user=user).delete(synchronize_session=False)
+    if project is not None:
+        # The project ids are JSON, so we can't match them in SQL:
+        ids = [token.id
+               for token in query.filter_by(is_admin=False)
+               if project.id in json.loads(token.project_ids)]
+        if ids:
+            query.filter(model.AuthToken.id.in_(ids)) \
+                .delete(synchronize_session=False)
@@ -85,10 +85,12 @@ def setup_http_client():
     Sets http_client to an object which makes HTTP requests with
     authentication. It chooses an authentication backend as follows:
 
-    1. If the environment variables HIL_USERNAME and HIL_PASSWORD
+    1. If the environment variable HIL_TOKEN is defined, it is sent as a
+       bearer token (which `token_create` obtains).
+    2. If the environment variables HIL_USERNAME and HIL_PASSWORD
        are defined, it will use HTTP basic auth, with the corresponding
        user name and password.
-    2. If the `python-keystoneclient` library is installed, and the
+    3. If the `python-keystoneclient` library is installed, and the
        environment variables:
 
            * OS_AUTH_URL
@@ -97,7 +99,7 @@ def setup_http_client():
            * OS_PROJECT_NAME
 
        are defined, Keystone is used.
-    3. Oterwise, do not supply authentication information.
+    4. Oterwise, do not supply authentication information.
 
     This may be extended with other backends in the future.
 
@@ -107,11 +109,18 @@ def setup_http_client():
     """
     global http_client
     global C  # initiating the client library
-    # First try basic auth:
+    # First try a token:
     ep = (
             os.environ.get('HIL_ENDPOINT') or
             sys.stdout.write("Error: HIL_ENDPOINT not set \n")
             )
+    token = os.getenv('HIL_TOKEN')
+    if token is not None:
+        http_client = RequestsHTTPClient()
+        http_client.headers['Authorization'] = 'Bearer ' + token
+        C = Client(ep, http_client)
+        return
+    # Next try basic auth:
     basic_username = os.getenv('HIL_USERNAME')
     basic_password = os.getenv('HIL_PASSWORD')
     if basic_username is not None and basic_password is not None:
@@ -258,8 +267,7 @@ def serve(port):
 @cmd
 def serve_networks():
     """Start the HIL networking server"""
-    from hil import model, deferred
-    from time import sleep
+    from hil import model, deferred, journal
     config.setup()
     server.init()
     server.register_drivers()
@@ -277,17 +285,108 @@ def serve_networks():
         if sleep_time <= 0 or sleep_time >= 3600:
             sys.exit("Error: sleep_time not within bounds "
                      "0 < sleep_time < 3600")
-        if sleep_time > 60:
-            logger.warn('sleep_time greater than 1 minute.')
     else:
-        sleep_time = 2
-
-    while True:
-        # Empty the journal until it's empty; then delay so we don't tight
-        # loop.
-        while deferred.apply_networking():
-            pass
-        sleep(sleep_time)
+        sleep_time = None
+
+    # Check if config contains usable workers
+    if (cfg.has_section('network-daemon') and
+            cfg.has_option('network-daemon', 'workers')):
+        try:
+            workers = cfg.getint('network-daemon', 'workers')
+        except (ValueError):
+            sys.exit("Error: workers set to non-integer value")
+        if workers < 1:
+            sys.exit("Error: workers must be at least 1")
+    else:
+        workers = 1
+
+    # Check if config contains usable lease_time
+    if (cfg.has_section('network-daemon') and
+            cfg.has_option('network-daemon', 'lease_time')):
+        try:
+            lease_time = cfg.getfloat('network-daemon', 'lease_time')
+        except (ValueError):
+            sys.exit("Error: lease_time set to non-float value")
+        if lease_time <= 0:
+            sys.exit("Error: lease_time must be > 0")
+    else:
+        lease_time = deferred.DEFAULT_LEASE_TIME
+
+    # Check if config contains usable batch_size
+    if (cfg.has_section('network-daemon') and
+            cfg.has_option('network-daemon', 'batch_size')):
+        try:
+            batch_size = cfg.getint('network-daemon', 'batch_size')
+        except (ValueError):
+            sys.exit("Error: batch_size set to non-integer value")
+        if batch_size < 1:
+            sys.exit("Error: batch_size must be at least 1")
+    else:
+        batch_size = deferred.DEFAULT_BATCH_SIZE
+
+    # Check if config contains usable session_idle_timeout
+    if (cfg.has_section('network-daemon') and
+            cfg.has_option('network-daemon', 'session_idle_timeout')):
+        try:
+            session_idle_timeout = cfg.getfloat('network-daemon',
+                                                'session_idle_timeout')
+        except (ValueError):
+            sys.exit("Error: session_idle_timeout set to non-float value")
+        if session_idle_timeout < 0:
+            sys.exit("Error: session_idle_timeout must be >= 0")
+    else:
+        session_idle_timeout = deferred.DEFAULT_SESSION_IDLE_TIMEOUT
+
+    # Check if config contains usable session_max_age
+    if (cfg.has_section('network-daemon') and
+            cfg.has_option('network-daemon', 'session_max_age')):
+        try:
+            session_max_age = cfg.getfloat('network-daemon',
+                                           'session_max_age')
+        except (ValueError):
+            sys.exit("Error: session_max_age set to non-float value")
+        if session_max_age < 0:
+            sys.exit("Error: session_max_age must be >= 0")
+    else:
+        session_max_age = deferred.DEFAULT_SESSION_MAX_AGE
+
+    listener = journal.Listener()
+    try:
+        if sleep_time is None:
+            if listener.enabled():
+                # We'll be woken up when there's work to do, so polling is
+                # only a safety net.
+                sleep_time = 60
+            else:
+                sleep_time = 2
+        elif sleep_time > 60 and not listener.enabled():
+            logger.warn('sleep_time greater than 1 minute.')
+
+        pool = deferred.SessionPool(idle_timeout=session_idle_timeout,
+                                    max_age=session_max_age)
+        try:
+            while True:
+                # Empty the journal until it's empty; then delay so we don't
+                # tight loop.
+                while deferred.apply_networking(workers, lease_time,
+                                                batch_size=batch_size,
+                                                pool=pool):
+                    pass
+                pool.reap()
+                listener.wait(sleep_time)
+        finally:
+            pool.close()
+    finally:
+        listener.close()
+
+
+@cmd
+def token_create():
+    """Obtain a bearer token, which may be used in place of other credentials.
+
+    Set HIL_TOKEN to the token to use it.
+    """
+    do_post(object_url('auth', 'token'))
 
 
 @cmd
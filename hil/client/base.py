@@ -1,11 +1,20 @@
 """ This module implements the HIL client library. """
 
 from urlparse import urljoin
+from collections import OrderedDict
 import json
 import re
 from hil.errors import BadArgumentError
 import inspect
 
+# How many results to ask the server for at a time, when iterating over a
+# paginated list call.
+DEFAULT_PAGE_SIZE = 100
+
+# A reasonable number of GET responses for a client to remember, for
+# revalidating with If-None-Match; see `ConditionalGetClient`.
+DEFAULT_CACHE_SIZE = 256
+
 
 class FailedAPICallException(Exception):
     """An exception indicating that the server returned an error.
@@ -22,6 +31,52 @@ class FailedAPICallException(Exception):
         self.error_type = error_type
 
 
+class ConditionalGetClient(object):
+    """Wraps an HTTPClient, making repeated GET requests conditional.
+
+    Responses to GET requests which carry an ETag are remembered. When the
+    same request is made again, the tag is sent in an If-None-Match header,
+    and if the server answers 304 Not Modified, the remembered response is
+    returned in its place. At most `cache_size` responses are remembered;
+    the least recently used are forgotten first.
+
+    `http_client`'s ``request`` method must accept the `headers` argument,
+    which older `HTTPClient` implementations may not; hence this is opt-in,
+    via the `cache_size` argument to `hil.client.client.Client`.
+    """
+
+    def __init__(self, http_client, cache_size=DEFAULT_CACHE_SIZE):
+        self.http_client = http_client
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def request(self, method, url, data=None, params=None):
+        """Make an HTTP request, as with HTTPClient.request."""
+        if method != 'GET':
+            return self.http_client.request(method, url, data=data,
+                                            params=params)
+
+        key = (url, tuple(sorted((params or {}).items())))
+        cached = self._cache.pop(key, None)
+        if cached is None:
+            response = self.http_client.request(method, url, data=data,
+                                                params=params)
+        else:
+            headers = {'If-None-Match': cached.headers['ETag']}
+            response = self.http_client.request(method, url, data=data,
+                                                params=params,
+                                                headers=headers)
+            if response.status_code == 304:
+                response = cached
+
+        if 200 <= response.status_code < 300 and \
+                response.headers.get('ETag') is not None:
+            self._cache[key] = response
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return response
+
+
 class ClientBase(object):
     """Main class which contains all the methods to
 
@@ -50,16 +105,19 @@ class ClientBase(object):
         url = urljoin(self.endpoint, rel)
         return url
 
-    def check_response(self, response):
+    def check_response(self, response, ordered=False):
         """
         Check the response from an API call, and do any needed error handling
 
         Returns the body of the response as (parsed) JSON, or None if there
         was no body. Raises a FailedAPICallException on any non 2xx status.
+        If `ordered` is True, JSON objects are returned as `OrderedDict`s,
+        in the order the server sent their keys.
         """
         if 200 <= response.status_code < 300:
+            hook = OrderedDict if ordered else None
             try:
-                return json.loads(response.content)
+                return json.loads(response.content, object_pairs_hook=hook)
             except ValueError:  # No JSON request body; typical
                                 # For methods PUT, POST, DELETE
                 return
@@ -73,6 +131,34 @@ class ClientBase(object):
         except ValueError:
             return response.content
 
+    def paginate(self, url, params=None, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over the results of a paginated list call.
+
+        Fetches `page_size` results at a time from `url`, passing along any
+        query parameters in `params`, until the server runs out. Calls which
+        return a JSON array yield its elements; calls which return a JSON
+        object yield its (key, value) pairs. Either way, results come in the
+        server's order, which is the database's collation order, and need
+        not match Python's; the last result on a page is where the next one
+        starts.
+        """
+        params = dict(params or {}, limit=page_size)
+        while True:
+            page = self.check_response(
+                self.httpClient.request('GET', url, params=params),
+                ordered=True)
+            if isinstance(page, dict):
+                keys = page.keys()
+                for key in keys:
+                    yield key, page[key]
+            else:
+                keys = page
+                for item in page:
+                    yield item
+            if len(keys) < page_size:
+                return
+            params['after'] = keys[-1]
+
 
 def _find_reserved(string, slashes_ok=False):
     """Returns a list of illegal characters in a string"""
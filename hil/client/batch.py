@@ -0,0 +1,48 @@
+"""Client support for making batches of api calls."""
+import json
+from collections import namedtuple
+from hil.client.base import ClientBase
+
+
+class BatchResult(namedtuple('BatchResult', ['status_code', 'content'])):
+    """The response to one of the calls in a batch.
+
+    Attributes
+    ----------
+
+    status_code : int
+        The http status code
+    content : str
+        The body of the response
+    """
+
+
+class Batch(ClientBase):
+    """Consists of calls to make several api calls in one request."""
+
+    def run(self, calls, atomic=False):
+        """Make the api calls in `calls`, in order, in a single request.
+
+        `calls` is a list of (method, path, body) tuples, where `path` is
+        relative to the root of the API (e.g. '/node/node-1') and `body` is
+        the JSON-serializable body of the call, or None.
+
+        If `atomic` is True, either all of the calls take effect or none of
+        them do; the calls stop at the first one which fails.
+
+        Returns a list with a `BatchResult` for each call made, which may be
+        passed to `check_response`.
+        """
+        payload = []
+        for method, path, body in calls:
+            call = {'method': method, 'path': path}
+            if body is not None:
+                call['body'] = body
+            payload.append(call)
+        url = self.object_url('batch')
+        results = self.check_response(self.httpClient.request(
+            'POST', url, data=json.dumps({'calls': payload,
+                                          'atomic': atomic})))
+        return [BatchResult(status_code=result['status'],
+                            content=result['body'])
+                for result in results]
@@ -10,8 +10,11 @@ from hil.client.switch import Port
 from hil.client.network import Network
 from hil.client.user import User
 from hil.client.extensions import Extensions
+from hil.client.batch import Batch
+from hil.client.base import ConditionalGetClient
 import abc
 import requests
+import time
 
 from collections import namedtuple
 
@@ -26,12 +29,13 @@ class HTTPClient(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
         """Make an HTTP request
 
         Makes an HTTP request on URL `url` with method `method`, request body
-        `data`(if supplied) and query parameter `params`(if supplied). May add
-        authentication or other backend-specific information to the request.
+        `data`(if supplied), query parameter `params`(if supplied) and extra
+        `headers`(if supplied). May add authentication or other
+        backend-specific information to the request.
 
         Parameters
         ----------
@@ -45,6 +49,11 @@ class HTTPClient(object):
         params : dictionary, optional
             The query parameter, e.g. {'key1': 'val1', 'key2': 'val2'},
             dictionary key can't be `None`
+        headers : dictionary, optional
+            Extra headers to send, e.g. {'If-None-Match': '"abc123"'}. This
+            is only ever passed if conditional GETs are enabled (see
+            `Client`), so implementations written before it was added keep
+            working without it.
 
         Returns
         -------
@@ -80,8 +89,32 @@ class RequestsHTTPClient(requests.Session, HTTPClient):
     The requests library's Response object actually satisfies the
     needed interface by itself, but by wrapping it we decrease the
     odds of accidentally depending on requests-specific functionality.
+
+    If `token_url` is given (the URL of HIL's ``/auth/token``), the
+    session's credentials (``auth``) are only used to obtain a bearer token
+    from it, which is sent with requests instead. A new token is obtained
+    shortly before the old one expires, or if the server stops accepting
+    it. If the server doesn't issue tokens at all (it is too old, so the
+    token endpoint gives a 404 or 405), the session's credentials are used
+    from then on; if a token can't be obtained for any other reason (the
+    server may be restarting, say), they are used for that one request,
+    and the next request tries again.
     """
 
+    # Responses from the token endpoint meaning the server doesn't issue
+    # tokens at all:
+    TOKENS_UNSUPPORTED = frozenset([404, 405])
+
+    # How long before a token expires to replace it, in seconds:
+    TOKEN_REFRESH_MARGIN = 60
+
+    def __init__(self, token_url=None):
+        requests.Session.__init__(self)
+        self.token_url = token_url
+        self._token = None
+        self._token_refresh = None
+        self._token_failed = False
+
     # disable a pylint warning about arguments that don't match the
     # superclass's; we just pass these straight through to the super
     # class's method, so *args, **kwargs let's us ignore what they
@@ -89,11 +122,58 @@ class RequestsHTTPClient(requests.Session, HTTPClient):
     #
     # pylint: disable=arguments-differ
     def request(self, *args, **kwargs):
-        resp = requests.Session.request(self, *args, **kwargs)
+        if self.token_url is None or self._token_failed or 'auth' in kwargs:
+            resp = requests.Session.request(self, *args, **kwargs)
+        else:
+            resp = self._request_with_token(*args, **kwargs)
         return HTTPResponse(status_code=resp.status_code,
                             headers=resp.headers,
                             content=resp.content)
 
+    def _request_with_token(self, *args, **kwargs):
+        """Make a request with a bearer token, obtaining one if need be."""
+        reused = self._token is not None and \
+            time.time() < self._token_refresh
+        if not reused:
+            self._get_token()
+        if self._token is None:
+            return requests.Session.request(self, *args, **kwargs)
+        resp = requests.Session.request(
+            self, auth=_BearerAuth(self._token), *args, **kwargs)
+        if resp.status_code == 401 and reused:
+            # The server may have forgotten about the token (if its database
+            # was reset, for instance); try again with a new one:
+            self._get_token()
+            if self._token is not None:
+                resp = requests.Session.request(
+                    self, auth=_BearerAuth(self._token), *args, **kwargs)
+        return resp
+
+    def _get_token(self):
+        """Obtain a new token, or set the token to None on failure."""
+        self._token = None
+        started = time.time()
+        resp = requests.Session.request(self, 'POST', self.token_url)
+        if resp.status_code != 200:
+            if resp.status_code in self.TOKENS_UNSUPPORTED:
+                self._token_failed = True
+            return
+        result = resp.json()
+        self._token = result['token']
+        self._token_refresh = started + \
+            result['expires_in'] - self.TOKEN_REFRESH_MARGIN
+
+
+class _BearerAuth(requests.auth.AuthBase):
+    """Authenticate a request with a bearer token."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, req):
+        req.headers['Authorization'] = 'Bearer ' + self.token
+        return req
+
 
 class KeystoneHTTPClient(HTTPClient):
     """An HTTPClient which authenticates with Keystone.
@@ -113,7 +193,7 @@ class KeystoneHTTPClient(HTTPClient):
         """
         self.session = session
 
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
         """Make an HTTP request using keystone for authentication.
 
         Smooths over the differences between python-keystoneclient's
@@ -129,7 +209,8 @@ class KeystoneHTTPClient(HTTPClient):
             resp = self.session.request(method=method,
                                         url=url,
                                         data=data,
-                                        params=params)
+                                        params=params,
+                                        headers=headers)
 
         except HttpError as e:
             resp = e.response
@@ -139,9 +220,17 @@ class KeystoneHTTPClient(HTTPClient):
 
 
 class Client(object):
-    """A HIL API client."""
+    """A HIL API client.
+
+    If `cache_size` is non-zero, the client remembers that many responses to
+    GET requests which carry an ETag, and makes repeated requests
+    conditional (see `ConditionalGetClient`). This needs an `httpClient`
+    whose ``request`` method accepts a `headers` argument.
+    """
 
-    def __init__(self, endpoint, httpClient):
+    def __init__(self, endpoint, httpClient, cache_size=0):
+        if cache_size:
+            httpClient = ConditionalGetClient(httpClient, cache_size)
         self.httpClient = httpClient
         self.endpoint = endpoint
         self.node = Node(self.endpoint, self.httpClient)
@@ -151,3 +240,4 @@ class Client(object):
         self.network = Network(self.endpoint, self.httpClient)
         self.user = User(self.endpoint, self.httpClient)
         self.extensions = Extensions(self.endpoint, self.httpClient)
+        self.batch = Batch(self.endpoint, self.httpClient)
@@ -2,6 +2,7 @@
 import json
 from hil.client.base import ClientBase
 from hil.client.base import check_reserved_chars
+from hil.client.base import DEFAULT_PAGE_SIZE
 
 
 class Network(ClientBase):
@@ -15,6 +16,18 @@ class Network(ClientBase):
             url = self.object_url('networks')
             return self.check_response(self.httpClient.request("GET", url))
 
+        def iterate(self, project=None, page_size=DEFAULT_PAGE_SIZE):
+            """Iterate over all networks under HIL, a page at a time.
+
+            Yields (name, attributes) pairs. If `project` is given, only the
+            networks it has access to are included.
+            """
+            url = self.object_url('networks')
+            params = {}
+            if project is not None:
+                params['project'] = project
+            return self.paginate(url, params, page_size)
+
         @check_reserved_chars()
         def list_network_attachments(self, network, project):
             """Lists nodes connected to a network"""
@@ -1,6 +1,7 @@
 """Client support for node related api calls."""
 import json
 from hil.client.base import ClientBase, FailedAPICallException
+from hil.client.base import DEFAULT_PAGE_SIZE
 from hil.client.base import check_reserved_chars
 from hil.errors import BadArgumentError, UnknownSubtypeError
 
@@ -16,6 +17,42 @@ class Node(ClientBase):
         url = self.object_url('nodes', is_free)
         return self.check_response(self.httpClient.request('GET', url))
 
+    def iterate(self, is_free='all', project=None, switch=None,
+                metadata_key=None, metadata_value=None,
+                page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over the names of nodes that HIL manages.
+
+        Like `list`, but fetches them from the server a page at a time. The
+        other arguments narrow the results, as described for the server's
+        list_nodes call.
+        """
+        url = self.object_url('nodes', is_free)
+        params = {}
+        for name, value in [('project', project),
+                            ('switch', switch),
+                            ('metadata_key', metadata_key),
+                            ('metadata_value', metadata_value)]:
+            if value is not None:
+                params[name] = value
+        return self.paginate(url, params, page_size)
+
+    def list_detail(self, project=None, free=False):
+        """Show attributes of many nodes at once.
+
+        Returns a dict mapping node names to the attributes `show` would
+        return for them. If `project` is given only its nodes are listed;
+        if `free` is True only free nodes are.
+        """
+        url = self.object_url('nodes', 'detail')
+        params = {}
+        if project is not None:
+            params['project'] = project
+        if free:
+            params['free'] = 'true'
+        return self.check_response(
+                self.httpClient.request('GET', url, params=params)
+                )
+
     @check_reserved_chars()
     def show(self, node_name):
         """Shows attributes of a given node """
@@ -2,6 +2,7 @@
 import json
 from hil.client.base import ClientBase
 from hil.client.base import check_reserved_chars
+from hil.client.base import DEFAULT_PAGE_SIZE
 
 
 class Project(ClientBase):
@@ -16,6 +17,11 @@ class Project(ClientBase):
             url = self.object_url('/projects')
             return self.check_response(self.httpClient.request("GET", url))
 
+        def iterate(self, page_size=DEFAULT_PAGE_SIZE):
+            """Iterate over all projects under HIL, a page at a time."""
+            url = self.object_url('/projects')
+            return self.paginate(url, page_size=page_size)
+
         @check_reserved_chars()
         def nodes_in(self, project_name):
             """Lists nodes allocated to project <project_name> """
@@ -2,6 +2,7 @@
 import json
 from hil.client.base import check_reserved_chars
 from hil.client.base import ClientBase
+from hil.client.base import DEFAULT_PAGE_SIZE
 
 
 class Switch(ClientBase):
@@ -15,6 +16,11 @@ class Switch(ClientBase):
         url = self.object_url('/switches')
         return self.check_response(self.httpClient.request("GET", url))
 
+    def iterate(self, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over all switches that HIL manages, a page at a time."""
+        url = self.object_url('/switches')
+        return self.paginate(url, page_size=page_size)
+
     def register(self, switch, subtype, switchinfo):
         #import pdb;pdb.set_trace()
         """Registers a switch with name <switch> and
@@ -6,6 +6,7 @@ username & password auth.
 import json
 from hil.client.base import ClientBase
 from hil.client.base import check_reserved_chars
+from hil.client.base import DEFAULT_PAGE_SIZE
 
 
 class User(ClientBase):
@@ -18,6 +19,14 @@ class User(ClientBase):
         url = self.object_url('/auth/basic/users')
         return self.check_response(self.httpClient.request("GET", url))
 
+    def iterate(self, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over all users, a page at a time.
+
+        Yields (name, attributes) pairs.
+        """
+        url = self.object_url('/auth/basic/users')
+        return self.paginate(url, page_size=page_size)
+
     @check_reserved_chars(dont_check=['password', 'is_admin'])
     def create(self, username, password, is_admin):
         """Create a user <username> with password <password>.
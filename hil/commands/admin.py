@@ -1,6 +1,7 @@
 """Implement the hil-admin command."""
 from hil import config, model
 from hil.commands import db
+from hil.commands.layout import ImportLayout, ExportLayout
 from hil.commands.migrate_ipmi_info import MigrateIpmiInfo
 from hil.commands.util import ensure_not_root
 from hil.flaskapp import app
@@ -9,6 +10,8 @@ from flask_script import Manager
 manager = Manager(app)
 manager.add_command('db', db.command)
 manager.add_command('migrate-ipmi-info', MigrateIpmiInfo())
+manager.add_command('import-layout', ImportLayout())
+manager.add_command('export-layout', ExportLayout())
 
 
 def main():
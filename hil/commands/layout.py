@@ -0,0 +1,67 @@
+"""Implement the ``hil-admin import-layout`` and ``export-layout`` commands.
+
+See `hil.layout` for a description of layouts.
+"""
+import json
+import sys
+
+from flask_script import Command, Option
+from schema import Schema, SchemaError
+
+from hil import server
+from hil.errors import APIError
+from hil.flaskapp import app
+from hil.layout import LAYOUT_SCHEMA, import_layout, export_layout
+
+
+class ImportLayout(Command):
+    """Add everything in a site layout to HIL"""
+
+    option_list = (
+        Option('filename', help='JSON file with the layout; - for stdin'),
+    )
+
+    # pylint: disable=arguments-differ
+    def run(self, filename):
+        server.init()
+        if filename == '-':
+            layout = json.load(sys.stdin)
+        else:
+            with open(filename) as f:
+                layout = json.load(f)
+        try:
+            layout = Schema(LAYOUT_SCHEMA).validate(layout)
+        except SchemaError as e:
+            sys.exit('Invalid layout: %s' % e)
+        with app.app_context():
+            try:
+                import_layout(layout)
+            except APIError as e:
+                sys.exit('%s: %s' % (type(e).__name__, e.message))
+
+
+class ExportLayout(Command):
+    """Write the layout of everything in HIL"""
+
+    option_list = (
+        Option('-o', '--output', dest='filename', default='-',
+               help='file to write the layout to; - (the default) for '
+                    'stdout'),
+    )
+
+    # pylint: disable=arguments-differ
+    def run(self, filename):
+        server.init()
+        with app.app_context():
+            if filename == '-':
+                _write_layout(sys.stdout)
+            else:
+                with open(filename, 'w') as f:
+                    _write_layout(f)
+
+
+def _write_layout(f):
+    """Write the layout of everything in HIL to the file `f`."""
+    for chunk in export_layout():
+        f.write(chunk)
+    f.write('\n')
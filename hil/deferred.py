@@ -3,10 +3,144 @@
 from hil import model
 from hil.model import db
 from hil.errors import SwitchError
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
 import logging
+import os
+import socket
+import threading
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
+# Identifies this process when claiming networking actions.
+DAEMON_ID = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                          uuid.uuid4().hex[:8])
+
+# How long, in seconds, a daemon's claim on a networking action lasts if it
+# isn't renewed.
+DEFAULT_LEASE_TIME = 300
+
+# The default maximum number of networking actions to claim at a time.
+DEFAULT_BATCH_SIZE = 500
+
+# Defaults for how long, in seconds, a ``SessionPool`` keeps a switch session
+# open while it is idle, and in total.
+DEFAULT_SESSION_IDLE_TIMEOUT = 300
+DEFAULT_SESSION_MAX_AGE = 3600
+
+
+def _disconnect(session):
+    """Disconnect the switch session ``session``, logging any errors.
+
+    A session being thrown away may well be broken, and failing to log out
+    cleanly shouldn't stop the daemon.
+    """
+    try:
+        session.disconnect()
+    except Exception as e:
+        logger.warn('Error disconnecting from switch: %s', e)
+
+
+class SessionPool(object):
+    """Keeps switch sessions open across calls to ``apply_networking``.
+
+    Logging in to a switch can take several seconds, so rather than opening
+    a new session for each batch of work, the networking daemon keeps the
+    sessions around and reuses them. A session is closed once it has been
+    idle for ``idle_timeout`` seconds, or open for ``max_age`` seconds, and
+    is checked before reuse; see ``SwitchSession.release`` and
+    ``SwitchSession.reuse``. Sessions for drivers which don't support this
+    are disconnected at the end of each batch, as usual.
+
+    The pool may be shared by several worker threads, but a session is only
+    handed out to one of them at a time.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_SESSION_IDLE_TIMEOUT,
+                 max_age=DEFAULT_SESSION_MAX_AGE):
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Switch label -> (session, time opened, time last used), for the
+        # sessions not currently in use.
+        self._idle = {}
+        # Switch label -> time opened, for the sessions in use.
+        self._opened = {}
+
+    def _expired(self, opened, last_used, now):
+        """Return whether a session opened and last used at the given times
+        should be closed rather than reused.
+        """
+        return now - opened >= self.max_age or \
+            now - last_used >= self.idle_timeout
+
+    def get(self, switch):
+        """Return a session for ``switch``.
+
+        An open session is reused if there is one, otherwise a new one is
+        created. Either way, it must be returned with ``put`` once the
+        caller is done with it.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._idle.pop(switch.label, None)
+        if entry is not None:
+            session, opened, last_used = entry
+            if not self._expired(opened, last_used, now) and \
+                    session.reuse(switch):
+                with self._lock:
+                    self._opened[switch.label] = opened
+                return session
+            _disconnect(session)
+        session = switch.session()
+        with self._lock:
+            self._opened[switch.label] = now
+        return session
+
+    def put(self, label, session):
+        """Return ``session``, for the switch labeled ``label``, to the pool.
+
+        ``session`` must have come from ``get``.
+        """
+        with self._lock:
+            opened = self._opened.pop(label)
+        # The session needn't subclass SwitchSession; see ``Switch.session``.
+        release = getattr(session, 'release', None)
+        try:
+            keep = release is not None and release()
+        except Exception:
+            _disconnect(session)
+            raise
+        if not keep:
+            session.disconnect()
+            return
+        with self._lock:
+            self._idle[label] = (session, opened, time.time())
+
+    def reap(self):
+        """Close the idle sessions which have expired."""
+        now = time.time()
+        with self._lock:
+            expired = [label for label, (_, opened, last_used)
+                       in self._idle.iteritems()
+                       if self._expired(opened, last_used, now)]
+            sessions = [self._idle.pop(label)[0] for label in expired]
+        for session in sessions:
+            _disconnect(session)
+
+    def close(self):
+        """Close all of the idle sessions."""
+        with self._lock:
+            sessions = [session for session, _, _ in self._idle.values()]
+            self._idle = {}
+        for session in sessions:
+            _disconnect(session)
+
 
 class DaemonSession(object):
     """A daemon session tracks switch sessions during a call to
@@ -14,11 +148,13 @@ class DaemonSession(object):
 
     When applying a networking action, if the DaemonSession does not
     already have a switch session for the relevant switch, it will
-    create one, and cache it for next time.
+    create one (or get one from ``pool``, if given), and cache it for next
+    time.
     """
 
-    def __init__(self):
+    def __init__(self, pool=None):
         self.switch_sessions = {}
+        self.pool = pool
 
     def handle_action(self, action):
         """apply the networking action ``action``."""
@@ -31,33 +167,68 @@ class DaemonSession(object):
         else:
             getattr(self, action.type)(action)
 
+    def handle_actions(self, actions):
+        """Apply the networking actions ``actions``.
+
+        If there is more than one action, they must all be modify_port
+        actions on the same port (see ``_batch_by_port``), which are sent to
+        the switch together.
+        """
+        if len(actions) == 1:
+            self.handle_action(actions[0])
+        else:
+            self.modify_ports(actions)
+
     def modify_port(self, action):
         """Apply a modify_port action."""
-        session = self.get_session(action.nic.port.owner)
+        self.modify_ports([action])
 
-        if action.new_network is None:
-            network_id = None
-        else:
-            network_id = action.new_network.network_id
+    def modify_ports(self, actions):
+        """Apply several modify_port actions on the same port at once.
 
-        try:
-            session.modify_port(action.nic.port.label,
-                                action.channel,
-                                network_id)
+        If the switch rejects the changes, all of the actions are marked
+        ERROR, since we can't tell which of them were applied.
+        """
+        port = actions[0].nic.port
+        session = self.get_session(port.owner)
+
+        changes = []
+        for action in actions:
             if action.new_network is None:
+                changes.append((action.channel, None))
+            else:
+                changes.append((action.channel,
+                                action.new_network.network_id))
+
+        try:
+            if len(changes) == 1:
+                session.modify_port(port.label, *changes[0])
+            elif hasattr(session, 'apply_port_changes'):
+                session.apply_port_changes(port.label, changes)
+            else:
+                # The session needn't subclass SwitchSession; see
+                # ``Switch.session``.
+                for channel, network_id in changes:
+                    session.modify_port(port.label, channel, network_id)
+            for action in actions:
+                # Normally the api has already made sure the channel is free
+                # before queueing a connect, but a coalesced detach may not
+                # have been applied; either way, whatever was there is gone
+                # now.
                 model.NetworkAttachment.query \
                     .filter_by(nic=action.nic, channel=action.channel)\
                     .delete()
-            else:
-                db.session.add(model.NetworkAttachment(
-                    nic=action.nic,
-                    network=action.new_network,
-                    channel=action.channel))
-            action.status = 'DONE'
+                if action.new_network is not None:
+                    db.session.add(model.NetworkAttachment(
+                        nic=action.nic,
+                        network=action.new_network,
+                        channel=action.channel))
+                action.status = 'DONE'
         except SwitchError:
-            action.status = 'ERROR'
+            for action in actions:
+                action.status = 'ERROR'
             logger.error('Modify port failed on port %s of switch %s',
-                         action.nic.port.label, action.nic.port.owner.label)
+                         port.label, port.owner.label)
 
     def revert_port(self, action):
         """Apply a revert_port action."""
@@ -78,17 +249,280 @@ class DaemonSession(object):
         return the cached session.
         """
         if switch.label not in self.switch_sessions:
-            self.switch_sessions[switch.label] = switch.session()
+            if self.pool is None:
+                self.switch_sessions[switch.label] = switch.session()
+            else:
+                self.switch_sessions[switch.label] = self.pool.get(switch)
         return self.switch_sessions[switch.label]
 
     def close(self):
-        """Shut down all of the open switch sessions."""
-        for session in self.switch_sessions.values():
-            session.disconnect()
+        """Shut down all of the open switch sessions.
+
+        If we have a pool, the sessions are returned to it instead.
+        """
+        for label, session in self.switch_sessions.items():
+            if self.pool is None:
+                session.disconnect()
+            else:
+                self.pool.put(label, session)
         self.switch_sessions = {}
 
 
-def apply_networking():
+def _supports_skip_locked(dialect):
+    """Return whether the database behind `dialect` supports ``SKIP LOCKED``.
+
+    Of the databases HIL supports, only PostgreSQL 9.5 and later do.
+    """
+    return dialect.name == 'postgresql' and \
+        (dialect.server_version_info or ()) >= (9, 5)
+
+
+def _claim_pending_actions(daemon_id, lease_time,
+                           batch_size=DEFAULT_BATCH_SIZE):
+    """Claim up to ``batch_size`` pending networking actions for ``daemon_id``.
+
+    An action can be claimed if it is pending and either has never been
+    claimed, or its previous claim has expired (e.g. because the daemon
+    holding it crashed). Claimed actions are leased to ``daemon_id`` for
+    ``lease_time`` seconds.
+
+    On PostgreSQL 9.5 and later, rows which are locked by another daemon in
+    the middle of claiming them are skipped, rather than waited on (``SKIP
+    LOCKED``); older servers don't support that, so there (as on SQLite) the
+    candidates are read without locking them. On all databases, the update
+    re-checks that the action is still claimable, so two daemons can never
+    both claim the same action.
+
+    Returns the list of ids of the claimed actions, in the order in which
+    they were queued.
+    """
+    now = datetime.utcnow()
+    claimable = and_(
+        model.NetworkingAction.status == 'PENDING',
+        or_(model.NetworkingAction.claimed_by.is_(None),
+            model.NetworkingAction.lease_expiry < now))
+
+    query = db.session.query(model.NetworkingAction.id) \
+        .filter(claimable) \
+        .order_by(model.NetworkingAction.id) \
+        .limit(batch_size)
+    if _supports_skip_locked(db.session.get_bind().dialect):
+        query = query.with_for_update(skip_locked=True)
+    candidates = [action_id for (action_id,) in query]
+    if not candidates:
+        return []
+
+    model.NetworkingAction.query \
+        .filter(model.NetworkingAction.id.in_(candidates), claimable) \
+        .update({
+            model.NetworkingAction.claimed_by: daemon_id,
+            model.NetworkingAction.lease_expiry:
+                now + timedelta(seconds=lease_time),
+        }, synchronize_session=False)
+    db.session.commit()
+
+    return [action_id for (action_id,) in
+            db.session.query(model.NetworkingAction.id)
+            .filter(model.NetworkingAction.id.in_(candidates),
+                    model.NetworkingAction.claimed_by == daemon_id)
+            .order_by(model.NetworkingAction.id)]
+
+
+def _renew_lease(action_ids, daemon_id, lease_time):
+    """Extend our lease on those of ``action_ids`` which we still hold.
+
+    Returns the set of ids of those actions.
+    """
+    still_held = and_(model.NetworkingAction.id.in_(action_ids),
+                      model.NetworkingAction.status == 'PENDING',
+                      model.NetworkingAction.claimed_by == daemon_id)
+    model.NetworkingAction.query.filter(still_held).update({
+        model.NetworkingAction.lease_expiry:
+            datetime.utcnow() + timedelta(seconds=lease_time),
+    }, synchronize_session=False)
+    db.session.commit()
+    return {action_id for (action_id,) in
+            db.session.query(model.NetworkingAction.id).filter(still_held)}
+
+
+def _load_actions(action_ids):
+    """Load the networking actions with the given ids, in order.
+
+    Everything ``DaemonSession`` needs to apply the actions (the nic, its
+    port and switch, and the new network) is loaded up front, in a single
+    query, rather than lazily one action at a time.
+    """
+    return model.NetworkingAction.query \
+        .options(joinedload(model.NetworkingAction.nic)
+                 .joinedload(model.Nic.port)
+                 .joinedload(model.Port.owner),
+                 joinedload(model.NetworkingAction.new_network)) \
+        .filter(model.NetworkingAction.id.in_(action_ids)) \
+        .order_by(model.NetworkingAction.id).all()
+
+
+def _coalesce(actions):
+    """Skip the actions in ``actions`` whose effects are superseded.
+
+    ``actions`` is a list of networking actions, in the order in which they
+    were queued. An action is superseded if a later action in the list
+    resets the same nic (``revert_port``), or sets the same channel on it
+    (``modify_port``). If the final ``modify_port`` on a channel would just
+    restore the attachment the channel had before the whole sequence, it is
+    skipped as well, since the switch is already in that state.
+
+    Skipped actions are marked DONE without touching the switch. Returns
+    the list of actions which still need to be applied, in order.
+    """
+    skipped = set()
+    reverted = set()  # ids of nics reset by a later revert_port.
+    final = {}  # (nic_id, channel) -> the last modify_port on the channel.
+    for action in reversed(actions):
+        key = (action.nic_id, action.channel)
+        if action.type not in ('modify_port', 'revert_port'):
+            continue
+        elif action.nic_id in reverted:
+            skipped.add(action.id)
+        elif action.type == 'revert_port':
+            reverted.add(action.nic_id)
+        elif key in final:
+            skipped.add(action.id)
+        else:
+            final[key] = action
+
+    if not skipped:
+        return actions
+
+    # For channels with superseded actions, check whether the net change is
+    # nothing at all. The attachments haven't been touched yet, so they
+    # still reflect the state before the first action.
+    superseded = set((action.nic_id, action.channel) for action in actions
+                     if action.id in skipped)
+    coalesced = [action for key, action in final.iteritems()
+                 if key in superseded and action.nic_id not in reverted]
+    if coalesced:
+        attachments = model.NetworkAttachment.query.filter(
+            model.NetworkAttachment.nic_id.in_(
+                set(action.nic_id for action in coalesced))).all()
+        attached = dict(((a.nic_id, a.channel), a.network_id)
+                        for a in attachments)
+        for action in coalesced:
+            key = (action.nic_id, action.channel)
+            if attached.get(key) == action.new_network_id:
+                skipped.add(action.id)
+
+    for action in actions:
+        if action.id in skipped:
+            logger.info('Networking action %s coalesced with later actions '
+                        'on nic %s', action.uuid, action.nic.label)
+            action.status = 'DONE'
+    db.session.commit()
+    return [action for action in actions if action.id not in skipped]
+
+
+def _batch_by_port(actions):
+    """Split ``actions`` into batches which can be applied together.
+
+    ``actions`` is a list of networking actions on the same switch, in the
+    order in which they were queued. Consecutive modify_port actions on the
+    same port (ignoring actions on other ports in between) are put in one
+    batch; every other action is in a batch of its own. The order of the
+    actions on each port is preserved.
+
+    Returns a list of batches, each a list of actions.
+    """
+    batches = []
+    # Port id -> the batch modify_port actions on that port are added to.
+    open_batches = {}
+    for action in actions:
+        port = action.nic.port
+        if port is None or action.type != 'modify_port':
+            batches.append([action])
+            if port is not None:
+                open_batches.pop(port.id, None)
+            continue
+        if port.id not in open_batches:
+            open_batches[port.id] = []
+            batches.append(open_batches[port.id])
+        open_batches[port.id].append(action)
+    return batches
+
+
+def _group_by_switch(action_ids):
+    """Group the networking actions with the given ids by switch.
+
+    The return value is an ``OrderedDict`` mapping the id of a switch to a
+    list of action ids, in the order in which they were queued. Actions on
+    nics which are not attached to a port are grouped under the key
+    ``None``.
+    """
+    rows = db.session.query(model.NetworkingAction.id, model.Port.owner_id)\
+        .join(model.Nic, model.NetworkingAction.nic_id == model.Nic.id)\
+        .outerjoin(model.Port, model.Nic.port_id == model.Port.id)\
+        .filter(model.NetworkingAction.id.in_(action_ids))\
+        .order_by(model.NetworkingAction.id).all()
+
+    groups = OrderedDict()
+    for action_id, switch_id in rows:
+        groups.setdefault(switch_id, []).append(action_id)
+    return groups
+
+
+def _apply_actions(action_ids, daemon_id, lease_time, pool=None):
+    """Apply the networking actions with the given ids, in order.
+
+    All of the actions must be on the same switch, and claimed by
+    ``daemon_id``. Changes to the same port are sent to the switch together
+    (see ``_batch_by_port``), and committed as soon as they are applied,
+    so a failure part of the way through does not require the prior actions
+    to be re-run. Our lease on the remaining actions is renewed as we go,
+    so it only runs out if we stop making progress. Actions superseded by
+    later ones are skipped; see ``_coalesce``. Switch sessions come from
+    ``pool``, if given.
+    """
+    session = DaemonSession(pool)
+    # The actions and related objects are all loaded up front; keep them
+    # around across the per-action commits, rather than re-loading each of
+    # them from the database again on first use.
+    db_session = db.session()
+    expire_on_commit = db_session.expire_on_commit
+    db_session.expire_on_commit = False
+    try:
+        batches = _batch_by_port(_coalesce(_load_actions(action_ids)))
+        held = set(action_ids)
+        renew_at = time.time() + lease_time / 2.0
+        for i, batch in enumerate(batches):
+            if time.time() >= renew_at:
+                held = _renew_lease([a.id for b in batches[i:] for a in b],
+                                    daemon_id, lease_time)
+                renew_at = time.time() + lease_time / 2.0
+            # If our lease ran out, another daemon may have taken over.
+            batch = [action for action in batch if action.id in held]
+            if batch:
+                session.handle_actions(batch)
+                db.session.commit()
+    finally:
+        db_session.expire_on_commit = expire_on_commit
+        session.close()
+
+
+def _apply_actions_in_worker(args):
+    """Like ``_apply_actions``, but for use from a worker thread.
+
+    ``args`` is the tuple of arguments to ``_apply_actions``.
+
+    Each thread gets its own database session; this makes sure it is
+    released once the thread is done with it.
+    """
+    try:
+        _apply_actions(*args)
+    finally:
+        db.session.remove()
+
+
+def apply_networking(workers=1, lease_time=DEFAULT_LEASE_TIME,
+                     daemon_id=None, batch_size=DEFAULT_BATCH_SIZE,
+                     pool=None):
     """Do each networking action in the journal, then cross them off.
 
     Returns False if the journal was empty, and True if there were journal
@@ -104,28 +538,55 @@ def apply_networking():
     returns immediately, the server should sleep, because there was no time for
     new entries to be added.  This keeps the networking server from
     tight-looping.
-    """
 
-    action = model.NetworkingAction.query \
-        .order_by(model.NetworkingAction.id) \
-        .filter_by(status='PENDING').first()
+    ``workers`` is the maximum number of switches to talk to at once. Actions
+    are handed out to the workers by switch, so that actions on the same
+    switch (and therefore the same port) are still applied in the order they
+    were queued, while a slow switch does not hold up the others.
 
-    if action is None:
-        db.session.commit()
-        return False
+    Several daemons may drain the same journal: each one first claims the
+    actions it is going to apply, identifying itself by ``daemon_id``
+    (which defaults to a value unique to this process). Claims are leases of
+    ``lease_time`` seconds, so actions claimed by a daemon which dies are
+    picked up by another one once the lease expires. For this to work,
+    the daemons' clocks must be kept in sync.
 
-    session = DaemonSession()
-    while action is not None:
-        session.handle_action(action)
+    At most ``batch_size`` actions are claimed per call; the actions in a
+    batch are loaded from the database together, rather than one at a
+    time.
+
+    If ``pool`` is given, it must be a ``SessionPool``; switch sessions are
+    taken from it and returned to it, rather than opened and closed by each
+    call.
+    """
+    if daemon_id is None:
+        daemon_id = DAEMON_ID
+
+    claimed = _claim_pending_actions(daemon_id, lease_time, batch_size)
+    if not claimed:
+        # End the transaction opened by the query.
         db.session.commit()
-        # Get the next action
-        action = model.NetworkingAction.query \
-            .order_by(model.NetworkingAction.id)\
-            .filter_by(status='PENDING').first()
+        return False
 
-    # the last statement in the while loop opens a new db session that we must
-    # close when we exit the loop.
+    groups = _group_by_switch(claimed)
+    # End the transaction opened by the query above, so we don't hold it
+    # open while talking to the switches.
     db.session.commit()
 
-    session.close()
+    args = [(action_ids, daemon_id, lease_time, pool)
+            for action_ids in groups.values()]
+    if workers <= 1 or len(groups) == 1:
+        for arg in args:
+            _apply_actions(*arg)
+    else:
+        threads = ThreadPool(min(workers, len(groups)))
+        try:
+            threads.map(_apply_actions_in_worker, args)
+        finally:
+            threads.close()
+            threads.join()
+
+    # the last query in the loop opens a new db session that we must
+    # close when we are done.
+    db.session.commit()
     return True
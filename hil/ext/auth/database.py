@@ -5,15 +5,21 @@ Includes API calls for managing users.
 from hil import api, model, auth, errors
 from hil.model import db
 from hil.auth import get_auth_backend
-from hil.rest import rest_call, local, ContextLogger
+from hil.rest import rest_call, local, ContextLogger, json_object
+from hil.config import cfg
 from passlib.hash import sha512_crypt
 from schema import Schema, Optional
+from collections import OrderedDict
 import flask
+import hashlib
+import hmac
 import logging
+import os
+import threading
+import time
 from os.path import join, dirname
 from hil.migrations import paths
 from hil.model import BigIntegerType
-import json
 
 logger = ContextLogger(logging.getLogger(__name__), {})
 
@@ -46,14 +52,118 @@ class User(db.Model):
         self.set_password(password)
 
     def verify_password(self, password):
-        """Return whether `password` is the user's (plaintext) password."""
-        return sha512_crypt.verify(password, self.hashed_password)
+        """Return whether `password` is the user's (plaintext) password.
+
+        Successful checks are remembered for a while; see
+        `_CredentialCache`.
+        """
+        if _verified.check(self.label, self.hashed_password, password):
+            return True
+        if sha512_crypt.verify(password, self.hashed_password):
+            _verified.put(self.label, self.hashed_password, password)
+            return True
+        return False
 
     def set_password(self, password):
-        """Set the user's password to `password` (which must be plaintext)."""
+        """Set the user's password to `password` (which must be plaintext).
+
+        Any tokens issued to the user are revoked.
+        """
+        _verified.discard(self.label)
+        auth.revoke_tokens(user=self.label)
         self.hashed_password = sha512_crypt.encrypt(password)
 
 
+class _CredentialCache(object):
+    """A cache of recently verified passwords, keyed on username.
+
+    Checking a password against its hash is deliberately slow, and would
+    otherwise be done on every request. Instead, once a user's password has
+    been verified, a keyed digest of it is remembered (never the password
+    itself), along with the hash it was checked against. Until the entry
+    expires, the same password is accepted without checking the hash again,
+    as long as the user's hash hasn't changed -- so changing the password
+    invalidates the entry even if it was done by another server process.
+    Entries are also dropped when a user is deleted or their password set.
+
+    Only the password check is cached; whether a user is an admin, and
+    which projects they belong to, is still read from the database.
+
+    The cache holds at most ``[hil.ext.auth.database] credential_cache_size``
+    entries (default 1024), the least recently used being dropped first,
+    each for at most ``credential_cache_ttl`` seconds (default 60). Setting
+    either to 0 disables it.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._key = os.urandom(32)
+        self._size = None
+        self._ttl = None
+
+    def _settings(self):
+        """Return the configured (size, ttl), reading them if need be."""
+        if self._size is None:
+            self._size, self._ttl = 1024, 60
+            if cfg.has_option(__name__, 'credential_cache_size'):
+                self._size = cfg.getint(__name__, 'credential_cache_size')
+            if cfg.has_option(__name__, 'credential_cache_ttl'):
+                self._ttl = cfg.getint(__name__, 'credential_cache_ttl')
+        return self._size, self._ttl
+
+    def _digest(self, password):
+        """Return a keyed digest of `password`."""
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(self._key, password, hashlib.sha256).digest()
+
+    def check(self, label, hashed_password, password):
+        """Return whether `password` was recently verified for `label`.
+
+        `hashed_password` must be the user's current hash.
+        """
+        size, ttl = self._settings()
+        if size <= 0 or ttl <= 0:
+            return False
+        with self._lock:
+            entry = self._entries.pop(label, None)
+            if entry is None:
+                return False
+            cached_hash, digest, expires = entry
+            if expires <= self._clock() or cached_hash != hashed_password:
+                return False
+            self._entries[label] = entry
+        return hmac.compare_digest(digest, self._digest(password))
+
+    def put(self, label, hashed_password, password):
+        """Remember that `password` matches `label`'s `hashed_password`."""
+        size, ttl = self._settings()
+        if size <= 0 or ttl <= 0:
+            return
+        entry = (hashed_password, self._digest(password), self._clock() + ttl)
+        with self._lock:
+            self._entries.pop(label, None)
+            self._entries[label] = entry
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def discard(self, label):
+        """Forget about `label`'s password."""
+        with self._lock:
+            self._entries.pop(label, None)
+
+    def clear(self):
+        """Forget everything, and re-read the configuration on next use."""
+        with self._lock:
+            self._entries.clear()
+            self._size = self._ttl = None
+
+
+_verified = _CredentialCache()
+
+
 # A joining table for users and projects, which have a many to many
 # relationship:
 user_projects = db.Table('user_projects',
@@ -61,17 +171,19 @@ user_projects = db.Table('user_projects',
                          db.Column('project_id', db.ForeignKey('project.id')))
 
 
-@rest_call('GET', '/auth/basic/users', schema=Schema({}))
-def list_users():
-    """List all users with database authentication"""
+@rest_call('GET', '/auth/basic/users', schema=Schema(api.PAGINATION_ARGS))
+def list_users(limit=None, after=None):
+    """List all users with database authentication
+
+    `limit` and `after` page through the list; see `hil.api.paginate`.
+    """
     get_auth_backend().require_admin()
-    users = User.query.all()
-    result = {}
-    for u in users:
-        user = {'is_admin': u.is_admin,
-                'projects': sorted(p.label for p in u.projects)}
-        result[u.label] = user
-    return json.dumps(result, sort_keys=True)
+    query = User.query.options(db.subqueryload(User.projects))
+    users = api.paginate(query, User.label, limit, after)
+    return json_object((u.label, {'is_admin': u.is_admin,
+                                  'projects': sorted(p.label
+                                                     for p in u.projects)})
+                       for u in users)
 
 
 @rest_call('PUT', '/auth/basic/user/<user>', schema=Schema({
@@ -107,6 +219,8 @@ def user_delete(user):
     # hil.api:
     user = api.get_or_404(User, user)
 
+    _verified.discard(user.label)
+    auth.revoke_tokens(user=user.label)
     db.session.delete(user)
     db.session.commit()
 
@@ -146,6 +260,7 @@ def user_remove_project(user, project):
         raise errors.NotFoundError(
             "User %s is not in project %s" % (user.label, project.label))
     user.projects.remove(project)
+    auth.revoke_tokens(user=user.label)
     db.session.commit()
 
 
@@ -157,9 +272,10 @@ def user_set_admin(user, is_admin):
     """Set whether the user is an admin."""
     get_auth_backend().require_admin()
     user = api.get_or_404(User, user)
-    if user.label == local.auth.label:
+    if user.label == auth.get_user():
         raise errors.IllegalStateError("Cannot set own admin status")
     user.is_admin = is_admin
+    auth.revoke_tokens(user=user.label)
     db.session.commit()
 
 
@@ -168,6 +284,8 @@ class DatabaseAuthBackend(auth.AuthBackend):
     Auth backend using basic auth, with usernames & passwords stored in the DB.
     """
 
+    etag_tables = ('user', 'user_projects')
+
     def authenticate(self):
         # pylint: disable=missing-docstring
         local.auth = None
@@ -186,13 +304,28 @@ class DatabaseAuthBackend(auth.AuthBackend):
             logger.info("Failed authentication for user %r", user.label)
             return False
 
+    def get_user(self):
+        # pylint: disable=missing-docstring
+        user = local.auth
+        return None if user is None else user.label
+
     def _have_admin(self):
         user = local.auth
         return user is not None and user.is_admin
 
     def _have_project_access(self, project):
         user = local.auth
-        return user is not None and project in user.projects
+        if user is None:
+            return False
+        # Fetch the ids of all of the user's projects at once, so checking
+        # many projects in one request doesn't go to the database each time:
+        memo = auth.request_memo()
+        if 'project_ids' not in memo:
+            memo['project_ids'] = set(
+                project_id for (project_id,) in
+                db.session.query(user_projects.c.project_id)
+                .filter(user_projects.c.user_id == user.id))
+        return project.id in memo['project_ids']
 
 
 def setup(*args, **kwargs):
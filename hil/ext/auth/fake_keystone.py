@@ -0,0 +1,222 @@
+"""A stand-in for a keystone server, for testing and benchmarking.
+
+`FakeKeystone` is a wsgi app implementing just enough of keystone's
+identity v3 API for keystonemiddleware (and keystoneauth1's password
+plugin) to work against it: version discovery, password authentication
+scoped to a project, and token validation. It keeps everything in memory,
+and can be told to respond slowly, so the effect of keystone's latency on
+HIL -- and of caching tokens, see `hil.ext.auth.keystone_cache` -- can be
+measured without a real keystone.
+
+This is not an extension; don't load it as one.
+"""
+from datetime import datetime, timedelta
+from werkzeug.wrappers import Request, Response
+import json
+import threading
+import time
+import uuid
+
+_DOMAIN = {'id': 'default', 'name': 'Default'}
+
+
+def _timestamp(when):
+    """Format the datetime `when` the way keystone does."""
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeKeystone(object):
+    """A fake keystone server.
+
+    Users and projects are added with `add_user` and `add_project`. Tokens
+    are valid for `token_lifetime` seconds, and validating one takes at least
+    `latency` seconds. `validations` counts the tokens validated so far.
+    """
+
+    def __init__(self, latency=0, token_lifetime=3600):
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.validations = 0
+        self._lock = threading.Lock()
+        self._projects = {}
+        self._users = {}
+        self._tokens = {}
+
+    def add_project(self, name):
+        """Add a project called `name`, and return its id."""
+        project_id = uuid.uuid4().hex
+        self._projects[name] = project_id
+        return project_id
+
+    def add_user(self, name, password, project, roles=()):
+        """Add a user, with the named `roles` on the named `project`."""
+        self._users[name] = {
+            'id': uuid.uuid4().hex,
+            'password': password,
+            'project': project,
+            'roles': list(roles),
+        }
+
+    def issue_token(self, username, password):
+        """Return a new token for the user, or None if the password is wrong.
+
+        The token is scoped to the user's project.
+        """
+        user = self._users.get(username)
+        if user is None or user['password'] != password:
+            return None
+        now = datetime.utcnow()
+        project = user['project']
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = {
+                'methods': ['password'],
+                'issued_at': _timestamp(now),
+                'expires_at': _timestamp(
+                    now + timedelta(seconds=self.token_lifetime)),
+                'audit_ids': [uuid.uuid4().hex[:22]],
+                'user': {
+                    'id': user['id'],
+                    'name': username,
+                    'domain': _DOMAIN,
+                    'password_expires_at': None,
+                },
+                'project': {
+                    'id': self._projects[project],
+                    'name': project,
+                    'domain': _DOMAIN,
+                },
+                'roles': [{'id': role, 'name': role}
+                          for role in user['roles']],
+            }
+        return token
+
+    def revoke_token(self, token):
+        """Revoke `token`."""
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def validate_token(self, token):
+        """Return the data of `token`, or None if it isn't valid.
+
+        This is what requests to validate a token do, so it is slow (if
+        `latency` is set), and counted in `validations`.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.validations += 1
+        return self._token_data(token)
+
+    def _token_data(self, token):
+        """Return the data of `token`, or None if it isn't valid."""
+        with self._lock:
+            data = self._tokens.get(token)
+        if data is None:
+            return None
+        expires = datetime.strptime(data['expires_at'],
+                                    '%Y-%m-%dT%H:%M:%S.%fZ')
+        if expires <= datetime.utcnow():
+            return None
+        return data
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        path = request.path.rstrip('/')
+        if path == '':
+            response = self._versions(request)
+        elif path == '/v3':
+            response = _json_response({'version': self._v3(request)})
+        elif path == '/v3/auth/tokens':
+            if request.method == 'POST':
+                response = self._authenticate(request)
+            elif request.method in ('GET', 'HEAD'):
+                response = self._validate(request)
+            else:
+                response = _error(405, 'Method Not Allowed')
+        else:
+            response = _error(404, 'Not Found')
+        return response(environ, start_response)
+
+    def _v3(self, request):
+        """Return the description of the v3 API, for version discovery."""
+        return {
+            'id': 'v3.8',
+            'status': 'stable',
+            'updated': '2017-02-22T00:00:00Z',
+            'links': [{'rel': 'self', 'href': request.host_url + 'v3/'}],
+            'media-types': [{
+                'base': 'application/json',
+                'type': 'application/vnd.openstack.identity-v3+json',
+            }],
+        }
+
+    def _versions(self, request):
+        """Respond to a request for the available API versions."""
+        response = _json_response({'versions': {
+            'values': [self._v3(request)],
+        }})
+        response.status_code = 300
+        return response
+
+    def _catalog(self, request):
+        """Return the service catalog, which lists just ourselves."""
+        return [{
+            'id': 'identity',
+            'type': 'identity',
+            'name': 'keystone',
+            'endpoints': [{
+                'id': interface,
+                'interface': interface,
+                'region': 'RegionOne',
+                'region_id': 'RegionOne',
+                'url': request.host_url + 'v3',
+            } for interface in ('public', 'internal', 'admin')],
+        }]
+
+    def _authenticate(self, request):
+        """Respond to a request for a new token."""
+        try:
+            auth = json.loads(request.get_data())['auth']
+            user = auth['identity']['password']['user']
+            token = self.issue_token(user['name'], user['password'])
+        except (ValueError, KeyError, TypeError):
+            return _error(400, 'Bad Request')
+        if token is None:
+            return _error(401, 'Unauthorized')
+        data = dict(self._token_data(token), catalog=self._catalog(request))
+        response = _json_response({'token': data})
+        response.status_code = 201
+        response.headers['X-Subject-Token'] = token
+        return response
+
+    def _validate(self, request):
+        """Respond to a request to validate a token."""
+        # The caller must have a valid token of their own:
+        if self._token_data(request.headers.get('X-Auth-Token')) is None:
+            return _error(401, 'Unauthorized')
+        token = request.headers.get('X-Subject-Token')
+        data = self.validate_token(token)
+        if data is None:
+            return _error(404, 'Not Found')
+        if 'nocatalog' not in request.args:
+            data = dict(data, catalog=self._catalog(request))
+        response = _json_response({'token': data})
+        response.headers['X-Subject-Token'] = token
+        return response
+
+
+def _json_response(body):
+    """Return a response with the JSON encoding of `body`."""
+    return Response(json.dumps(body), content_type='application/json')
+
+
+def _error(code, title):
+    """Return an error response, as keystone would."""
+    response = _json_response({'error': {
+        'code': code,
+        'title': title,
+        'message': title,
+    }})
+    response.status_code = code
+    return response
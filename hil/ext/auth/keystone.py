@@ -8,6 +8,8 @@ from hil.flaskapp import app
 from hil.config import cfg
 from hil.model import Project
 from hil import auth, rest
+from hil.ext.auth.keystone_cache import CachingAuthMiddleware, TokenCache, \
+    MemcachedTokenCache
 import logging
 import sys
 
@@ -46,6 +48,10 @@ class KeystoneAuthBackend(auth.AuthBackend):
 
         return True
 
+    def get_user(self):
+        # pylint: disable=missing-docstring
+        return request.environ.get('HTTP_X_USER_NAME')
+
     def _have_project_access(self, project):
         return project.label == request.environ['HTTP_X_PROJECT_ID']
 
@@ -53,6 +59,51 @@ class KeystoneAuthBackend(auth.AuthBackend):
         return 'admin' in request.environ['HTTP_X_ROLES'].split(',')
 
 
+# Options in our section which are for us, rather than keystonemiddleware:
+_CACHE_OPTIONS = (
+    'hil_token_cache_size',
+    'hil_token_cache_ttl',
+    'hil_memcached_servers',
+    'hil_memcache_secret_key',
+)
+
+
+def _token_cache():
+    """Return the cache of validated tokens to use, or None to not cache.
+
+    See `hil.ext.auth.keystone_cache`. By default, up to 1024 tokens are
+    cached in-process, for up to 60 seconds each; the options
+    ``hil_token_cache_size`` and ``hil_token_cache_ttl`` change this, and
+    setting either to 0 disables the cache. If ``hil_memcached_servers`` (a
+    comma-separated list of ``host:port``) is set, the tokens are cached in
+    memcached instead, which requires python-memcached, and
+    ``hil_memcache_secret_key`` to sign the entries with.
+    """
+    size, ttl = 1024, 60
+    if cfg.has_option(__name__, 'hil_token_cache_size'):
+        size = cfg.getint(__name__, 'hil_token_cache_size')
+    if cfg.has_option(__name__, 'hil_token_cache_ttl'):
+        ttl = cfg.getint(__name__, 'hil_token_cache_ttl')
+    if size <= 0 or ttl <= 0:
+        return None
+    if not cfg.has_option(__name__, 'hil_memcached_servers'):
+        return TokenCache(size, ttl)
+    try:
+        import memcache
+    except ImportError:
+        logger.error('hil_memcached_servers is set, but python-memcached '
+                     'is not installed.')
+        sys.exit(1)
+    if not cfg.has_option(__name__, 'hil_memcache_secret_key'):
+        logger.error('hil_memcached_servers is set, but '
+                     'hil_memcache_secret_key is not.')
+        sys.exit(1)
+    servers = cfg.get(__name__, 'hil_memcached_servers').split(',')
+    return MemcachedTokenCache(
+        memcache.Client([server.strip() for server in servers]), ttl,
+        cfg.get(__name__, 'hil_memcache_secret_key'))
+
+
 def setup(*args, **kwargs):
     """Set a KeystoneAuthBackend as the auth backend.
 
@@ -65,10 +116,15 @@ def setup(*args, **kwargs):
         sys.exit(1)
     keystone_cfg = {}
     for key in cfg.options(__name__):
-        keystone_cfg[key] = cfg.get(__name__, key)
+        if key not in _CACHE_OPTIONS:
+            keystone_cfg[key] = cfg.get(__name__, key)
 
     # Great job with the API design Openstack! </sarcasm>
     factory = filter_factory(keystone_cfg)
-    app.wsgi_app = factory(app.wsgi_app)
+    cache = _token_cache()
+    if cache is None:
+        app.wsgi_app = factory(app.wsgi_app)
+    else:
+        app.wsgi_app = CachingAuthMiddleware(app.wsgi_app, factory, cache)
 
     auth.set_auth_backend(KeystoneAuthBackend())
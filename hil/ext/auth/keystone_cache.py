@@ -0,0 +1,206 @@
+"""Caching of validated keystone tokens.
+
+keystonemiddleware validates each request's token with keystone before
+passing the request on to HIL, which can make every API call as slow as
+keystone is. `CachingAuthMiddleware` sits in front of it: once a token has
+been validated, the identity keystonemiddleware found for it is remembered,
+and later requests with the same token are passed straight to HIL with that
+identity, without going through keystonemiddleware at all.
+
+This module doesn't depend on keystonemiddleware itself, so it can be used
+(and tested) without it.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import calendar
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+# The variables keystonemiddleware sets in the wsgi environment once it has
+# validated a token, which are what `KeystoneAuthBackend` reads. Requests
+# answered from the cache have all of these set from the cache, so a client
+# cannot inject its own values for them.
+IDENTITY_KEYS = (
+    'HTTP_X_IDENTITY_STATUS',
+    'HTTP_X_PROJECT_ID',
+    'HTTP_X_ROLES',
+    'HTTP_X_USER_NAME',
+)
+
+
+class TokenCache(object):
+    """An in-process cache of validated tokens' identities.
+
+    Holds at most `size` entries, the least recently used being dropped
+    first, each for at most `ttl` seconds. Keys and values are strings.
+    """
+
+    def __init__(self, size, ttl, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the value stored under `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key`, for at most `ttl` seconds."""
+        if self.size <= 0:
+            return
+        expires = self._clock() + min(ttl, self.ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class MemcachedTokenCache(object):
+    """A cache of validated tokens' identities, kept in memcached.
+
+    `client` is a memcached client, such as ``memcache.Client`` from
+    python-memcached; anything with compatible ``get`` and ``set`` methods
+    will do. Entries are kept for at most `ttl` seconds, and may be shared
+    by several HIL processes.
+
+    memcached doesn't authenticate its clients, so entries are signed with
+    an HMAC keyed on `secret_key`, which must be shared by all of HIL's
+    processes and nobody else. The memcached keys are also derived from it,
+    so they don't reveal which tokens are cached. Entries which fail
+    verification are ignored; otherwise anyone who could write to memcached
+    could grant any token any identity.
+    """
+
+    # Prefix of our keys, in case the memcached servers are shared:
+    KEY_PREFIX = 'hil-keystone-token-'
+
+    def __init__(self, client, ttl, secret_key):
+        self.client = client
+        self.ttl = ttl
+        self._secret_key = secret_key
+
+    def _mac(self, data):
+        """Return the hex HMAC of `data`, keyed on our secret key."""
+        return hmac.new(self._secret_key, data, hashlib.sha256).hexdigest()
+
+    def _memcached_key(self, key):
+        """Return the memcached key to store the value of `key` under."""
+        return self.KEY_PREFIX + self._mac('key\0' + key)
+
+    def get(self, key):
+        """Return the value stored under `key`, or None.
+
+        Values whose signature doesn't match are treated as absent.
+        """
+        entry = self.client.get(self._memcached_key(key))
+        if entry is None:
+            return None
+        mac, _, value = entry.partition(':')
+        if not hmac.compare_digest(mac, self._mac(key + '\0' + value)):
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key`, for at most `ttl` seconds."""
+        entry = self._mac(key + '\0' + value) + ':' + value
+        self.client.set(self._memcached_key(key), entry,
+                        time=min(ttl, self.ttl))
+
+
+def token_expiry(environ):
+    """Return when the token validated for `environ` expires, or None.
+
+    keystonemiddleware makes the token's data available as
+    ``keystone.token_info``; this reads its ``expires_at`` (identity v3) or
+    ``access.token.expires`` (v2). The result is a unix timestamp.
+    """
+    info = environ.get('keystone.token_info') or {}
+    expires = info.get('token', {}).get('expires_at') or \
+        info.get('access', {}).get('token', {}).get('expires')
+    if not expires:
+        return None
+    expires = expires.rstrip('Z')
+    for fmt in '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S':
+        try:
+            parsed = datetime.strptime(expires, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed.utctimetuple())
+    return None
+
+
+class CachingAuthMiddleware(object):
+    """WSGI middleware which caches the identities of validated tokens.
+
+    `app` is the wsgi app to protect, and `auth_filter` a function which
+    wraps a wsgi app in (uncached) token validation, as returned by
+    keystonemiddleware's ``filter_factory``. `cache` is a `TokenCache`,
+    `MemcachedTokenCache`, or anything else with the same ``get`` and ``set``
+    methods.
+
+    Only tokens which were validated successfully are cached, and never for
+    longer than they are valid; tokens whose expiry can't be determined (see
+    `token_expiry`) aren't cached at all. A token revoked in keystone may
+    still be accepted until its cache entry expires.
+
+    The ``hits`` and ``misses`` attributes count the requests which carried
+    a token and were, or were not, answered from the cache.
+    """
+
+    def __init__(self, app, auth_filter, cache, clock=time.time):
+        self.app = app
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._auth_app = auth_filter(self._remember)
+
+    def __call__(self, environ, start_response):
+        token = environ.get('HTTP_X_AUTH_TOKEN')
+        if not token:
+            return self._auth_app(environ, start_response)
+        identity = self.cache.get(_cache_key(token))
+        if identity is None:
+            self.misses += 1
+            return self._auth_app(environ, start_response)
+        self.hits += 1
+        environ.update(json.loads(identity))
+        return self.app(environ, start_response)
+
+    def _remember(self, environ, start_response):
+        """Cache the identity validated for the request, and pass it on.
+
+        This is the app wrapped by `auth_filter`.
+        """
+        token = environ.get('HTTP_X_AUTH_TOKEN')
+        expires = token_expiry(environ)
+        if token and expires is not None and \
+                environ.get('HTTP_X_IDENTITY_STATUS') == 'Confirmed':
+            ttl = min(self.cache.ttl, int(expires - self._clock()))
+            if ttl > 0:
+                identity = dict((key, environ.get(key, ''))
+                                for key in IDENTITY_KEYS)
+                self.cache.set(_cache_key(token), json.dumps(identity), ttl)
+        return self.app(environ, start_response)
+
+
+def _cache_key(token):
+    """Return the key to cache `token`'s identity under.
+
+    Tokens are credentials, so we don't keep them around ourselves.
+    """
+    return hashlib.sha256(token).hexdigest()
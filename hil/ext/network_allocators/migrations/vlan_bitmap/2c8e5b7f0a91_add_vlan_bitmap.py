@@ -0,0 +1,32 @@
+"""Add vlan_bitmap allocator
+
+Revision ID: 2c8e5b7f0a91
+Revises:
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8e5b7f0a91'
+down_revision = None
+branch_labels = ('hil.ext.network_allocators.vlan_bitmap',)
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table('vlan_bitmap',
+                    sa.Column('id', sa.BIGINT(), nullable=False),
+                    sa.Column('version', sa.BIGINT(), nullable=False),
+                    sa.Column('pool', sa.String(), nullable=False),
+                    sa.Column('free', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+
+
+def downgrade():
+    op.drop_table('vlan_bitmap')
@@ -0,0 +1,215 @@
+"""VLAN based ``network_allocator`` implementation, using bitmaps.
+
+This is a drop-in replacement for ``vlan_pool``, taking the same ``vlans``
+option. Instead of a row per VLAN, it keeps the whole pool in a single row,
+as two bitmaps: the VLANs in the pool, and those of them which are free.
+Allocating a VLAN reads that row and writes it back with the VLAN's bit
+cleared, if nobody else has written it in the meantime (compare-and-swap on
+a version number); so concurrent allocations can't hand out the same VLAN,
+whatever the database's isolation level.
+"""
+
+import logging
+import sys
+
+from sqlalchemy import select
+
+from hil import model
+from hil.network_allocator import NetworkAllocator, set_network_allocator
+from hil.model import db
+from hil.config import cfg
+from hil.errors import BlockedError
+
+from os.path import join, dirname
+from hil.migrations import paths
+from hil.model import BigIntegerType
+
+paths[__name__] = join(dirname(__file__), 'migrations', 'vlan_bitmap')
+
+logger = logging.getLogger(__name__)
+
+
+def get_vlans():
+    """Return the bitmap of the vlans in the module's config section.
+
+    The option is a comma-separated list of vlans and ranges of vlans, as
+    for ``vlan_pool``. Raises a ValueError if it isn't valid; every vlan
+    must be between 1 and 4096, and ranges must not be reversed.
+    """
+    bitmap = 0
+    for item in cfg.get(__name__, 'vlans').split(','):
+        r = item.strip().split('-')
+        try:
+            if len(r) > 2:
+                raise ValueError
+            first = int(r[0])
+            last = int(r[-1])
+        except ValueError:
+            raise ValueError('%r is not a vlan or range of vlans' %
+                             item.strip())
+        if not 1 <= first <= last <= 4096:
+            raise ValueError('%r is not a range of vlans between 1 and 4096'
+                             % item.strip())
+        bitmap |= ((1 << (last - first + 1)) - 1) << first
+    return bitmap
+
+
+class VlanBitmapAllocator(NetworkAllocator):
+    """A allocator of VLANs. The interface is as specified in
+    ``NetworkAllocator``.
+    """
+
+    def get_new_network_id(self):
+        while True:
+            state = _read_state()
+            if state is None:
+                logger.error('The vlan pool is empty; run `hil-admin db '
+                             'create` to populate it.')
+                return None
+            if state.free == 0:
+                return None
+            # Take the lowest free vlan:
+            vlan = (state.free & -state.free).bit_length() - 1
+            if _write_free(state, state.free & ~(1 << vlan)):
+                return str(vlan)
+
+    def free_network_id(self, net_id):
+        bit = 1 << int(net_id)
+        while True:
+            state = _read_state()
+            if state is None or not state.pool & bit:
+                logger.error('vlan %s is not in the pool', net_id)
+                return
+            if _write_free(state, state.free | bit):
+                return
+
+    def populate(self):
+        vlans = get_vlans()
+        # Any vlans already used by networks aren't free, even if they
+        # weren't in the pool before (e.g. if we are replacing vlan_pool):
+        used = 0
+        for (net_id,) in db.session.query(model.Network.network_id):
+            if self.validate_network_id(net_id):
+                used |= 1 << int(net_id)
+        state = _read_state()
+        if state is None:
+            db.session.execute(VlanBitmap.__table__.insert().values(
+                id=_ROW_ID,
+                version=0,
+                pool=_encode(vlans),
+                free=_encode(vlans & ~used),
+            ))
+            return
+        # Add any vlans new to the pool; the state of the others is left
+        # alone. Vlans cannot be removed from the pool.
+        added = vlans & ~state.pool
+        if added:
+            table = VlanBitmap.__table__
+            db.session.execute(
+                table.update()
+                .where(table.c.id == _ROW_ID)
+                .values(version=table.c.version + 1,
+                        pool=_encode(state.pool | added),
+                        free=_encode(state.free | (added & ~used))))
+
+    def legal_channels_for(self, net_id):
+        return ["vlan/native",
+                "vlan/" + net_id]
+
+    def is_legal_channel_for(self, channel_id, net_id):
+        return channel_id in self.legal_channels_for(net_id)
+
+    def get_default_channel(self):
+        return "vlan/native"
+
+    def validate_network_id(self, net_id):
+        try:
+            return 1 <= int(net_id) <= 4096
+        except ValueError:
+            return False
+
+    def claim_network_id(self, net_id):
+        bit = 1 << int(net_id)
+        while True:
+            state = _read_state()
+            if state is None or not state.pool & bit:
+                return
+            if not state.free & bit:
+                raise BlockedError("Network ID is not available."
+                                   " Please choose a different ID.")
+            if _write_free(state, state.free & ~bit):
+                return
+
+    def is_network_id_in_pool(self, net_id):
+        state = _read_state()
+        return state is not None and bool(state.pool & (1 << int(net_id)))
+
+
+class VlanBitmap(db.Model):
+    """The state of the vlan pool.
+
+    There is only ever one row, with the id `_ROW_ID`. `pool` and `free` are
+    bitmaps (bit n is vlan n) of the vlans in the pool and those of them
+    which are free, as hexadecimal strings. `version` is incremented by
+    every change, so changes can be made with compare-and-swap.
+    """
+    id = db.Column(BigIntegerType, primary_key=True)
+    version = db.Column(BigIntegerType, nullable=False)
+    pool = db.Column(db.String, nullable=False)
+    free = db.Column(db.String, nullable=False)
+
+
+_ROW_ID = 1
+
+
+class _State(object):
+    """The contents of the `VlanBitmap` row, with the bitmaps decoded."""
+
+    def __init__(self, version, pool, free):
+        self.version = version
+        self.pool = int(pool, 16)
+        self.free = int(free, 16)
+
+
+def _encode(bitmap):
+    """Encode `bitmap` for storage in a `VlanBitmap`."""
+    return '%x' % bitmap
+
+
+def _read_state():
+    """Return the current `_State`, or None if `populate` hasn't been run."""
+    table = VlanBitmap.__table__
+    row = db.session.execute(
+        select([table.c.version, table.c.pool, table.c.free])
+        .where(table.c.id == _ROW_ID)).first()
+    if row is None:
+        return None
+    return _State(*row)
+
+
+def _write_free(state, free):
+    """Set the bitmap of free vlans to `free`, if `state` is still current.
+
+    Returns whether it was; if not, nothing is changed, and the caller
+    should read the state again and retry.
+    """
+    table = VlanBitmap.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == _ROW_ID)
+        .where(table.c.version == state.version)
+        .values(version=state.version + 1, free=_encode(free)))
+    return result.rowcount == 1
+
+
+def setup(*args, **kwargs):
+    """Register a VlanBitmapAllocator as the network allocator.
+
+    The ``vlans`` option is checked up front, so mistakes in it are
+    reported on startup, rather than when the pool is populated.
+    """
+    try:
+        get_vlans()
+    except ValueError as e:
+        sys.exit('ERROR: Invalid vlans in [%s]: %s' % (__name__, e))
+    set_network_allocator(VlanBitmapAllocator())
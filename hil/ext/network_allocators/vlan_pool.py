@@ -52,12 +52,18 @@ class VlanAllocator(NetworkAllocator):
         vlan.available = True
 
     def populate(self):
-        vlan_list = get_vlan_list()
-        for vlan in vlan_list:
-            if Vlan.query.filter_by(vlan_no=vlan).count() == 1:
-                # Already created by a previous call; leave it alone.
-                continue
-            db.session.add(Vlan(vlan))
+        # Vlans already created by a previous call are left alone:
+        existing = set(vlan_no for (vlan_no,)
+                       in db.session.query(Vlan.vlan_no))
+        new = []
+        for vlan_no in get_vlan_list():
+            if vlan_no not in existing:
+                existing.add(vlan_no)
+                new.append(vlan_no)
+        if new:
+            db.session.execute(Vlan.__table__.insert(),
+                               [{'vlan_no': vlan_no, 'available': True}
+                                for vlan_no in new])
         db.session.commit()
 
     def legal_channels_for(self, net_id):
@@ -5,10 +5,9 @@ import pexpect
 
 from abc import ABCMeta, abstractmethod
 from hil.model import Port, NetworkAttachment, SwitchSession
-from hil.ext.switches.common import should_save
+from hil.ext.switches.common import should_save, merge_trunk_changes
 import re
 
-_CHANNEL_RE = re.compile(r'vlan/(\d+)')
 logger = logging.getLogger(__name__)
 
 
@@ -65,6 +64,36 @@ class Session(SwitchSession):
     def save_running_config(self):
         """saves the running config to startup config"""
 
+    def release(self):
+        """Save the running config (if configured to), and keep the session
+        open for reuse.
+        """
+        if should_save(self):
+            self.save_running_config()
+        return True
+
+    def reuse(self, switch):
+        """Check that the switch still responds at the prompt."""
+        self.switch = switch
+        try:
+            if not self.console.isalive():
+                return False
+            # Discard any output left over from the last batch of work, so
+            # we only match a prompt sent in response to the probe:
+            try:
+                while True:
+                    self.console.read_nonblocking(size=4096, timeout=0)
+            except pexpect.TIMEOUT:
+                pass
+            self._sendline('')
+            self.console.expect([self.config_prompt, self.main_prompt],
+                                timeout=10)
+        except (pexpect.ExceptionPexpect, OSError):
+            logger.debug('Session with switch %r is no longer usable',
+                         switch)
+            return False
+        return True
+
     def disconnect(self):
         """End the session. Must be at the main prompt. Handles the scenario
         where the switch only exits out of enable mode and doesn't actually
@@ -79,6 +108,14 @@ class Session(SwitchSession):
         logger.debug('Logged out of switch %r', self.switch)
 
     def modify_port(self, port, channel, new_network):
+        self.apply_port_changes(port, [(channel, new_network)])
+
+    def apply_port_changes(self, port, changes):
+        """Apply all of the changes from a single interface prompt.
+
+        Consecutive trunked vlans to add (or remove) are sent to the switch
+        as one command.
+        """
         interface = port
         port = Port.query.filter_by(label=port,
                                     owner_id=self.switch.id).one()
@@ -86,31 +123,32 @@ class Session(SwitchSession):
         self.enter_if_prompt(interface)
         self.console.expect(self.if_prompt)
 
-        if channel == 'vlan/native':
-            old_native = NetworkAttachment.query.filter_by(
-                channel='vlan/native',
-                nic_id=port.nic.id).one_or_none()
-            if old_native is not None:
-                old_native = old_native.network.network_id
-
-            if new_network is not None:
-                self.set_native(old_native, new_network)
-            elif old_native is not None:
-                self.disable_native(old_native)
-        else:
-            match = re.match(_CHANNEL_RE, channel)
-            # TODO: I'd be more okay with this assertion if it weren't possible
-            # to mis-configure HIL in a way that triggers this; currently the
-            # administrator needs to line up the network allocator with the
-            # switches; this is unsatisfactory. --isd
-            assert match is not None, "HIL passed an invalid channel to the" \
-                "switch!"
-            vlan_id = match.groups()[0]
-            if new_network is None:
-                self.disable_vlan(vlan_id)
+        # TODO: merge_trunk_changes asserts that the channels are valid. I'd
+        # be more okay with that if it weren't possible to mis-configure HIL
+        # in a way that triggers this; currently the administrator needs to
+        # line up the network allocator with the switches; this is
+        # unsatisfactory. --isd
+        old_native = None
+        native_known = False
+        for op, arg in merge_trunk_changes(changes):
+            if op == 'native':
+                if not native_known:
+                    old_native = NetworkAttachment.query.filter_by(
+                        channel='vlan/native',
+                        nic_id=port.nic.id).one_or_none()
+                    if old_native is not None:
+                        old_native = old_native.network.network_id
+                    native_known = True
+
+                if arg is not None:
+                    self.set_native(old_native, arg)
+                elif old_native is not None:
+                    self.disable_native(old_native)
+                old_native = arg
+            elif op == 'add':
+                self.enable_vlan(','.join(arg))
             else:
-                assert new_network == vlan_id
-                self.enable_vlan(vlan_id)
+                self.disable_vlan(','.join(arg))
 
         self.exit_if_prompt()
         self.console.expect(self.config_prompt)
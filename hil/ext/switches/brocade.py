@@ -15,7 +15,8 @@ from hil.model import db, Switch, SwitchSession
 from hil.errors import BadArgumentError
 from hil.model import BigIntegerType
 from hil.errors import SwitchError
-from hil.ext.switches.common import check_native_networks, parse_vlans
+from hil.ext.switches.common import check_native_networks, parse_vlans, \
+    merge_trunk_changes, http_session, http_timeout
 
 
 paths[__name__] = join(dirname(__file__), 'migrations', 'brocade')
@@ -68,9 +69,15 @@ class Brocade(Switch, SwitchSession):
         return []
 
     def disconnect(self):
-        pass
+        """Close our connections to the switch, if any."""
+        if getattr(self, '_http', None) is not None:
+            self._http.close()
+            self._http = None
 
     def modify_port(self, port, channel, new_network):
+        self.apply_port_changes(port, [(channel, new_network)])
+
+    def apply_port_changes(self, port, changes):
         # XXX: We ought to be able to do a Port.query ... one() here, but
         # there's somthing I(zenhack)  don't understand going on with when
         # things are committed in the tests for this driver, and we don't
@@ -79,22 +86,18 @@ class Brocade(Switch, SwitchSession):
         (port,) = filter(lambda p: p.label == port, self.ports)
         interface = port.label
 
-        if channel == 'vlan/native':
-            if new_network is None:
-                self._remove_native_vlan(interface)
+        # The switch takes a comma separated list of vlans, so we can add (or
+        # remove) several at once.
+        for op, arg in merge_trunk_changes(changes):
+            if op == 'native':
+                if arg is None:
+                    self._remove_native_vlan(interface)
+                else:
+                    self._set_native_vlan(interface, arg)
+            elif op == 'add':
+                self._add_vlan_to_trunk(interface, ','.join(arg))
             else:
-                self._set_native_vlan(interface, new_network)
-        else:
-            match = re.match(re.compile(r'vlan/(\d+)'), channel)
-            assert match is not None, "HIL passed an invalid channel to the" \
-                " switch!"
-            vlan_id = match.groups()[0]
-
-            if new_network is None:
-                self._remove_vlan_from_trunk(interface, vlan_id)
-            else:
-                assert new_network == vlan_id
-                self._add_vlan_to_trunk(interface, vlan_id)
+                self._remove_vlan_from_trunk(interface, ','.join(arg))
 
     def revert_port(self, port):
         self._remove_all_vlans_from_trunk(port)
@@ -116,13 +119,54 @@ class Brocade(Switch, SwitchSession):
         }
 
         """
+        snapshot = self._get_all_port_networks()
         response = {}
         for port in ports:
-            response[port] = filter(None,
-                                    [self._get_native_vlan(port.label)]) \
-                                    + self._get_vlans(port.label)
+            if port.label in snapshot:
+                response[port] = snapshot[port.label]
+            else:
+                response[port] = filter(None,
+                                        [self._get_native_vlan(port.label)]) \
+                                        + self._get_vlans(port.label)
         return response
 
+    def _get_all_port_networks(self):
+        """ Return the networks on every interface of the switch.
+
+        This reads the configuration of all of the interfaces with a single
+        request, rather than one or more per port.
+
+        Returns: Dictionary mapping interface names to lists of the same
+        form as the values returned by get_port_networks. If the switch
+        doesn't give us the details of an interface, it is left out; if
+        the request fails altogether, the dictionary is empty.
+        """
+        url = '%s/rest/config/running/interface/%s' % (self.hostname,
+                                                       self.interface_type)
+        try:
+            # Without this header, the switch only returns links to the
+            # interfaces, not their configuration.
+            response = self._make_request('GET', url,
+                                          headers={'Resource-Depth': '5'})
+        except SwitchError:
+            return {}
+        root = etree.fromstring(response.text)
+
+        result = {}
+        for interface in root:
+            name = interface.find(self._construct_tag('name'))
+            switchport = interface.find(self._construct_tag('switchport'))
+            if name is None or switchport is None:
+                continue
+            trunk = switchport.find(self._construct_tag('trunk'))
+            if trunk is None:
+                result[name.text] = []
+            else:
+                result[name.text] = \
+                    filter(None, [self._parse_native_vlan(trunk)]) + \
+                    self._parse_vlans(trunk)
+        return result
+
     def _get_mode(self, interface):
         """ Return the mode of an interface.
 
@@ -175,11 +219,20 @@ class Brocade(Switch, SwitchSession):
         Returns: List containing the vlans of the form:
         [('vlan/vlan1', vlan1), ('vlan/vlan2', vlan2)]
         """
+        url = self._construct_url(interface, suffix='trunk')
+        response = self._make_request('GET', url)
+        return self._parse_vlans(etree.fromstring(response.text))
+
+    def _parse_vlans(self, trunk):
+        """ Return the vlans in the trunk configuration of an interface.
+
+        Args:
+            trunk: the interface's trunk element, as returned by the switch
+
+        Returns: List of the same form as _get_vlans
+        """
         try:
-            url = self._construct_url(interface, suffix='trunk')
-            response = self._make_request('GET', url)
-            root = etree.fromstring(response.text)
-            vlans = root. \
+            vlans = trunk. \
                 find(self._construct_tag('allowed')).\
                 find(self._construct_tag('vlan')).\
                 find(self._construct_tag('add')).text
@@ -193,7 +246,7 @@ class Brocade(Switch, SwitchSession):
             vlan_list = parse_vlans(match.group())
 
             return [('vlan/%s' % x, x) for x in vlan_list]
-        except AttributeError:
+        except (AttributeError, TypeError):
             return []
 
     def _get_native_vlan(self, interface):
@@ -202,13 +255,22 @@ class Brocade(Switch, SwitchSession):
         Args:
             interface: interface to return the native vlan of
 
+        Returns: Tuple of the form ('vlan/native', vlan) or None
+        """
+        url = self._construct_url(interface, suffix='trunk')
+        response = self._make_request('GET', url)
+        return self._parse_native_vlan(etree.fromstring(response.text))
+
+    def _parse_native_vlan(self, trunk):
+        """ Return the native vlan in the trunk configuration of an interface.
+
+        Args:
+            trunk: the interface's trunk element, as returned by the switch
+
         Returns: Tuple of the form ('vlan/native', vlan) or None
         """
         try:
-            url = self._construct_url(interface, suffix='trunk')
-            response = self._make_request('GET', url)
-            root = etree.fromstring(response.text)
-            vlan = root.find(self._construct_tag('native-vlan')).text
+            vlan = trunk.find(self._construct_tag('native-vlan')).text
             return ('vlan/native', vlan)
         except AttributeError:
             return None
@@ -220,7 +282,7 @@ class Brocade(Switch, SwitchSession):
 
         Args:
             interface: interface to add the vlan to
-            vlan: vlan to add
+            vlan: vlan to add, or a comma separated list of vlans
         """
         self._enable_and_set_mode(interface, 'trunk')
         url = self._construct_url(interface, suffix='trunk/allowed/vlan')
@@ -232,7 +294,7 @@ class Brocade(Switch, SwitchSession):
 
         Args:
             interface: interface to remove the vlan from
-            vlan: vlan to remove
+            vlan: vlan to remove, or a comma separated list of vlans
         """
         url = self._construct_url(interface, suffix='trunk/allowed/vlan')
         payload = '<vlan><remove>%s</remove></vlan>' % vlan
@@ -246,7 +308,7 @@ class Brocade(Switch, SwitchSession):
         """
         url = self._construct_url(interface, suffix='trunk/allowed/vlan')
         payload = '<vlan><none>true</none></vlan>'
-        requests.put(url, data=payload, auth=self._auth)
+        self._make_request('PUT', url, data=payload)
 
     def _set_native_vlan(self, interface, vlan):
         """ Set the native vlan of an interface.
@@ -311,9 +373,23 @@ class Brocade(Switch, SwitchSession):
         """ Construct the xml tag by prepending the brocade tag prefix. """
         return '{urn:brocade.com:mgmt:brocade-interface}%s' % name
 
+    def _http_session(self):
+        """Return the ``requests.Session`` used to talk to the switch.
+
+        The session (and its connections) are kept until ``disconnect``.
+        """
+        if getattr(self, '_http', None) is None:
+            self._http = http_session(self, self._auth)
+        return self._http
+
     def _make_request(self, method, url, data=None,
-                      acceptable_error_codes=()):
-        r = requests.request(method, url, data=data, auth=self._auth)
+                      acceptable_error_codes=(), headers=None):
+        try:
+            r = self._http_session().request(method, url, data=data,
+                                             headers=headers,
+                                             timeout=http_timeout(self))
+        except requests.exceptions.RequestException as e:
+            raise SwitchError('Request to switch failed: %s' % e)
         if r.status_code >= 400 and \
            r.status_code not in acceptable_error_codes:
             logger.error('Bad Request to switch. '
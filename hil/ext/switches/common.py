@@ -1,4 +1,7 @@
 """Helper methods for switches"""
+import re
+import requests
+
 from hil.config import cfg
 from hil import model
 from hil.model import db
@@ -14,6 +17,53 @@ def should_save(switch_obj):
     return True
 
 
+# Defaults for the options read by ``http_session`` and ``http_timeout``.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_MAX_CONNECTIONS = 4
+
+
+def http_session(switch_obj, auth):
+    """Return a new ``requests.Session`` for the REST API of ``switch_obj``.
+
+    ``auth`` is passed on to requests with each request. Connections are
+    kept alive and reused, and at most ``max_connections`` (from the
+    switch's extension's config section) are open at a time; beyond that,
+    requests wait for a connection to free up.
+
+    The caller should close the session when done with it.
+    """
+    switch_ext = switch_obj.__class__.__module__
+    max_connections = DEFAULT_MAX_CONNECTIONS
+    if cfg.has_option(switch_ext, 'max_connections'):
+        max_connections = cfg.getint(switch_ext, 'max_connections')
+
+    session = requests.Session()
+    session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_connections,
+                                            pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def http_timeout(switch_obj):
+    """Return the (connect, read) timeouts for requests to ``switch_obj``.
+
+    These are the ``connect_timeout`` and ``read_timeout`` options in the
+    switch's extension's config section, in seconds.
+    """
+    switch_ext = switch_obj.__class__.__module__
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    read_timeout = DEFAULT_READ_TIMEOUT
+    if cfg.has_option(switch_ext, 'connect_timeout'):
+        connect_timeout = cfg.getfloat(switch_ext, 'connect_timeout')
+    if cfg.has_option(switch_ext, 'read_timeout'):
+        read_timeout = cfg.getfloat(switch_ext, 'read_timeout')
+    return (connect_timeout, read_timeout)
+
+
 def check_native_networks(nic, op_type, channel):
     """Check to ensure that native network is the first one to be added
     and last one to be removed
@@ -53,3 +103,38 @@ def parse_vlans(raw_vlans):
             vlan_list.append(num_str)
 
     return vlan_list
+
+
+def merge_trunk_changes(changes):
+    """Merge consecutive changes to the trunked vlans of a port.
+
+    ``changes`` is a list of (channel, new_network) pairs, as passed to
+    ``SwitchSession.apply_port_changes``. Returns a list of (op, arg) pairs,
+    in the same order, where op is one of:
+
+    * 'native' -- arg is the new native vlan, or None to remove it.
+    * 'add' -- arg is a list of vlans to add to the trunk.
+    * 'remove' -- arg is a list of vlans to remove from the trunk.
+
+    Consecutive additions (or removals) are merged into one, so that drivers
+    can apply them with a single command.
+    """
+    result = []
+    for channel, new_network in changes:
+        if channel == 'vlan/native':
+            result.append(('native', new_network))
+            continue
+        match = re.match(r'vlan/(\d+)', channel)
+        assert match is not None, "HIL passed an invalid channel to the" \
+            " switch!"
+        vlan_id = match.group(1)
+        if new_network is None:
+            op = 'remove'
+        else:
+            assert new_network == vlan_id
+            op = 'add'
+        if result and result[-1][0] == op:
+            result[-1][1].append(vlan_id)
+        else:
+            result.append((op, [vlan_id]))
+    return result
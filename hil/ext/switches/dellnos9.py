@@ -10,11 +10,11 @@ import requests
 import schema
 
 from hil.model import db, Switch, SwitchSession
-from hil.errors import BadArgumentError
+from hil.errors import BadArgumentError, SwitchError
 from hil.model import BigIntegerType
 from hil.network_allocator import get_network_allocator
 from hil.ext.switches.common import should_save, check_native_networks, \
- parse_vlans
+ parse_vlans, merge_trunk_changes, http_session, http_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -66,51 +66,140 @@ class DellNOS9(Switch, SwitchSession):
         return
 
     def disconnect(self):
-        """Since the switch is not connection oriented, we don't need to
-        establish a session or disconnect from it."""
+        """The switch is not connection oriented, so there is no session to
+        end, but we do close our connections to its REST API, if any."""
+        if getattr(self, '_http', None) is not None:
+            self._http.close()
+            self._http = None
+        self._invalidate_port_state()
 
     def modify_port(self, port, channel, new_network):
+        self.apply_port_changes(port, [(channel, new_network)])
+
+    def apply_port_changes(self, port, changes):
         (port,) = filter(lambda p: p.label == port, self.ports)
         interface = port.label
 
-        if channel == 'vlan/native':
-            if new_network is None:
-                self._remove_native_vlan(interface)
-                self._port_shutdown(interface)
-            else:
-                self._set_native_vlan(interface, new_network)
-        else:
-            vlan_id = channel.replace('vlan/', '')
-            legal = get_network_allocator(). \
-                is_legal_channel_for(channel, vlan_id)
-            assert legal, "HIL passed an invalid channel to the switch!"
-
-            if new_network is None:
-                self._remove_vlan_from_trunk(interface, vlan_id)
+        for op, arg in merge_trunk_changes(changes):
+            if op == 'native':
+                if arg is None:
+                    self._remove_native_vlan(interface)
+                    self._port_shutdown(interface)
+                else:
+                    self._set_native_vlan(interface, arg)
+                continue
+
+            for vlan_id in arg:
+                legal = get_network_allocator(). \
+                    is_legal_channel_for('vlan/' + vlan_id, vlan_id)
+                assert legal, "HIL passed an invalid channel to the switch!"
+            if op == 'add':
+                self._add_vlans_to_trunk(interface, arg)
             else:
-                assert new_network == vlan_id
-                self._add_vlan_to_trunk(interface, vlan_id)
+                self._remove_vlans_from_trunk(interface, arg)
+        # Saving is slow, so only do it once for all of the changes.
         if should_save(self):
             self.save_running_config()
 
     def revert_port(self, port):
+        # Look up the native vlan first, so we can use the same (cached)
+        # port info for the trunked vlans; removing them invalidates it.
+        native = self._get_native_vlan(port)
         self._remove_all_vlans_from_trunk(port)
-        if self._get_native_vlan(port) is not None:
-            self._remove_native_vlan(port)
+        if native is not None:
+            self._remove_native_vlan(port, native[1])
         self._port_shutdown(port)
         if should_save(self):
             self.save_running_config()
 
     def get_port_networks(self, ports):
+        # Reading the state of each port through the REST API CLI is slow, so
+        # we get everything from one read of the running config instead.
+        snapshot = self._parse_running_config(
+            self._execute(SHOW, 'running-config').text)
         response = {}
         for port in ports:
-            response[port] = self._get_vlans(port.label)
-            native = self._get_native_vlan(port.label)
-            if native is not None:
-                response[port].append(native)
-
+            response[port] = snapshot.get(port.label, [])
         return response
 
+    def _parse_running_config(self, config):
+        """Return the vlans on each port in the running config ``config``.
+
+        The switch's configuration is vlan centric, e.g.:
+
+            interface GigabitEthernet 1/3
+             no ip address
+             portmode hybrid
+             switchport
+             no shutdown
+            !
+            interface Vlan 1511
+             no ip address
+             tagged GigabitEthernet 1/3,1/5-1/7
+             untagged GigabitEthernet 1/4
+            !
+
+        Only ports of this switch's ``interface_type`` are considered.
+        Returns a dictionary mapping port names to lists of the same form
+        as the values returned by ``get_port_networks``. As elsewhere in
+        this driver, ports which are shut down have no vlans.
+        """
+        shutdown = set()
+        tagged = {}
+        untagged = {}
+        section = None
+        for line in config.splitlines():
+            if line.startswith('interface '):
+                section = line.split()[1:]
+                continue
+            elif not line.startswith(' '):
+                section = None
+                continue
+            if section is None:
+                continue
+
+            words = line.split()
+            if section[0] == self.interface_type and words == ['shutdown']:
+                shutdown.add(section[1])
+            elif section[0] == 'Vlan' and len(words) == 3 and \
+                    words[0] in ('tagged', 'untagged') and \
+                    words[1] == self.interface_type:
+                vlan = section[1]
+                for port in self._parse_port_list(words[2]):
+                    if words[0] == 'tagged':
+                        tagged.setdefault(port, []).append(vlan)
+                    else:
+                        untagged[port] = vlan
+
+        result = {}
+        for port in set(tagged.keys()) | set(untagged.keys()):
+            if port in shutdown:
+                continue
+            vlans = sorted(tagged.get(port, []), key=int)
+            result[port] = [('vlan/%s' % vlan, vlan) for vlan in vlans]
+            if port in untagged:
+                result[port].append(('vlan/native', untagged[port]))
+        return result
+
+    @staticmethod
+    def _parse_port_list(ports):
+        """Expand a list of ports from the running config.
+
+        ``ports`` is a comma separated list of ports and port ranges, e.g.
+        '1/3,1/5-1/7' or '1/1/1-3'. Returns a list of port names.
+        """
+        result = []
+        for item in ports.split(','):
+            if '-' not in item:
+                result.append(item)
+                continue
+            first, last = item.split('-')
+            prefix, start = first.rsplit('/', 1)
+            end = last.rsplit('/', 1)[-1]
+            for i in range(int(start), int(end) + 1):
+                result.append('%s/%d' % (prefix, i))
+        return result
+
     def _get_vlans(self, interface):
         """ Return the vlans of a trunk port.
 
@@ -179,35 +268,47 @@ class DellNOS9(Switch, SwitchSession):
         Tagged:Hybrid\r\n Vlan membership:\r\n Q Vlans\r\n U 1512 \r\n T 1511
         1612-1614,1700\r\n\r\n Native Vlan Id: 1512.\r\n\r\n\r\n\r\n
         MOC-Dell-S3048-ON#</command>\n</output>\n"
+
+        The response is cached until the next change to the switch's
+        configuration; see ``_port_state``.
         """
-        command = 'interfaces switchport %s %s' % \
-            (self.interface_type, interface)
-        response = self._execute(SHOW, command)
-        return response.text.replace(' ', '')
+        cache = self._port_state()
+        if ('info', interface) not in cache:
+            command = 'interfaces switchport %s %s' % \
+                (self.interface_type, interface)
+            response = self._execute(SHOW, command)
+            cache[('info', interface)] = response.text.replace(' ', '')
+        return cache[('info', interface)]
 
-    def _add_vlan_to_trunk(self, interface, vlan):
-        """ Add a vlan to a trunk port.
+    def _add_vlans_to_trunk(self, interface, vlans):
+        """ Add vlans to a trunk port.
 
         If the port is not trunked, its mode will be set to trunk.
 
         Args:
-            interface: interface to add the vlan to
-            vlan: vlan to add
+            interface: interface to add the vlans to
+            vlans: list of vlans to add
+
+        All of the vlans are added with a single request.
         """
         if not self._is_port_on(interface):
             self._port_on(interface)
-        command = 'interface vlan ' + vlan + '\r\n tagged ' + \
-            self.interface_type + ' ' + interface
+        command = '\r\n '.join(
+            'interface vlan ' + vlan + '\r\n tagged ' +
+            self.interface_type + ' ' + interface for vlan in vlans)
         self._execute(CONFIG, command)
 
-    def _remove_vlan_from_trunk(self, interface, vlan):
-        """ Remove a vlan from a trunk port.
+    def _remove_vlans_from_trunk(self, interface, vlans):
+        """ Remove vlans from a trunk port.
 
         Args:
-            interface: interface to remove the vlan from
-            vlan: vlan to remove
+            interface: interface to remove the vlans from
+            vlans: list of vlans to remove
+
+        All of the vlans are removed with a single request.
         """
-        command = self._remove_vlan_command(interface, vlan)
+        command = '\r\n '.join(
+            self._remove_vlan_command(interface, vlan) for vlan in vlans)
         self._execute(CONFIG, command)
 
     def _remove_all_vlans_from_trunk(self, interface):
@@ -244,14 +345,17 @@ class DellNOS9(Switch, SwitchSession):
             self.interface_type + ' ' + interface
         self._execute(CONFIG, command)
 
-    def _remove_native_vlan(self, interface):
+    def _remove_native_vlan(self, interface, vlan=None):
         """ Remove the native vlan from an interface.
 
         Args:
             interface: interface to remove the native vlan from.vlan
+            vlan: the native vlan, if already known. Otherwise it is looked
+                up.
         """
         try:
-            vlan = self._get_native_vlan(interface)[1]
+            if vlan is None:
+                vlan = self._get_native_vlan(interface)[1]
             command = 'interface vlan ' + vlan + '\r\n no untagged ' + \
                 self.interface_type + ' ' + interface
             self._execute(CONFIG, command)
@@ -264,6 +368,7 @@ class DellNOS9(Switch, SwitchSession):
         Turn off portmode hybrid, disable switchport, and then shut down the
         port. All non-default vlans must be removed before calling this.
         """
+        self._invalidate_port_state()
 
         url = self._construct_url(interface=interface)
         interface = self._convert_interface_type(self.interface_type) + \
@@ -279,6 +384,7 @@ class DellNOS9(Switch, SwitchSession):
 
         Turn on port and enable hybrid portmode and switchport.
         """
+        self._invalidate_port_state()
 
         url = self._construct_url(interface=interface)
         interface = self._convert_interface_type(self.interface_type) + \
@@ -290,7 +396,14 @@ class DellNOS9(Switch, SwitchSession):
         self._make_request('PUT', url, data=payload)
 
     def _is_port_on(self, port):
-        """ Returns a boolean that tells the status of a switchport"""
+        """ Returns a boolean that tells the status of a switchport
+
+        The status is cached until the next change to the switch's
+        configuration; see ``_port_state``.
+        """
+        cache = self._port_state()
+        if ('on', port) in cache:
+            return cache[('on', port)]
 
         # the url here requires a suffix to GET the shutdown tag in response.
         url = self._construct_url(interface=port) + '\?with-defaults'
@@ -299,7 +412,29 @@ class DellNOS9(Switch, SwitchSession):
         shutdown = root.find(self._construct_tag('shutdown')).text
 
         assert shutdown in ('false', 'true'), "unexpected state of switchport"
-        return shutdown == 'false'
+        cache[('on', port)] = shutdown == 'false'
+        return cache[('on', port)]
+
+    def _port_state(self):
+        """Return the cache of interface state read from the switch.
+
+        Reading the state of an interface goes through the (slow) REST API
+        CLI, and a single operation may need the same state several times,
+        so we keep it until we change the switch's configuration (or
+        disconnect). The cache maps (kind, interface) to the result of the
+        method which read it.
+        """
+        if getattr(self, '_port_state_cache', None) is None:
+            self._port_state_cache = {}
+        return self._port_state_cache
+
+    def _invalidate_port_state(self):
+        """Forget all cached interface state.
+
+        This must be called before any change to the switch's
+        configuration.
+        """
+        self._port_state_cache = None
 
     def save_running_config(self):
         command = 'write'
@@ -345,6 +480,8 @@ class DellNOS9(Switch, SwitchSession):
 
     def _execute(self, command_type, command):
         """This method gets the url & the payload and executes <command>"""
+        if command_type != SHOW:
+            self._invalidate_port_state()
         url = self._construct_url()
         payload = self._make_payload(command_type, command)
         return self._make_request('POST', url, data=payload)
@@ -412,8 +549,21 @@ class DellNOS9(Switch, SwitchSession):
         """ Construct the xml tag by prepending the dell tag prefix. """
         return '{http://www.dell.com/ns/dell:0.1/root}%s' % name
 
+    def _http_session(self):
+        """Return the ``requests.Session`` used to talk to the switch.
+
+        The session (and its connections) are kept until ``disconnect``.
+        """
+        if getattr(self, '_http', None) is None:
+            self._http = http_session(self, self._auth)
+        return self._http
+
     def _make_request(self, method, url, data=None):
-        r = requests.request(method, url, data=data, auth=self._auth)
+        try:
+            r = self._http_session().request(method, url, data=data,
+                                             timeout=http_timeout(self))
+        except requests.exceptions.RequestException as e:
+            raise SwitchError('Request to switch failed: %s' % e)
         if r.status_code >= 400:
             logger.error('Bad Request to switch. Response: %s', r.text)
         return r
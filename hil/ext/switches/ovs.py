@@ -3,6 +3,7 @@ import re
 import logging
 import schema
 import ast
+import json
 import subprocess
 import shlex
 
@@ -64,20 +65,16 @@ class Ovs(Switch, SwitchSession):
 
     def get_port_networks(self, ports):
 
+        # Read all of the ports at once, rather than running ovs-vsctl for
+        # each of them.
+        all_info = self._all_interface_info()
         response = {}
         for port in ports:
-            trunk_id_list = self._interface_info(port.label)['trunks']
-            if trunk_id_list == []:
-                response[port] = []
-            else:
-                result = []
-                for trunk in trunk_id_list:
-                    name = "vlan/"+trunk
-                    result.append((name, trunk))
-                response[port] = result
-            native = self._interface_info(port.label)['tag']
-            if native != []:
-                response[port].append(("vlan/native", native))
+            info = all_info.get(port.label, {'trunks': [], 'tag': []})
+            response[port] = [("vlan/" + trunk, trunk)
+                              for trunk in info['trunks']]
+            if info['tag'] != []:
+                response[port].append(("vlan/native", info['tag'][0]))
 
         return response
 
@@ -191,6 +188,43 @@ class Ovs(Switch, SwitchSession):
                 i_info[x] = self._string_to_list(i_info[x])
         return i_info
 
+    def _all_interface_info(self):
+        """Gets the vlan configuration of every port on the switch.
+
+        Returns: dictionary mapping port names to dictionaries with the keys
+            'tag' and 'trunks', each a list of vlan ids (as strings). 'tag'
+            has at most one element, the native vlan.
+        """
+        shell_cmd = "sudo ovs-vsctl --format=json --columns=name,tag,trunks" \
+            " list port"
+        args = shlex.split(shell_cmd)
+        try:
+            output = subprocess.check_output(args)
+        except subprocess.CalledProcessError as e:
+            logger.error(" %s ", e)
+            raise SwitchError('Ovs command failed: ')
+        table = json.loads(output)
+        columns = table['headings']
+        result = {}
+        for row in table['data']:
+            row = dict(zip(columns, row))
+            result[row['name']] = {
+                'tag': self._ovsdb_set(row['tag']),
+                'trunks': self._ovsdb_set(row['trunks']),
+            }
+        return result
+
+    @staticmethod
+    def _ovsdb_set(value):
+        """Converts a set from ovs-vsctl's json output into a list of strings.
+
+        Sets are encoded as ["set", [elements]], except that a set with just
+        one element is encoded as the element itself.
+        """
+        if isinstance(value, list) and value[0] == 'set':
+            return [str(x) for x in value[1]]
+        return [str(value)]
+
     def _remove_native_vlan(self, port):
         """Removes native vlan from a trunked port.
         If it is the last vlan to be removed, it disables the port and
@@ -0,0 +1,226 @@
+"""Wake up the networking daemon when new networking actions are queued.
+
+Whenever a ``NetworkingAction`` is committed to the database, a
+notification is sent to anyone listening, so that ``serve_networks`` can
+block until there is work to do, rather than polling the journal.
+
+How the notification is delivered depends on the database:
+
+* On PostgreSQL, we use ``LISTEN``/``NOTIFY``. The ``NOTIFY`` is issued as
+  part of the transaction which inserts the action, so it is only delivered
+  if (and when) that transaction commits.
+* On SQLite, the API server and the networking daemon must be on the same
+  host anyway, so we send a datagram to a unix socket bound by the daemon.
+  The path of the socket is the ``socket`` option in the ``[network-daemon]``
+  section of ``hil.cfg``, defaulting to the path of the database file with
+  ``.sock`` appended.
+
+Notifications are only a hint; the daemon still polls the journal
+periodically, so a lost notification only costs latency. In particular, if
+another daemon is already listening on the socket, the second one just
+polls.
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import object_session
+
+from hil.config import cfg
+from hil.model import db, NetworkingAction
+
+logger = logging.getLogger(__name__)
+
+# The postgres channel used for notifications.
+CHANNEL = 'hil_networking_action'
+
+# Key in ``Session.info`` marking that the current transaction has queued
+# networking actions.
+_PENDING_KEY = 'hil_journal_notify'
+
+
+def socket_path():
+    """Return the path of the unix socket used to wake up the daemon.
+
+    Returns None if the database is not a SQLite database on disk, in which
+    case the socket is not used.
+    """
+    if cfg.has_option('network-daemon', 'socket'):
+        return cfg.get('network-daemon', 'socket')
+    if not cfg.has_option('database', 'uri'):
+        return None
+    url = make_url(cfg.get('database', 'uri'))
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database + '.sock'
+
+
+@event.listens_for(NetworkingAction, 'after_insert')
+def _after_insert(mapper, connection, target):
+    """Queue a notification for a newly inserted networking action."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute('NOTIFY ' + CHANNEL)
+    else:
+        session = object_session(target)
+        if session is not None:
+            session.info[_PENDING_KEY] = True
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _after_commit(session):
+    """Send any notifications queued by the transaction just committed."""
+    if session.info.pop(_PENDING_KEY, False):
+        notify()
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _after_rollback(session):
+    """Drop any notifications queued by the transaction just rolled back."""
+    session.info.pop(_PENDING_KEY, None)
+
+
+def notify():
+    """Wake up the networking daemon via its unix socket, if it has one.
+
+    This is a no-op if the daemon isn't running.
+    """
+    path = socket_path()
+    if path is None:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto('\0', path)
+    except socket.error as e:
+        # ENOENT/ECONNREFUSED mean nobody is listening, and EAGAIN that
+        # there are already plenty of wakeups queued. Either way there's
+        # nothing to do.
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+            logger.warn('Failed to notify the networking daemon: %s', e)
+    finally:
+        sock.close()
+
+
+def _is_listening(path):
+    """Return whether a live socket is bound at ``path``.
+
+    A socket file left over by a daemon which has since died refuses
+    connections.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        sock.close()
+    return True
+
+
+class Listener(object):
+    """Receives the notifications sent when networking actions are queued.
+
+    The listener starts listening as soon as it is created, so no
+    notification sent after that point is lost, even if it arrives while
+    the caller is busy.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._sock = None
+        self._path = None
+        self._inode = None
+
+        if db.engine.dialect.name == 'postgresql':
+            # A raw connection in autocommit mode, kept for the life of the
+            # listener. We detach it from the pool, since we never want it
+            # to be handed out to anyone else.
+            self._conn = db.engine.raw_connection()
+            self._conn.detach()
+            self._conn.set_isolation_level(0)
+            self._conn.cursor().execute('LISTEN ' + CHANNEL)
+        else:
+            self._path = socket_path()
+            if self._path is None:
+                return
+            if os.path.exists(self._path):
+                if _is_listening(self._path):
+                    logger.warn('Another daemon is listening on %s; falling '
+                                'back to polling the journal.', self._path)
+                    self._path = None
+                    return
+                # Left over from a previous daemon.
+                os.unlink(self._path)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(self._path)
+            self._sock.setblocking(False)
+            stat = os.stat(self._path)
+            self._inode = (stat.st_dev, stat.st_ino)
+
+    def enabled(self):
+        """Return whether notifications are available.
+
+        If not, ``wait`` just sleeps for the full timeout.
+        """
+        return self._conn is not None or self._sock is not None
+
+    def _fileno(self):
+        """Return the file descriptor on which notifications arrive."""
+        if self._conn is not None:
+            return self._conn.fileno()
+        return self._sock.fileno()
+
+    def _drain(self):
+        """Discard all notifications received so far."""
+        if self._conn is not None:
+            self._conn.poll()
+            del self._conn.notifies[:]
+        else:
+            while True:
+                try:
+                    self._sock.recv(64)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return
+                    raise
+
+    def wait(self, timeout):
+        """Block until a notification arrives, or ``timeout`` seconds pass.
+
+        Returns True if a notification arrived, False otherwise.
+        """
+        if not self.enabled():
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self._fileno()], [], [], timeout)
+        if not readable:
+            return False
+        self._drain()
+        return True
+
+    def close(self):
+        """Stop listening."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            # Only remove the socket file if it is still ours; if it was
+            # deleted and re-bound by someone else, it belongs to them.
+            try:
+                stat = os.stat(self._path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            if (stat.st_dev, stat.st_ino) == self._inode:
+                os.unlink(self._path)
@@ -0,0 +1,428 @@
+"""Importing and exporting whole site layouts.
+
+A layout describes the inventory of a site -- its projects, switches and
+their ports, nodes with their OBMs and nics, and networks -- as one JSON
+document; see `LAYOUT_SCHEMA`, and ``examples/layout.json`` for an
+example. `import_layout` adds everything in a layout to the database in a
+single transaction, and `export_layout` produces the layout of everything
+in it.
+
+The API calls `layout_import` and `layout_export` expose these over HTTP;
+the ``hil-admin import-layout`` and ``export-layout`` commands use them
+directly.
+"""
+import json
+from collections import defaultdict
+
+from schema import Schema, Optional, SchemaError
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, subqueryload, with_polymorphic
+
+from hil import api, model, errors
+from hil.auth import get_auth_backend
+from hil.class_resolver import concrete_class_for
+from hil.model import db
+from hil.network_allocator import get_network_allocator
+from hil.rest import rest_call, json_array, json_object
+
+# The structure of a layout. This is a superset of the format of the
+# ``site-layout.json`` used by the deployment tests; see docs/testing.md.
+#
+# The arguments for switches and OBMs are the same as for `switch_register`
+# and `node_register`. A nic's switch and port are optional, but must be
+# given together; ports used by nics are registered if need be, so a
+# switch's `ports` only has to list those which aren't. A network's `owner`
+# is a project, or 'admin', and its `access` is the list of projects that can
+# use it; an empty list (the default) makes it public. If `net_id` is '' or
+# missing, one is allocated.
+LAYOUT_SCHEMA = {
+    Optional('projects'): [basestring],
+    Optional('switches'): [{
+        'switch': basestring,
+        'type': basestring,
+        Optional('ports'): [basestring],
+        Optional(basestring): object,
+    }],
+    Optional('nodes'): [{
+        'name': basestring,
+        'obm': {
+            'type': basestring,
+            Optional(basestring): object,
+        },
+        Optional('project'): basestring,
+        Optional('metadata'): dict,
+        Optional('nics'): [{
+            'name': basestring,
+            'mac': basestring,
+            Optional('switch'): basestring,
+            Optional('port'): basestring,
+        }],
+    }],
+    Optional('networks'): [{
+        'network': basestring,
+        'owner': basestring,
+        Optional('access'): [basestring],
+        Optional('net_id'): basestring,
+    }],
+}
+
+
+@rest_call('POST', '/layout', Schema(LAYOUT_SCHEMA))
+def layout_import(**layout):
+    """Add everything in a layout to HIL; see `import_layout`."""
+    get_auth_backend().require_admin()
+    import_layout(layout)
+
+
+@rest_call('GET', '/layout', Schema({}))
+def layout_export():
+    """Return the layout of everything in HIL; see `export_layout`."""
+    get_auth_backend().require_admin()
+    return export_layout()
+
+
+def import_layout(layout):
+    """Add everything in `layout` to the database, and commit.
+
+    `layout` should already have been validated against `LAYOUT_SCHEMA`.
+
+    Either everything is added, or (if an error is raised) nothing is. None
+    of the objects in the layout may already exist. The projects, switches
+    and ports they refer to may either exist already or be part of the
+    layout, or (for ports) be used by one of its nics.
+
+    Rows are added with bulk inserts rather than through the ORM, so large
+    layouts load quickly.
+    """
+    projects = layout.get('projects', [])
+    switches = layout.get('switches', [])
+    nodes = layout.get('nodes', [])
+    networks = layout.get('networks', [])
+
+    project_ids = _label_ids(model.Project)
+    switch_ids = _label_ids(model.Switch)
+    _check_new(model.Project, projects, project_ids)
+    _check_new(model.Switch, [s['switch'] for s in switches], switch_ids)
+    _check_new(model.Node, [n['name'] for n in nodes],
+               _label_ids(model.Node))
+    _check_new(model.Network, [n['network'] for n in networks],
+               _label_ids(model.Network))
+
+    new_projects = set(projects)
+    switch_classes = {}
+    new_ports = {}
+    for switch in switches:
+        cls = _switch_class(switch)
+        switch_classes[switch['switch']] = cls
+        ports = switch.get('ports', [])
+        _check_new(model.Port, ports, {})
+        for port in ports:
+            cls.validate_port_name(port)
+        new_ports[switch['switch']] = set(ports)
+
+    def check_project(label):
+        """Raise a NotFoundError if there's no project `label`."""
+        if label not in new_projects and label not in project_ids:
+            raise errors.NotFoundError('Project %r does not exist.' % label)
+
+    # The switches already in the database which nics refer to, and their
+    # ports:
+    old_switches = set(nic['switch']
+                       for node in nodes
+                       for nic in node.get('nics', [])
+                       if nic.get('switch') in switch_ids)
+    for label, type_ in db.session.query(model.Switch.label,
+                                         model.Switch.type) \
+            .filter(model.Switch.label.in_(old_switches)):
+        switch_classes[label] = concrete_class_for(model.Switch, type_)
+        new_ports[label] = set()
+    old_ports = _existing_ports(set(switch_ids[label]
+                                    for label in old_switches))
+
+    used_ports = set()
+    obm_classes = []
+    for node in nodes:
+        obm_classes.append(_obm_class(node['obm']))
+        if 'project' in node:
+            check_project(node['project'])
+        nics = node.get('nics', [])
+        _check_new(model.Nic, [nic['name'] for nic in nics], {})
+        for nic in nics:
+            if ('switch' in nic) != ('port' in nic):
+                raise errors.BadArgumentError(
+                    'Nic %r of node %r must have both a switch and a port, '
+                    'or neither.' % (nic['name'], node['name']))
+            if 'switch' not in nic:
+                continue
+            switch, port = key = nic['switch'], nic['port']
+            if switch not in switch_classes:
+                raise errors.NotFoundError(
+                    'Switch %r does not exist.' % switch)
+            if key in used_ports:
+                raise errors.DuplicateError(port)
+            used_ports.add(key)
+            old_port = old_ports.get((switch_ids.get(switch), port))
+            if old_port is not None:
+                if old_port[1]:
+                    raise errors.DuplicateError(port)
+            elif port not in new_ports[switch]:
+                switch_classes[switch].validate_port_name(port)
+                new_ports[switch].add(port)
+
+    network_rows = []
+    allocator = get_network_allocator()
+    for network in networks:
+        access = network.get('access', [])
+        for label in access:
+            check_project(label)
+        if network['owner'] != 'admin':
+            check_project(network['owner'])
+            if network['owner'] not in access:
+                raise errors.BadArgumentError(
+                    'Project-owned networks must be accessible by the '
+                    'owner.')
+        net_id = network.get('net_id', '')
+        if net_id == '':
+            net_id = allocator.get_new_network_id()
+            if net_id is None:
+                raise errors.AllocationError('No more networks')
+        else:
+            if not allocator.validate_network_id(net_id):
+                raise errors.BadArgumentError('Invalid net_id')
+            allocator.claim_network_id(net_id)
+        network_rows.append({
+            'label': network['network'],
+            'network_id': net_id,
+            'allocated': allocator.is_network_id_in_pool(net_id),
+        })
+
+    # Everything checks out; add it all. Tables whose rows are referred to
+    # by label are re-read after each insert to find the new rows' ids,
+    # except for joined-inheritance tables, which can only be bulk inserted
+    # a row at a time, fetching the ids as they go.
+    _insert(model.Project, [{'label': label} for label in projects])
+    project_ids = _label_ids(model.Project)
+
+    for switch in switches:
+        row = dict((k, v) for k, v in switch.items()
+                   if k not in ('switch', 'ports'))
+        row['label'] = switch['switch']
+        db.session.bulk_insert_mappings(switch_classes[switch['switch']],
+                                        [row], return_defaults=True)
+        switch_ids[switch['switch']] = row['id']
+    _insert(model.Port, [{'label': port, 'owner_id': switch_ids[switch]}
+                         for switch, ports in new_ports.items()
+                         for port in ports])
+    port_ids = dict((key, port_id) for key, (port_id, _) in
+                    _existing_ports(set(switch_ids[switch] for switch, _
+                                        in used_ports)).items())
+
+    obm_rows = defaultdict(list)
+    node_rows = []
+    for node, cls in zip(nodes, obm_classes):
+        obm_row = dict(node['obm'])
+        obm_rows[cls].append(obm_row)
+        node_rows.append((node, obm_row))
+    for cls, rows in obm_rows.items():
+        db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+    _insert(model.Node, [{
+        'label': node['name'],
+        'obm_id': obm_row['id'],
+        'project_id': project_ids.get(node.get('project')),
+    } for node, obm_row in node_rows])
+    node_ids = _label_ids(model.Node)
+
+    _insert(model.Nic, [{
+        'label': nic['name'],
+        'mac_addr': nic['mac'],
+        'owner_id': node_ids[node['name']],
+        'port_id': port_ids.get((switch_ids.get(nic.get('switch')),
+                                 nic.get('port'))),
+    } for node in nodes for nic in node.get('nics', [])])
+    _insert(model.Metadata, [{
+        'label': label,
+        'value': json.dumps(value),
+        'owner_id': node_ids[node['name']],
+    } for node in nodes for label, value in node.get('metadata', {}).items()])
+
+    for network, row in zip(networks, network_rows):
+        if network['owner'] != 'admin':
+            row['owner_id'] = project_ids[network['owner']]
+    _insert(model.Network, network_rows)
+    network_ids = _label_ids(model.Network)
+    access_rows = [{'network_id': network_ids[network['network']],
+                    'project_id': project_ids[label]}
+                   for network in networks
+                   for label in network.get('access', [])]
+    if access_rows:
+        db.session.execute(model.network_projects.insert(), access_rows)
+
+    tables = set([model.network_projects.name])
+    for cls in [model.Project, model.Switch, model.Port, model.Node,
+                model.Nic, model.Metadata, model.Network] + \
+            [switch_classes[switch['switch']] for switch in switches] + \
+            obm_classes:
+        tables.update(t.name for t in inspect(cls).tables)
+    model.bump_generations(tables)
+    db.session.commit()
+
+
+def export_layout():
+    """Return a `JSONStream` of the layout of everything in the database.
+
+    The result can be passed to `import_layout` to recreate the same
+    objects, e.g. in a fresh database. Nodes' project assignments are
+    included, but their network attachments are not.
+
+    Note that this includes the credentials of every switch and OBM.
+    """
+    return json_object([
+        ('networks', json_array(_export_networks())),
+        ('nodes', json_array(_export_nodes())),
+        ('projects', json_array(label for (label,) in api.paginate(
+            db.session.query(model.Project.label), model.Project.label))),
+        ('switches', json_array(_export_switches())),
+    ])
+
+
+def _export_networks():
+    """Generate the layouts of all networks."""
+    query = model.Network.query.options(joinedload(model.Network.owner),
+                                        subqueryload(model.Network.access))
+    for network in api.paginate(query, model.Network.label):
+        yield {
+            'network': network.label,
+            'owner': 'admin' if network.owner is None else
+                     network.owner.label,
+            'access': sorted(p.label for p in network.access),
+            'net_id': network.network_id,
+        }
+
+
+def _export_nodes():
+    """Generate the layouts of all nodes."""
+    obm_class = with_polymorphic(model.Obm, '*', flat=True)
+    query = model.Node.query.options(
+        joinedload(model.Node.obm.of_type(obm_class)),
+        joinedload(model.Node.project),
+        subqueryload(model.Node.metadata),
+        subqueryload(model.Node.nics)
+        .joinedload(model.Nic.port)
+        .joinedload(model.Port.owner),
+    )
+    for node in api.paginate(query, model.Node.label):
+        result = {
+            'name': node.label,
+            'obm': _driver_args(node.obm),
+            'nics': [],
+        }
+        result['obm']['type'] = node.obm.type
+        if node.project is not None:
+            result['project'] = node.project.label
+        if node.metadata:
+            result['metadata'] = dict((m.label, json.loads(m.value))
+                                      for m in node.metadata)
+        for nic in sorted(node.nics, key=lambda nic: nic.label):
+            nic_result = {'name': nic.label, 'mac': nic.mac_addr}
+            if nic.port is not None:
+                nic_result['switch'] = nic.port.owner.label
+                nic_result['port'] = nic.port.label
+            result['nics'].append(nic_result)
+        yield result
+
+
+def _export_switches():
+    """Generate the layouts of all switches."""
+    switch_class = with_polymorphic(model.Switch, '*')
+    query = db.session.query(switch_class) \
+        .options(subqueryload(switch_class.ports))
+    for switch in api.paginate(query, switch_class.label):
+        result = _driver_args(switch)
+        result.update({
+            'switch': switch.label,
+            'type': switch.type,
+            'ports': sorted(port.label for port in switch.ports),
+        })
+        yield result
+
+
+def _driver_args(obj):
+    """Return the driver-specific arguments of the switch or obm `obj`.
+
+    These are its columns which aren't also columns of its base class.
+    """
+    mapper = inspect(obj).mapper
+    base_keys = set(attr.key for attr in mapper.base_mapper.column_attrs)
+    return dict((attr.key, getattr(obj, attr.key))
+                for attr in mapper.column_attrs
+                if attr.key not in base_keys)
+
+
+def _label_ids(cls):
+    """Return a dict mapping the labels of all `cls` objects to their ids."""
+    return dict(db.session.query(cls.label, cls.id))
+
+
+def _check_new(cls, labels, existing):
+    """Check that `labels` are new labels for objects of type `cls`.
+
+    Raises a DuplicateError if any label appears twice in `labels`, or is
+    in `existing`.
+    """
+    seen = set()
+    for label in labels:
+        if label in seen or label in existing:
+            raise errors.DuplicateError('%s %r already exists.' %
+                                        (cls.__name__, label))
+        seen.add(label)
+
+
+def _existing_ports(switch_ids):
+    """Return the ports on the switches with ids in `switch_ids`.
+
+    The result maps (switch id, port label) to (port id, connected), where
+    `connected` says whether the port is connected to a nic.
+    """
+    if not switch_ids:
+        return {}
+    rows = db.session.query(model.Port.owner_id, model.Port.label,
+                            model.Port.id, model.Nic.id) \
+        .outerjoin(model.Nic, model.Nic.port_id == model.Port.id) \
+        .filter(model.Port.owner_id.in_(switch_ids))
+    return dict(((owner_id, label), (port_id, nic_id is not None))
+                for owner_id, label, port_id, nic_id in rows)
+
+
+def _switch_class(switch):
+    """Return the class for the layout of `switch`, after validating it."""
+    cls = concrete_class_for(model.Switch, switch['type'])
+    if cls is None:
+        raise errors.BadArgumentError('%r is not a valid switch type.' %
+                                      switch['type'])
+    try:
+        cls.validate(dict((k, v) for k, v in switch.items()
+                          if k not in ('switch', 'type', 'ports')))
+    except SchemaError:
+        raise errors.BadArgumentError(
+            'The arguments are not valid for switch %r.' % switch['switch'])
+    return cls
+
+
+def _obm_class(obm):
+    """Return the class for the layout of `obm`, after validating it."""
+    cls = concrete_class_for(model.Obm, obm['type'])
+    if cls is None:
+        raise errors.BadArgumentError('%r is not a valid OBM type.' %
+                                      obm['type'])
+    try:
+        cls.validate(obm)
+    except SchemaError:
+        raise errors.BadArgumentError(
+            'The arguments are not valid for this OBM type.')
+    return cls
+
+
+def _insert(cls, rows):
+    """Bulk insert `rows`, a list of dicts of column values, into `cls`."""
+    if rows:
+        db.session.bulk_insert_mappings(cls, rows)
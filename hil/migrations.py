@@ -8,13 +8,14 @@ Contains code for:
 """
 from flask_migrate import Migrate, MigrateCommand
 from hil.flaskapp import app
-from hil.model import db
+from hil.model import db, seed_generations
 from hil.network_allocator import get_network_allocator
 from os.path import join, dirname
 import sys
 
 from alembic.config import Config
 from alembic.script import ScriptDirectory
+from sqlalchemy.exc import IntegrityError
 
 # This is a dictionary mapping the names of modules to directories containing
 # their alembic version scripts. Extensions may add entries to this with their
@@ -83,6 +84,7 @@ def create_db():
             db.session.execute(
                 AlembicVersion.insert().values(version_num=head)
             )
+        seed_generations()
         get_network_allocator().populate()
         db.session.commit()
 
@@ -104,3 +106,11 @@ def check_db_schema():
     if _expected_heads() != actual_heads:
         sys.exit("ERROR: Database schema version is incorrect; try "
                  "running hil-admin db upgrade heads.")
+
+    # Tables added by `db upgrade` need generations. Another process may be
+    # starting up and doing the same thing, in which case it wins:
+    seed_generations()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
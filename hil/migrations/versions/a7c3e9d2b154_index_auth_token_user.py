@@ -0,0 +1,26 @@
+"""Index auth_token.user
+
+Revision ID: a7c3e9d2b154
+Revises: f1b2c3d4e5a6
+Create Date: 2018-04-03 11:27:45.830129
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9d2b154'
+down_revision = 'f1b2c3d4e5a6'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_index(op.f('ix_auth_token_user'), 'auth_token', ['user'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_auth_token_user'), table_name='auth_token')
@@ -0,0 +1,42 @@
+"""Seed the generation table
+
+Revision ID: b2d9f4c6e871
+Revises: a7c3e9d2b154
+Create Date: 2018-04-05 09:12:33.604718
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d9f4c6e871'
+down_revision = 'a7c3e9d2b154'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+# Mirrors hil.model.UNTRACKED_TABLES, as of this revision:
+untracked = ['alembic_version', 'auth_token', 'generation',
+             'networking_action']
+
+
+def upgrade():
+    # Generations are now only ever updated, never inserted on first use, so
+    # every table needs a row. Tables which already have one keep it.
+    conn = op.get_bind()
+    generation = sa.table('generation',
+                          sa.column('table_name', sa.String),
+                          sa.column('value', sa.BigInteger))
+    existing = set(name for (name,) in
+                   conn.execute(sa.select([generation.c.table_name])))
+    missing = [name for name in sa.inspect(conn).get_table_names()
+               if name not in existing and name not in untracked]
+    if missing:
+        op.bulk_insert(generation, [{'table_name': name, 'value': 0}
+                                    for name in sorted(missing)])
+
+
+def downgrade():
+    pass
@@ -0,0 +1,34 @@
+"""Add claimed_by and lease_expiry to networking_action
+
+Revision ID: d3f1c6b4a0e2
+Revises: 264ddaebdfcc
+Create Date: 2018-03-12 14:02:11.519023
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f1c6b4a0e2'
+down_revision = '264ddaebdfcc'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.add_column(
+        'networking_action',
+        sa.Column('claimed_by', sa.String(), nullable=True),
+    )
+    op.add_column(
+        'networking_action',
+        sa.Column('lease_expiry', sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column('networking_action', 'claimed_by')
+    op.drop_column('networking_action', 'lease_expiry')
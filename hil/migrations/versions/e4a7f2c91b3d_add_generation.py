@@ -0,0 +1,31 @@
+"""Add the generation table
+
+Revision ID: e4a7f2c91b3d
+Revises: d3f1c6b4a0e2
+Create Date: 2018-03-20 10:41:37.204518
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7f2c91b3d'
+down_revision = 'd3f1c6b4a0e2'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table(
+        'generation',
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('value', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name'),
+    )
+
+
+def downgrade():
+    op.drop_table('generation')
@@ -0,0 +1,36 @@
+"""Add the auth_token table
+
+Revision ID: f1b2c3d4e5a6
+Revises: e4a7f2c91b3d
+Create Date: 2018-03-27 14:02:11.518342
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b2c3d4e5a6'
+down_revision = 'e4a7f2c91b3d'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table(
+        'auth_token',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('token_hash', sa.String(), nullable=False),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.Column('user', sa.String(), nullable=True),
+        sa.Column('is_admin', sa.Boolean(), nullable=False),
+        sa.Column('project_ids', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token_hash'),
+    )
+
+
+def downgrade():
+    op.drop_table('auth_token')
@@ -11,14 +11,14 @@ Extensions are permitted to create new database objects by subclassing from
 # from sqlalchemy import *
 # from sqlalchemy.ext.declarative import declarative_base, declared_attr
 # from sqlalchemy.orm import relationship, sessionmaker,backref
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from subprocess import call, check_call, Popen, PIPE
 from hil.flaskapp import app
 from hil.config import cfg
 from hil.dev_support import no_dry_run
 import uuid
 import xml.etree.ElementTree
-from sqlalchemy import BigInteger
+from sqlalchemy import BigInteger, event, inspect
 from sqlalchemy.dialects import sqlite
 
 # without setting this explicitly, we get a warning that this option
@@ -27,7 +27,30 @@ from sqlalchemy.dialects import sqlite
 # just opt-in to the change now:
 app.config.update(SQLALCHEMY_TRACK_MODIFICATIONS=False)
 
-db = SQLAlchemy(app)
+# Key in ``Session.info``; while it is set, ``commit()`` only flushes, so
+# that several API calls can be made in one transaction (see
+# `hil.api.batch`). Whoever sets it is responsible for the final commit.
+DEFER_COMMIT = 'hil_defer_commit'
+
+
+class _Session(SignallingSession):
+    """The session class used by `db`; see `DEFER_COMMIT`."""
+
+    def commit(self):
+        if self.info.get(DEFER_COMMIT):
+            self.flush()
+        else:
+            super(_Session, self).commit()
+
+
+class _SQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions of class `_Session`."""
+
+    def create_session(self, options):
+        return _Session(self, **options)
+
+
+db = _SQLAlchemy(app)
 
 # Sets up variant type so that postgresql can use BIGINT primary keys
 # while sqlite uses Integer primary keys.
@@ -279,6 +302,21 @@ class SwitchSession(object):
         """
         assert False, "Subclasses MUST override modify_port"
 
+    def apply_port_changes(self, port, changes):
+        """Apply several changes to the same port.
+
+        `port` is the name of a port (`Port.label`) on the switch.
+
+        `changes` is a list of (channel, new_network) pairs, each as in
+        `modify_port`, to be applied in order.
+
+        Drivers which can apply several changes more cheaply than one at a
+        time should override this; the default just calls `modify_port` for
+        each change.
+        """
+        for channel, new_network in changes:
+            self.modify_port(port, channel, new_network)
+
     def revert_port(self, port):
         """Detach the port from all networks.
 
@@ -293,6 +331,32 @@ class SwitchSession(object):
         """
         assert False, "Subclasses MUST override disconnect"
 
+    def release(self):
+        """Finish a batch of work, without disconnecting.
+
+        The networking daemon calls this when it is done with the session
+        for now (see ``hil.deferred.SessionPool``). Returns True if the
+        session may be kept open and reused later, in which case any work
+        normally done by ``disconnect`` which shouldn't wait (such as saving
+        the configuration) must be done here.
+
+        The default returns False, in which case the session is disconnected
+        right away.
+        """
+        return False
+
+    def reuse(self, switch):
+        """Prepare to reuse the session for another batch of work.
+
+        This is only called on sessions for which ``release`` returned True.
+        ``switch`` is the switch object, as loaded in the current database
+        session; the session must use it from now on rather than the one it
+        was created with. Returns False if the session is no longer usable
+        (e.g. the switch has dropped the connection), in which case it is
+        disconnected and a new one is created.
+        """
+        return False
+
     def get_port_networks(self, ports):
         """Return a mapping from port objects to (channel, network ID)
             pairs.
@@ -589,6 +653,12 @@ class NetworkingAction(db.Model):
     # status of the operation; it can either be 'PENDING', 'DONE' or 'ERROR'
     status = db.Column(db.String, nullable=False)
 
+    # The networking daemon which has claimed the action, and when its claim
+    # expires (in UTC). Both are None if the action has never been claimed.
+    # See ``hil.deferred.apply_networking``.
+    claimed_by = db.Column(db.String, nullable=True)
+    lease_expiry = db.Column(db.DateTime, nullable=True)
+
     # The type of action.
     #
     # * 'modify_port' attaches the (nic, channel) pair to a specified network,
@@ -632,3 +702,158 @@ class NetworkAttachment(db.Model):
 
     nic = db.relationship('Nic', backref=db.backref('attachments'))
     network = db.relationship('Network', backref=db.backref('attachments'))
+
+
+class AuthToken(db.Model):
+    """A bearer token, issued by ``POST /auth/token``.
+
+    Only a hash of the token itself is stored. The token carries the claims
+    of the request it was issued to -- whether it had admin access, and the
+    ids of the projects it had access to -- until it expires or is revoked;
+    see `hil.auth`.
+    """
+    id = db.Column(BigIntegerType, primary_key=True)
+    token_hash = db.Column(db.String, nullable=False, unique=True)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    # The name of the user the token was issued to, if the auth backend
+    # knows it:
+    user = db.Column(db.String, nullable=True, index=True)
+    is_admin = db.Column(db.Boolean, nullable=False)
+    # A JSON list of project ids:
+    project_ids = db.Column(db.String, nullable=False)
+
+
+class Generation(db.Model):
+    """A count of the writes made to one database table.
+
+    Every transaction which adds, changes or removes rows of a table bumps
+    that table's generation once it has committed (see `_bump_generations`).
+    So if none of the generations a response was built from have changed,
+    neither has the response; `hil.rest` uses this to answer conditional
+    GETs.
+
+    The bump is made in a short transaction of its own, so the generation
+    rows are only ever locked briefly, and never while the writing
+    transaction holds locks of its own. The cost is a short window after
+    each commit in which the generation is stale; a conditional GET in that
+    window may be told nothing has changed, until the bump lands.
+
+    Each table has one row, created up front by `seed_generations`, so bumping
+    a generation is always a plain UPDATE. The tables in `UNTRACKED_TABLES`
+    are never used to build cacheable responses, so writes to them don't bump
+    anything.
+    """
+    table_name = db.Column(db.String, primary_key=True)
+    value = db.Column(BigIntegerType, nullable=False)
+
+
+# Tables without generations. The networking daemons write networking_action
+# constantly, to claim actions and renew their leases on them, and tokens are
+# issued on every login; neither table appears in any ETag, so there is no
+# point bumping generations for those writes.
+UNTRACKED_TABLES = frozenset([
+    'alembic_version',
+    'auth_token',
+    'generation',
+    'networking_action',
+])
+
+# Key in ``Session.info`` holding the set of tables written to by the current
+# transaction, whose generations are bumped when it commits.
+_WRITTEN_KEY = 'hil_written_tables'
+
+
+def get_generations(table_names):
+    """Return a dict mapping each of `table_names` to its generation.
+
+    Tables which have never been written to have generation 0.
+    """
+    result = dict((name, 0) for name in table_names)
+    rows = db.session.query(Generation.table_name, Generation.value) \
+        .filter(Generation.table_name.in_(table_names))
+    for name, value in rows:
+        result[name] = value
+    return result
+
+
+def seed_generations():
+    """Create the generation rows of any tables which don't have one yet.
+
+    This covers every table in the schema, including those of extensions,
+    except `UNTRACKED_TABLES`. It is called by ``create_db``, and on
+    startup by ``check_db_schema``, since ``db upgrade`` may have added
+    tables. The caller is responsible for committing.
+    """
+    existing = set(name for (name,) in db.session.query(Generation.table_name))
+    missing = [name for name in db.metadata.tables
+               if name not in existing and name not in UNTRACKED_TABLES]
+    if missing:
+        db.session.execute(Generation.__table__.insert(),
+                           [{'table_name': name, 'value': 0}
+                            for name in sorted(missing)])
+
+
+def _note_written(session, table_names):
+    """Record that the current transaction of `session` wrote `table_names`.
+    """
+    table_names = set(table_names) - UNTRACKED_TABLES
+    if table_names:
+        session.info.setdefault(_WRITTEN_KEY, set()).update(table_names)
+
+
+def _bump_generations(table_names):
+    """Bump the generations of `table_names`, in a transaction of its own."""
+    gen = Generation.__table__
+    # Lock the rows in the same order each time, so concurrent bumps can't
+    # deadlock:
+    with db.engine.begin() as connection:
+        for name in sorted(table_names):
+            connection.execute(
+                gen.update()
+                .where(gen.c.table_name == name)
+                .values(value=gen.c.value + 1))
+
+
+def bump_generations(table_names):
+    """Bump the generations of `table_names` when the session commits.
+
+    Writes made through the ORM bump generations automatically; this is for
+    writes which bypass it, such as ``Session.bulk_insert_mappings``.
+    """
+    _note_written(db.session(), table_names)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _note_flushed_tables(session, flush_context):
+    """Note the tables touched by a flush."""
+    table_names = set()
+    for obj in session.new | session.deleted:
+        table_names.update(t.name for t in inspect(obj).mapper.tables)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            table_names.update(t.name for t in inspect(obj).mapper.tables)
+    _note_written(session, table_names)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+@event.listens_for(SignallingSession, 'after_bulk_delete')
+def _note_bulk_tables(context):
+    """Note the tables touched by a bulk query."""
+    _note_written(context.session, [t.name for t in context.mapper.tables])
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _bump_committed_generations(session):
+    """Bump the generations of the tables written by the committed
+    transaction.
+    """
+    table_names = session.info.pop(_WRITTEN_KEY, None)
+    if table_names:
+        _bump_generations(table_names)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_written_tables(session):
+    """Forget the tables written by a transaction which was rolled back."""
+    session.info.pop(_WRITTEN_KEY, None)
@@ -8,6 +8,7 @@ The main things of interest in this module are:
 """
 import logging
 import json
+import hashlib
 
 import flask
 from flask import _app_ctx_stack as ctx_stack
@@ -16,10 +17,10 @@ from hil.flaskapp import app
 from hil.errors import APIError, AuthorizationError
 from hil.config import cfg
 
-from schema import SchemaError
+from schema import Schema, Optional, SchemaError
 from uuid import uuid4
 
-from hil import auth
+from hil import auth, model
 
 local = flask.g
 
@@ -89,7 +90,7 @@ class ValidationError(APIError):
     """An exception indicating that the body of the request was invalid."""
 
 
-def rest_call(methods, path, schema, dont_log=()):
+def rest_call(methods, path, schema, dont_log=(), etag=None):
     """A decorator which registers an http mapping to a python api call.
 
     `rest_call` makes no modifications to the function itself, though the
@@ -122,6 +123,16 @@ def rest_call(methods, path, schema, dont_log=()):
             perform type validation and conversion.
     * dont_log (optional): a list of "sensitive" argument names, which should
             not be logged.
+    * etag (optional): a list of the names of the database tables the
+            response to a GET request is built from. If given, such responses
+            carry an ETag header derived from the tables' generations (see
+            `hil.model.Generation`), and requests whose If-None-Match header
+            matches it get a 304 Not Modified without calling the function.
+            The tag also covers the request's path, query string and
+            credentials, so it can't be replayed across any of those, and
+            the tables the auth backend decides access from (see
+            `hil.auth.AuthBackend.etag_tables`), so it stops matching if the
+            credentials' access changes.
 
     For example, given::
 
@@ -162,6 +173,8 @@ def rest_call(methods, path, schema, dont_log=()):
           the status code will be 200.
         * A tuple, whose first element is a string (the response body), and
           whose second is an integer (the status code).
+        * A `JSONStream`, which will be streamed to the client as the body of
+          the response as it is encoded. The status code will be 200.
     """
     def register(f):
         """Return value from rest call; this decorates the function itself."""
@@ -176,16 +189,282 @@ def rest_call(methods, path, schema, dont_log=()):
 
         app.add_url_rule(path,
                          f.__name__,
-                         _rest_wrapper(f, schema, dont_log),
+                         _rest_wrapper(f, compile_schema(schema),
+                                       dont_log, etag),
                          methods=meths)
         return f
     return register
 
 
+def _stdlib_json_dumps(obj):
+    """Encode `obj` as JSON, with sorted keys, using the standard library."""
+    return json.dumps(obj, sort_keys=True)
+
+
+# Encoded by each candidate JSON codec before it is used; see
+# `_json_codec_works`.
+_JSON_CODEC_PROBE = {
+    'b': [1.5, None, True, u'\u2603 "a/b"\n'],
+    'a': {'d': 2**70, 'c': -2**63 - 1},
+}
+
+
+def _json_codec_works(dumps, loads):
+    """Return whether `dumps` and `loads` round-trip `_JSON_CODEC_PROBE`,
+    with the keys sorted.
+    """
+    try:
+        encoded = dumps(_JSON_CODEC_PROBE)
+        return (loads(encoded) == _JSON_CODEC_PROBE and
+                encoded.index('"a"') < encoded.index('"b"') and
+                encoded.index('"c"') < encoded.index('"d"'))
+    except Exception:  # pylint: disable=broad-except
+        return False
+
+
+def _find_json_codec():
+    """Return a (dumps, loads) pair using the fastest JSON library available.
+
+    ujson is preferred, then simplejson if its C speedups are built, then the
+    standard library. A library is skipped if it doesn't round-trip
+    `_JSON_CODEC_PROBE` correctly, with sorted keys; some versions of ujson,
+    for example, produce invalid output for integers wider than 64 bits.
+    """
+    candidates = []
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        def ujson_dumps(obj):
+            """Encode `obj` as JSON, with sorted keys, using ujson."""
+            try:
+                return ujson.dumps(obj, sort_keys=True,
+                                   escape_forward_slashes=False)
+            except OverflowError:
+                # Raised by versions of ujson which can't encode integers
+                # wider than 64 bits:
+                return _stdlib_json_dumps(obj)
+        candidates.append((ujson_dumps, ujson.loads))
+    try:
+        import simplejson
+        # pylint: disable=unused-variable
+        from simplejson import _speedups
+    except ImportError:
+        pass
+    else:
+        def simplejson_dumps(obj):
+            """Encode `obj` as JSON, with sorted keys, using simplejson."""
+            return simplejson.dumps(obj, sort_keys=True)
+        candidates.append((simplejson_dumps, simplejson.loads))
+    for dumps, loads in candidates:
+        if _json_codec_works(dumps, loads):
+            return dumps, loads
+    return _stdlib_json_dumps, json.loads
+
+
+_json_dumps, _json_loads = _find_json_codec()
+
+
+def set_json_codec(dumps, loads):
+    """Set the functions used to encode and decode JSON.
+
+    `dumps` must take a JSON-serializable object and return a string, with
+    the keys of all objects sorted, so that responses are deterministic.
+    `loads` must take a string and return the decoded object, raising
+    ValueError if it isn't valid JSON.
+
+    By default, the fastest library available is used; see
+    `_find_json_codec`.
+    """
+    global _json_dumps, _json_loads
+    _json_dumps, _json_loads = dumps, loads
+
+
+def json_dumps(obj):
+    """Encode `obj` as JSON, using the configured codec.
+
+    API calls should use this to encode their responses.
+    """
+    return _json_dumps(obj)
+
+
+def json_loads(data):
+    """Decode the JSON string `data`, using the configured codec."""
+    return _json_loads(data)
+
+
+# Roughly how many bytes of JSON a JSONStream encodes before handing them off
+# to be sent to the client.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class JSONStream(object):
+    """A JSON document which is encoded a piece at a time.
+
+    API calls may return one of these in place of a string, in which case the
+    body of the response is sent to the client as it is encoded, rather than
+    being built up in memory first. Use `json_array` or `json_object` to
+    create one.
+
+    Iterating over a JSONStream yields the pieces of the encoded document.
+    `read()` returns the whole thing at once, so `json.load` accepts a
+    JSONStream directly. Either way, a JSONStream can only be consumed once.
+    """
+
+    def __init__(self, pieces):
+        """Wrap `pieces`, an iterable of strings making up the document."""
+        self._pieces = pieces
+
+    def __iter__(self):
+        chunk = []
+        size = 0
+        for piece in self._pieces:
+            chunk.append(piece)
+            size += len(piece)
+            if size >= _STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def read(self):
+        """Encode and return the whole document."""
+        return ''.join(self)
+
+
+def json_array(items):
+    """Return a `JSONStream` encoding the elements of `items` as an array.
+
+    `items` is only iterated over as the stream is, so it may be a generator
+    producing elements on the fly. Elements may themselves be JSONStreams,
+    which are nested in this one, and also encoded lazily.
+    """
+    def pieces():
+        """Generate the pieces of the array."""
+        yield '['
+        sep = ''
+        for item in items:
+            yield sep
+            for piece in _json_pieces(item):
+                yield piece
+            sep = ', '
+        yield ']'
+    return JSONStream(pieces())
+
+
+def json_object(pairs):
+    """Return a `JSONStream` encoding the (key, value) `pairs` as an object.
+
+    As with `json_array`, `pairs` is iterated over lazily, and values may be
+    JSONStreams. Keys are emitted in the order they appear, so to match
+    `json_dumps` they should already be sorted; each key should appear only
+    once.
+    """
+    def pieces():
+        """Generate the pieces of the object."""
+        yield '{'
+        sep = ''
+        for key, value in pairs:
+            yield '%s%s: ' % (sep, json_dumps(key))
+            for piece in _json_pieces(value):
+                yield piece
+            sep = ', '
+        yield '}'
+    return JSONStream(pieces())
+
+
+def _json_pieces(value):
+    """Return the pieces of the encoding of `value`, which may be a
+    `JSONStream`.
+    """
+    if isinstance(value, JSONStream):
+        return value._pieces
+    return [json_dumps(value)]
+
+
+class _CompiledSchema(object):
+    """A specialized validator for a dict ``Schema``, as built by
+    `compile_schema`.
+
+    Accepts and rejects exactly the same data as the schema it was built
+    from, and returns the same validated dict, but looks keys up directly
+    rather than trying each key of the schema in turn, and checks values
+    which only need an isinstance() check without going through `Schema`.
+    """
+
+    def __init__(self, schema):
+        self._required = set()
+        self._validators = {}
+        for key, value in schema._schema.items():
+            if type(key) is Optional:
+                key = key._schema
+            else:
+                self._required.add(key)
+            self._validators[key] = _compile_value(value)
+
+    def validate(self, data):
+        """Validate `data`, as with ``Schema.validate``."""
+        if not isinstance(data, dict):
+            raise SchemaError('%r should be instance of %r' % (data, dict),
+                              None)
+        new = type(data)()
+        for key, value in data.iteritems():
+            validator = self._validators.get(key)
+            if validator is None:
+                raise SchemaError('wrong key %r in %r' % (key, data), None)
+            new[key] = validator(value)
+        missing = self._required.difference(new)
+        if missing:
+            raise SchemaError('missed keys %r' % missing, None)
+        return new
+
+
+def _compile_value(s):
+    """Return a function validating a value against the schema `s`.
+
+    The function behaves like ``Schema(s).validate``.
+    """
+    if s is object:
+        return lambda value: value
+    if isinstance(s, type) and not hasattr(s, 'validate'):
+        def check_type(value):
+            """Check that `value` is an instance of `s`."""
+            if isinstance(value, s):
+                return value
+            raise SchemaError('%r should be instance of %r' % (value, s),
+                              None)
+        return check_type
+    return Schema(s).validate
+
+
+def compile_schema(schema):
+    """Compile `schema` into a faster validator, if possible.
+
+    Dict schemas whose keys are all plain strings, optionally wrapped in
+    `Optional`, and which don't set a custom error, are compiled to a
+    `_CompiledSchema`. Anything else is returned as-is. Either way, the result
+    has a ``validate`` method behaving like `schema`'s.
+    """
+    if type(schema) is not Schema or schema._error is not None or \
+            type(schema._schema) is not dict:
+        return schema
+    for key in schema._schema:
+        if type(key) is Optional:
+            if key._error is not None:
+                return schema
+            key = key._schema
+        if not isinstance(key, basestring):
+            return schema
+    return _CompiledSchema(schema)
+
+
 def _do_validation(schema, kwargs):
     """Validate the current request against `schema`.
 
-    `schema` should be a schema as passed to `rest_call`.
+    `schema` should be a schema as passed to `rest_call`, or the result of
+    passing one to `compile_schema`.
 
     `kwargs` should be the arguments to the API call pulled from the URL.
 
@@ -204,22 +483,19 @@ def _do_validation(schema, kwargs):
             raise ValidationError("GET request made with a non-empty request"
                                   " body")
 
-        for key, value in flask.request.args.iteritems():
-            if key in final_kwargs:
-                raise ValidationError("Parameter specified more than once")
-            elif value is None or value == '':
-                # TODO: if we want to take flags (ie - an option that has no
-                # value), change this check and add logic in the next else to
-                # take care of that. We'll also need to pick a standard value
-                # to represent a flag (like 'True', 'None' or '').
-                raise ValidationError("Empty parameter specified")
-            else:
-                final_kwargs[key] = value
+        # If a parameter is given more than once, the first value wins.
+        final_kwargs = flask.request.args.to_dict()
+        if '' in final_kwargs.itervalues():
+            # TODO: if we want to take flags (ie - an option that has no
+            # value), change this check to allow them. We'll also need to
+            # pick a standard value to represent a flag (like 'True', 'None'
+            # or '').
+            raise ValidationError("Empty parameter specified")
     else:
         # Methods other than GET can use path and body arguments
         if flask.request.data != '':
             try:
-                final_kwargs = json.loads(flask.request.data)
+                final_kwargs = json_loads(flask.request.data)
             except ValueError:
                 raise ValidationError("The request body is not valid JSON")
 
@@ -245,7 +521,28 @@ def _do_validation(schema, kwargs):
         raise validation_error
 
 
-def _rest_wrapper(f, schema, dont_log):
+def _make_etag(table_names):
+    """Return the ETag for the current request, given the tables it reads.
+
+    See the documentation for the `etag` argument to `rest_call`.
+    """
+    generations = model.get_generations(
+        list(table_names) + list(auth.get_auth_backend().etag_tables))
+    tag = hashlib.sha1()
+    tag.update(flask.request.full_path.encode('utf-8'))
+    for header in 'Authorization', 'X-Auth-Token':
+        value = flask.request.headers.get(header, '')
+        tag.update('\0' + value.encode('utf-8'))
+    # A token's access can be revoked without any of the above changing;
+    # see `hil.auth.revoke_tokens`:
+    token = getattr(local, 'auth_token', None)
+    tag.update('\0token=%s' % (token.id if token is not None else ''))
+    for name in sorted(generations):
+        tag.update('\0%s=%d' % (name, generations[name]))
+    return tag.hexdigest()
+
+
+def _rest_wrapper(f, schema, dont_log, etag=None):
     """Return a wrapper around `f` that does the following:
 
     * Validate the current request against the schema.
@@ -254,6 +551,8 @@ def _rest_wrapper(f, schema, dont_log):
       `rest_call`.
     * Log arguments, except those in `dont_log`.
     * Convert `None` return values to empty bodies.
+    * Stream `JSONStream` return values.
+    * Handle ETags and conditional GETs, if `etag` is not None.
 
     The result of this is suitable to hand directly to flask.
     """
@@ -266,13 +565,36 @@ def _rest_wrapper(f, schema, dont_log):
         for argname in dont_log:
             censored_kwargs[argname] = '<<CENSORED>>'
 
-        init_auth()
+        if getattr(local, 'reuse_auth', False):
+            # A subrequest; see `subrequest`. Whatever the caller has
+            # done may have changed the request's access, so decisions
+            # remembered so far can't be relied on:
+            local.auth_memo = None
+        else:
+            init_auth()
         logger.info('API call: %s(%s)',
                     f.__name__, _format_arglist(**censored_kwargs))
 
+        tag = None
+        if etag is not None and flask.request.method == 'GET':
+            tag = _make_etag(etag)
+            if flask.request.if_none_match.contains(tag):
+                ret = flask.Response(status=304)
+                ret.set_etag(tag)
+                return ret
+
         ret = f(**kwargs)
         if ret is None:
             ret = ''
+        elif isinstance(ret, JSONStream):
+            # The request context has to stay around until the stream is
+            # done, since producing it may still involve the database or
+            # auth backend:
+            ret = flask.Response(flask.stream_with_context(ret),
+                                 mimetype='application/json')
+        if tag is not None:
+            ret = flask.make_response(ret)
+            ret.set_etag(tag)
         return ret
     return wrapper
 
@@ -292,11 +614,12 @@ def _format_arglist(*args, **kwargs):
 def init_auth():
     """Process authentication.
 
-    This invokes the auth backend. If HIL is configured to *require*
+    This invokes the auth backend, unless the request carries a bearer
+    token (see `hil.auth.authenticate`). If HIL is configured to *require*
     authentication, and authentication fails, it raises an
     AuthorizationError.
     """
-    ok = auth.get_auth_backend().authenticate()
+    ok = auth.authenticate()
     if cfg.has_option('auth', 'require_authentication'):
         require_auth = cfg.getboolean('auth', 'require_authentication')
     else:
@@ -306,6 +629,51 @@ def init_auth():
                                  "is required to use this service.")
 
 
+# Headers of the enclosing request which aren't passed on to subrequests;
+# they describe its own body, or make it conditional.
+_SUBREQUEST_SKIP_HEADERS = frozenset([
+    'content-length',
+    'content-type',
+    'if-match',
+    'if-none-match',
+    'if-modified-since',
+    'if-unmodified-since',
+])
+
+
+def subrequest(method, path, body=None, reuse_auth=False):
+    """Make a request to the API from within the current request.
+
+    The request is dispatched exactly like one from a client would be, with
+    the same routing, validation, authentication and error handling, and
+    with the same credentials as the current request. It runs inside the
+    current app context, so it shares `local` and the database session with
+    the caller.
+
+    `path` may include a query string. `body`, if not None, is encoded as
+    JSON and used as the body of the request.
+
+    If `reuse_auth` is true, the request is not authenticated again;
+    it has the access the current request was authenticated with. The
+    current request must already have been authenticated.
+
+    Returns the `flask.Response`. Its body has already been read, so a
+    streamed response may be used after this returns.
+    """
+    headers = [(name, value) for name, value in flask.request.headers
+               if name.lower() not in _SUBREQUEST_SKIP_HEADERS]
+    data = '' if body is None else json_dumps(body)
+    with app.test_request_context(path, method=method, data=data,
+                                  headers=headers):
+        local.reuse_auth = reuse_auth
+        try:
+            resp = app.full_dispatch_request()
+            resp.get_data()
+        finally:
+            local.reuse_auth = False
+    return resp
+
+
 def serve(port, debug=True):
     """Start an http server running the API.
 
@@ -1,9 +1,9 @@
 """Manage server-side startup"""
 import sys
 
-# api must be loaded to register the api callbacks, even though we don't
-# use it directly from this module.
-from hil import api  # pylint: disable=unused-import
+# api and layout must be loaded to register their api callbacks, even though
+# we don't use them directly from this module.
+from hil import api, layout  # pylint: disable=unused-import
 
 from hil import model, auth
 from hil.class_resolver import build_class_map_for
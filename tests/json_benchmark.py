@@ -0,0 +1,95 @@
+"""Benchmark for JSON encoding and decoding in `hil.rest`.
+
+Builds large payloads shaped like the responses to `list_networks` and
+`list_users`, then times encoding and decoding them with each JSON codec
+available: the standard library, plus ujson and simplejson if they are
+installed. Encoding is timed both for the whole document at once and for
+the streamed form returned by the list calls (`json_object`).
+
+This isn't a test; run it directly::
+
+    python tests/json_benchmark.py [number of items]
+"""
+
+import json
+import sys
+import timeit
+
+from hil import rest
+
+DEFAULT_SIZE = 10000
+NUMBER = 5
+
+
+def list_networks_payload(size):
+    """Return (key, value) pairs like those of a `list_networks` response."""
+    return [('net-%06d' % i, {'network_id': str(1000 + i % 3000),
+                              'projects': ['proj-%d' % (i % 50),
+                                           'proj-%d' % (i % 7)]})
+            for i in range(size)]
+
+
+def list_users_payload(size):
+    """Return (key, value) pairs like those of a `list_users` response."""
+    return [('user-%06d' % i, {'is_admin': i % 10 == 0,
+                               'projects': ['proj-%d' % j
+                                            for j in range(i % 5)]})
+            for i in range(size)]
+
+
+def codecs():
+    """Return a list of (name, dumps, loads) for each codec available."""
+    result = [('json', rest._stdlib_json_dumps, json.loads)]
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        result.append(('simplejson',
+                       lambda obj: simplejson.dumps(obj, sort_keys=True),
+                       simplejson.loads))
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        result.append(('ujson',
+                       lambda obj: ujson.dumps(obj, sort_keys=True,
+                                               escape_forward_slashes=False),
+                       ujson.loads))
+    return result
+
+
+def best_time(func):
+    """Return the fastest of `NUMBER` runs of `func`, in milliseconds."""
+    return min(timeit.repeat(func, number=1, repeat=NUMBER)) * 1e3
+
+
+def main():
+    """Run the benchmark, and print the results."""
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE
+    saved = rest._json_dumps, rest._json_loads
+    print('default codec: %s' % rest._json_dumps.__name__)
+    print('%-14s %-12s %6s %12s %12s %12s' % (
+        'payload', 'codec', 'works', 'dumps (ms)', 'stream (ms)',
+        'loads (ms)'))
+    try:
+        for name, payload in [('list_networks', list_networks_payload(size)),
+                              ('list_users', list_users_payload(size))]:
+            obj = dict(payload)
+            for codec, dumps, loads in codecs():
+                works = rest._json_codec_works(dumps, loads)
+                rest.set_json_codec(dumps, loads)
+                encoded = rest.json_dumps(obj)
+                dumps_ms = best_time(lambda: rest.json_dumps(obj))
+                stream_ms = best_time(
+                    lambda: rest.json_object(payload).read())
+                loads_ms = best_time(lambda: rest.json_loads(encoded))
+                print('%-14s %-12s %6s %12.1f %12.1f %12.1f' % (
+                    name, codec, works, dumps_ms, stream_ms, loads_ms))
+    finally:
+        rest.set_json_codec(*saved)
+
+
+if __name__ == '__main__':
+    main()
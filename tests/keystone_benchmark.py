@@ -0,0 +1,118 @@
+"""Benchmark for caching validated keystone tokens.
+
+Runs `hil.ext.auth.fake_keystone.FakeKeystone` on a local port, taking the
+given time to validate each token, and times requests to a trivial app
+behind keystonemiddleware: with keystonemiddleware's own cache disabled,
+with it enabled, and behind HIL's cache (`hil.ext.auth.keystone_cache`).
+The requests cycle through a number of tokens, as if from as many clients.
+
+This isn't a test, and needs keystonemiddleware; run it directly::
+
+    python tests/keystone_benchmark.py [requests] [latency in ms] [tokens]
+"""
+
+import sys
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+DEFAULT_REQUESTS = 1000
+DEFAULT_LATENCY_MS = 20
+DEFAULT_TOKENS = 10
+
+
+class QuietHandler(WSGIRequestHandler):
+    """A request handler which doesn't log every request."""
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        pass
+
+
+def serve(app):
+    """Serve `app` on a local port in the background; return its URL."""
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+def protected_app(environ, start_response):
+    """Stand in for HIL: respond with the request's identity status."""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ.get('HTTP_X_IDENTITY_STATUS', '')]
+
+
+def run(name, app, keystone, tokens, count):
+    """Make `count` requests to `app`, and report how long they took."""
+    client = Client(app, BaseResponse)
+    validations = keystone.validations
+    start = time.time()
+    for i in range(count):
+        resp = client.get('/', headers={'X-Auth-Token':
+                                        tokens[i % len(tokens)]})
+        assert resp.get_data() == 'Confirmed', resp.status
+    elapsed = time.time() - start
+    print '%-34s %8.3f ms/request %6d validations' % (
+        name, elapsed * 1000 / count, keystone.validations - validations)
+    if hasattr(app, 'hits'):
+        print '%-34s %8.1f%% hit rate' % (
+            '', 100.0 * app.hits / (app.hits + app.misses))
+
+
+def main():
+    """Run the benchmark."""
+    # Imported here, so pytest can collect this file without
+    # keystonemiddleware, and without loading extensions into the env of
+    # the tests:
+    from keystonemiddleware.auth_token import filter_factory
+    from hil.ext.auth.fake_keystone import FakeKeystone
+    from hil.ext.auth.keystone_cache import CachingAuthMiddleware, TokenCache
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REQUESTS
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_LATENCY_MS
+    ntokens = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_TOKENS
+
+    keystone = FakeKeystone(latency=latency / 1000.0)
+    keystone.add_project('service')
+    keystone.add_project('runway')
+    keystone.add_user('hil', 'secret', 'service', roles=['admin'])
+    tokens = []
+    for i in range(ntokens):
+        keystone.add_user('user-%d' % i, 'secret', 'runway', roles=['member'])
+        tokens.append(keystone.issue_token('user-%d' % i, 'secret'))
+
+    url = serve(keystone)
+    conf = {
+        'auth_type': 'password',
+        'auth_url': url + '/v3',
+        'www_authenticate_uri': url + '/v3',
+        'username': 'hil',
+        'password': 'secret',
+        'project_name': 'service',
+        'user_domain_id': 'default',
+        'project_domain_id': 'default',
+        'interface': 'public',
+    }
+    print '%d requests, %d tokens, %gms to validate a token' % (
+        count, ntokens, latency)
+    run('keystonemiddleware, no cache',
+        filter_factory(dict(conf, token_cache_time='-1'))(protected_app),
+        keystone, tokens, count)
+    run('keystonemiddleware, its own cache',
+        filter_factory(conf)(protected_app),
+        keystone, tokens, count)
+    run('keystonemiddleware, HIL cache',
+        CachingAuthMiddleware(protected_app,
+                              filter_factory(dict(conf,
+                                                  token_cache_time='-1')),
+                              TokenCache(1024, 60)),
+        keystone, tokens, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1529,7 +1529,7 @@ class Test_list_show_switch:
         This registers switches, checking the output of list_switches
         beforehand and in between.
         """
-        assert json.loads(api.list_switches()) == []
+        assert json.load(api.list_switches()) == []
 
         api.switch_register('sw0',
                             type=MOCK_SWITCH_TYPE,
@@ -1537,7 +1537,7 @@ class Test_list_show_switch:
                             password="bar",
                             hostname="baz")
         api.get_or_404(model.Switch, 'sw0')
-        assert json.loads(api.list_switches()) == ['sw0']
+        assert json.load(api.list_switches()) == ['sw0']
 
         api.switch_register('mock',
                             type=MOCK_SWITCH_TYPE,
@@ -1553,7 +1553,7 @@ class Test_list_show_switch:
                             hostname="switch")
 
         api.get_or_404(model.Switch, 'cirius')
-        assert json.loads(api.list_switches()) == [
+        assert json.load(api.list_switches()) == [
             'cirius',
             'mock',
             'sw0',
@@ -1747,7 +1747,7 @@ class TestQuery_populated_db:
         """Test list_networks."""
         auth = get_auth_backend()
         auth.set_admin(False)
-        user_result = json.loads(api.list_networks())
+        user_result = json.load(api.list_networks())
         for net in user_result.keys():
             del user_result[net]['network_id']
         assert user_result == {
@@ -1757,7 +1757,7 @@ class TestQuery_populated_db:
         }
         # Test against the Admin user
         auth.set_admin(True)
-        admin_result = json.loads(api.list_networks())
+        admin_result = json.load(api.list_networks())
         for net in admin_result.keys():
             del admin_result[net]['network_id']
         assert admin_result == {
@@ -1782,7 +1782,7 @@ class TestQuery_populated_db:
             'manhattan_node_0', 'boot-nic', 'manhattan_runway_pxe')
         deferred.apply_networking()
 
-        actual = json.loads(
+        actual = json.load(
             api.list_network_attachments('manhattan_runway_pxe'))
         expected = {
             'manhattan_node_0':
@@ -1812,7 +1812,7 @@ class TestQuery_populated_db:
             'manhattan_runway_pxe')
         deferred.apply_networking()
 
-        actual = json.loads(
+        actual = json.load(
             api.list_network_attachments('manhattan_runway_pxe', 'runway'))
         expected = {
             'runway_node_0':
@@ -1825,6 +1825,88 @@ class TestQuery_populated_db:
         assert actual == expected
 
 
+class TestLookupCache:
+    """Test the caching done by get_or_404 and friends."""
+
+    def _count_selects(self, f):
+        """Call ``f``, and return the number of SELECTs it made."""
+        from sqlalchemy import event
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            """Record each statement executed."""
+            statements.append(statement)
+
+        event.listen(model.db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            f()
+        finally:
+            event.remove(model.db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return len([s for s in statements
+                    if s.lstrip().upper().startswith('SELECT')])
+
+    def test_repeated_lookup(self):
+        """Looking the same objects up again doesn't query the database."""
+        new_node('robocop')
+        api.node_register_nic('robocop', 'eth0', 'DE:AD:BE:EF:20:14')
+        node = api.get_or_404(model.Node, 'robocop')
+        nic = api.get_child_or_404(node, model.Nic, 'eth0')
+
+        def lookups():
+            """Look the node and its nic up again."""
+            assert api.get_or_404(model.Node, 'robocop') is node
+            assert api.get_child_or_404(node, model.Nic, 'eth0') is nic
+            with pytest.raises(errors.DuplicateError):
+                api.absent_or_conflict(model.Node, 'robocop')
+        assert self._count_selects(lookups) == 0
+
+    def test_deleted_and_renamed(self):
+        """Deleted and renamed objects aren't found under their old names."""
+        api.project_create('anvil-nextgen')
+        api.project_create('runway')
+        api.get_or_404(model.Project, 'anvil-nextgen')
+        runway = api.get_or_404(model.Project, 'runway')
+
+        api.project_delete('anvil-nextgen')
+        with pytest.raises(errors.NotFoundError):
+            api.get_or_404(model.Project, 'anvil-nextgen')
+
+        runway.label = 'manhattan'
+        with pytest.raises(errors.NotFoundError):
+            api.get_or_404(model.Project, 'runway')
+        assert api.get_or_404(model.Project, 'manhattan') is runway
+
+    def test_label_id_cache(self):
+        """The cross-request cache remembers ids, and forgets them when
+        objects are deleted or renamed.
+        """
+        config_merge({'database': {'label_cache_size': '2'}})
+        api._label_ids.clear()
+        try:
+            for name in ['anvil-nextgen', 'runway', 'manhattan']:
+                api.project_create(name)
+                project = api.get_or_404(model.Project, name)
+                assert api._label_ids.get(model.Project, name) == project.id
+            # Only the two most recently used are kept:
+            assert api._label_ids.get(model.Project, 'anvil-nextgen') is None
+
+            project = api.get_or_404(model.Project, 'runway')
+            project.label = 'encom'
+            model.db.session.commit()
+            assert api._label_ids.get(model.Project, 'runway') is None
+            assert api.get_or_404(model.Project, 'encom') is project
+
+            api.project_delete('manhattan')
+            assert api._label_ids.get(model.Project, 'manhattan') is None
+            with pytest.raises(errors.NotFoundError):
+                api.get_or_404(model.Project, 'manhattan')
+        finally:
+            api._label_ids.clear()
+
+
 class TestQuery_unpopulated_db:
     """test portions of the query api with a fresh database"""
 
@@ -1855,7 +1937,7 @@ class TestQuery_unpopulated_db:
         new_node('master-control-program')
         new_node('robocop')
         new_node('data')
-        result = json.loads(api.list_nodes("free"))
+        result = json.load(api.list_nodes("free"))
         # For the lists to be equal, the ordering must be the same:
         result.sort()
         assert result == [
@@ -1866,29 +1948,123 @@ class TestQuery_unpopulated_db:
 
     def test_list_networks_none(self):
         """list_networks should return an empty list if the db is empty."""
-        assert json.loads(api.list_networks()) == {}
+        assert json.load(api.list_networks()) == {}
 
     def test_list_projects(self):
         """Add a few projects and check the output of list_projects
 
         Before, between, and after adding the projects.
         """
-        assert json.loads(api.list_projects()) == []
+        assert json.load(api.list_projects()) == []
         api.project_create('anvil-nextgen')
-        assert json.loads(api.list_projects()) == ['anvil-nextgen']
+        assert json.load(api.list_projects()) == ['anvil-nextgen']
         api.project_create('runway')
         api.project_create('manhattan')
-        assert sorted(json.loads(api.list_projects())) == [
+        assert sorted(json.load(api.list_projects())) == [
             'anvil-nextgen',
             'manhattan',
             'runway',
         ]
 
+    def test_list_pagination(self):
+        """The list calls return one page at a time when given a limit."""
+        for name in ['runway', 'manhattan', 'anvil-nextgen']:
+            api.project_create(name)
+            new_node('node-' + name)
+            api.switch_register('sw-' + name,
+                                type=MOCK_SWITCH_TYPE,
+                                username="switch_user",
+                                password="switch_pass",
+                                hostname="switchname")
+            network_create_simple('net-' + name, name)
+
+        for call in [api.list_projects,
+                     api.list_switches,
+                     lambda **kwargs: api.list_nodes('all', **kwargs)]:
+            everything = json.load(call())
+            assert everything == sorted(everything)
+            assert json.load(call(limit=2)) == everything[:2]
+            assert json.load(call(limit=2, after=everything[1])) == \
+                everything[2:]
+            assert json.load(call(after=everything[2])) == []
+
+        result = json.load(api.list_networks(limit=1, after='net-manhattan'))
+        assert result.keys() == ['net-runway']
+
+    def test_list_batches(self, monkeypatch):
+        """List calls return the same thing when they fetch their results
+        from the database in several batches.
+        """
+        monkeypatch.setattr(api, 'QUERY_BATCH_SIZE', 2)
+        for name in ['runway', 'manhattan', 'anvil-nextgen', 'encom', 'tron']:
+            api.project_create(name)
+        assert json.load(api.list_projects()) == [
+            'anvil-nextgen', 'encom', 'manhattan', 'runway', 'tron',
+        ]
+        assert json.load(api.list_projects(limit=3, after='encom')) == [
+            'manhattan', 'runway', 'tron',
+        ]
+
+    def test_list_nodes_filters(self):
+        """list_nodes narrows its results by project, switch and
+        metadata.
+        """
+        api.switch_register('sw0',
+                            type=MOCK_SWITCH_TYPE,
+                            username="switch_user",
+                            password="switch_pass",
+                            hostname="switchname")
+        api.switch_register_port('sw0', PORTS[0])
+        api.project_create('anvil-nextgen')
+        for name in ['robocop', 'data', 'master-control-program']:
+            new_node(name)
+        api.project_connect_node('anvil-nextgen', 'robocop')
+        api.project_connect_node('anvil-nextgen', 'data')
+        api.node_register_nic('data', 'eth0', 'DE:AD:BE:EF:20:14')
+        api.port_connect_nic('sw0', PORTS[0], 'data', 'eth0')
+        api.node_set_metadata('robocop', 'EK', 'pk')
+        api.node_set_metadata('master-control-program', 'EK', 'other')
+
+        def list_nodes(**kwargs):
+            """Call list_nodes('all') with the given filters."""
+            return json.load(api.list_nodes('all', **kwargs))
+
+        assert list_nodes(project='anvil-nextgen') == ['data', 'robocop']
+        assert json.load(api.list_nodes('free', project='anvil-nextgen')) \
+            == []
+        assert list_nodes(switch='sw0') == ['data']
+        assert list_nodes(metadata_key='EK') == \
+            ['master-control-program', 'robocop']
+        assert list_nodes(metadata_key='EK', metadata_value='pk') == \
+            ['robocop']
+        with pytest.raises(errors.BadArgumentError):
+            list_nodes(metadata_value='pk')
+        with pytest.raises(errors.NotFoundError):
+            list_nodes(switch='sw1')
+
+    def test_list_networks_project(self):
+        """list_networks can be limited to the networks a project can
+        access, which include the public ones.
+        """
+        api.project_create('anvil-nextgen')
+        api.project_create('runway')
+        network_create_simple('hammernet', 'anvil-nextgen')
+        network_create_simple('spiderwebs', 'runway')
+        api.network_grant_project_access('anvil-nextgen', 'spiderwebs')
+
+        api.network_create('pubnet', 'admin', '', '')
+
+        result = json.load(api.list_networks(project='anvil-nextgen'))
+        assert sorted(result.keys()) == ['hammernet', 'pubnet', 'spiderwebs']
+        result = json.load(api.list_networks(project='runway'))
+        assert sorted(result.keys()) == ['pubnet', 'spiderwebs']
+        assert result['pubnet']['projects'] is None
+
     def test_no_free_nodes(self):
         """
         list_nodes('free') should return an empty list if the db is empty.
         """
-        assert json.loads(api.list_nodes("free")) == []
+        assert json.load(api.list_nodes("free")) == []
 
     def test_some_non_free_nodes(self):
         """Make sure that allocated nodes don't show up in the free list."""
@@ -1900,7 +2076,7 @@ class TestQuery_unpopulated_db:
         api.project_connect_node('anvil-nextgen', 'robocop')
         api.project_connect_node('anvil-nextgen', 'data')
 
-        assert json.loads(api.list_nodes("free")) == ['master-control-program']
+        assert json.load(api.list_nodes("free")) == ['master-control-program']
 
     def test_show_node(self):
         """Test the show_node api call.
@@ -2032,6 +2208,160 @@ class TestQuery_unpopulated_db:
         }
         self._compare_node_dumps(actual, expected)
 
+    def test_show_node_query_count(self):
+        """The number of queries show_node makes doesn't grow with the
+        number of nics, ports and networks.
+        """
+        from sqlalchemy import event
+
+        api.switch_register('sw0',
+                            type=MOCK_SWITCH_TYPE,
+                            username="switch_user",
+                            password="switch_pass",
+                            hostname="switchname")
+        api.project_create('anvil-nextgen')
+        network_create_simple('pxe', 'anvil-nextgen')
+
+        def count_selects(nodename, num_nics, first_port):
+            """Register a node with ``num_nics`` nics, each on a port and
+            connected to a network, and return the number of SELECTs
+            show_node makes for it.
+            """
+            new_node(nodename)
+            api.project_connect_node('anvil-nextgen', nodename)
+            api.node_set_metadata(nodename, 'EK', 'pk')
+            for i in range(num_nics):
+                nic = 'eth%d' % i
+                port = 'gi1/0/%d' % (first_port + i)
+                api.node_register_nic(nodename, nic, 'DE:AD:BE:EF:20:14')
+                api.switch_register_port('sw0', port)
+                api.port_connect_nic('sw0', port, nodename, nic)
+                api.node_connect_network(nodename, nic, 'pxe')
+            deferred.apply_networking()
+            model.db.session.expunge_all()
+
+            statements = []
+
+            def before_cursor_execute(conn, cursor, statement, *args):
+                """Record each statement executed."""
+                statements.append(statement)
+
+            event.listen(model.db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            try:
+                result = json.loads(api.show_node(nodename))
+            finally:
+                event.remove(model.db.engine, 'before_cursor_execute',
+                             before_cursor_execute)
+            assert len(result['nics']) == num_nics
+            return len([s for s in statements
+                        if s.lstrip().upper().startswith('SELECT')])
+
+        assert count_selects('robocop', 1, 0) == \
+            count_selects('data', 6, 1)
+
+    def test_list_nodes_detail(self):
+        """list_nodes_detail reports the same thing as show_node for each
+        node, and honours its filters.
+        """
+        api.switch_register('sw0',
+                            type=MOCK_SWITCH_TYPE,
+                            username="switch_user",
+                            password="switch_pass",
+                            hostname="switchname")
+        api.switch_register_port('sw0', PORTS[0])
+        new_node('robocop')
+        new_node('data')
+        new_node('master-control-program')
+        api.node_register_nic('robocop', 'eth0', 'DE:AD:BE:EF:20:14')
+        api.node_set_metadata('data', 'EK', 'pk')
+        api.project_create('anvil-nextgen')
+        api.project_create('encom')
+        api.project_connect_node('anvil-nextgen', 'robocop')
+        api.project_connect_node('encom', 'master-control-program')
+        network_create_simple('pxe', 'anvil-nextgen')
+        api.port_connect_nic('sw0', PORTS[0], 'robocop', 'eth0')
+        api.node_connect_network('robocop', 'eth0', 'pxe')
+        deferred.apply_networking()
+
+        names = ['robocop', 'data', 'master-control-program']
+        result = json.load(api.list_nodes_detail())
+        assert result == {name: json.loads(api.show_node(name))
+                          for name in names}
+
+        result = json.load(api.list_nodes_detail(project='anvil-nextgen'))
+        assert result.keys() == ['robocop']
+        result = json.load(api.list_nodes_detail(free=True))
+        assert result.keys() == ['data']
+        with pytest.raises(errors.BadArgumentError):
+            api.list_nodes_detail(project='anvil-nextgen', free=True)
+        with pytest.raises(errors.NotFoundError):
+            api.list_nodes_detail(project='fsociety')
+
+        # A project member only sees its own and free nodes, without
+        # port or switch information:
+        auth = get_auth_backend()
+        auth.set_project(api.get_or_404(model.Project, 'anvil-nextgen'))
+        auth.set_admin(False)
+        result = json.load(api.list_nodes_detail())
+        assert sorted(result.keys()) == ['data', 'robocop']
+        assert result['robocop'] == json.loads(api.show_node('robocop'))
+        assert 'port' not in result['robocop']['nics'][0]
+        with pytest.raises(errors.AuthorizationError):
+            api.list_nodes_detail(project='encom')
+
+    def test_list_nodes_detail_query_count(self):
+        """The number of queries list_nodes_detail makes doesn't grow with
+        the number of nodes.
+        """
+        from sqlalchemy import event
+
+        api.switch_register('sw0',
+                            type=MOCK_SWITCH_TYPE,
+                            username="switch_user",
+                            password="switch_pass",
+                            hostname="switchname")
+        api.project_create('anvil-nextgen')
+        network_create_simple('pxe', 'anvil-nextgen')
+
+        def count_selects(num_nodes):
+            """Register ``num_nodes`` more nodes, each with a nic on a port
+            connected to a network, and return the number of SELECTs
+            list_nodes_detail makes.
+            """
+            for _ in range(num_nodes):
+                n = len(model.Node.query.all())
+                nodename = 'node-%d' % n
+                port = 'gi1/0/%d' % n
+                new_node(nodename)
+                api.project_connect_node('anvil-nextgen', nodename)
+                api.node_set_metadata(nodename, 'EK', 'pk')
+                api.node_register_nic(nodename, 'eth0', 'DE:AD:BE:EF:20:14')
+                api.switch_register_port('sw0', port)
+                api.port_connect_nic('sw0', port, nodename, 'eth0')
+                api.node_connect_network(nodename, 'eth0', 'pxe')
+            deferred.apply_networking()
+            model.db.session.expunge_all()
+
+            statements = []
+
+            def before_cursor_execute(conn, cursor, statement, *args):
+                """Record each statement executed."""
+                statements.append(statement)
+
+            event.listen(model.db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            try:
+                result = json.load(api.list_nodes_detail())
+            finally:
+                event.remove(model.db.engine, 'before_cursor_execute',
+                             before_cursor_execute)
+            assert len(result) == len(model.Node.query.all())
+            return len([s for s in statements
+                        if s.lstrip().upper().startswith('SELECT')])
+
+        assert count_selects(1) == count_selects(5)
+
     def test_show_nonexistent_node(self):
         """Showing a node that does not exist should raise not found."""
         with pytest.raises(errors.NotFoundError):
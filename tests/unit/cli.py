@@ -87,6 +87,19 @@ def test_serve_networks():
     assert runs_for_seconds(['hil', 'serve_networks'], seconds=1)
 
 
+def test_serve_networks_cleans_up():
+    """Check that hil serve_networks removes its notification socket when
+    it is interrupted.
+    """
+    check_call(['hil-admin', 'db', 'create'])
+    proc = Popen(['hil', 'serve_networks'])
+    sleep(1)
+    assert os.path.exists('hil.db.sock')
+    proc.send_signal(signal.SIGINT)
+    proc.wait()
+    assert not os.path.exists('hil.db.sock')
+
+
 @pytest.mark.parametrize('command', [
     ['hil', 'serve', '5000'],
     ['hil', 'serve_networks'],
@@ -1,15 +1,18 @@
 """Unit tests for client library"""
 from hil.flaskapp import app
-from hil.client.base import ClientBase, FailedAPICallException
+from hil.client.base import ClientBase, FailedAPICallException, \
+    DEFAULT_CACHE_SIZE
 from hil.errors import BadArgumentError, UnknownSubtypeError
-from hil.client.client import Client, HTTPClient, HTTPResponse
+from hil.client.client import Client, HTTPClient, HTTPResponse, \
+    RequestsHTTPClient
 from hil.test_common import config_testsuite, config_merge, \
     fresh_database, fail_on_log_warnings, server_init, uuid_pattern
 from hil.model import db
-from hil import config, deferred
+from hil import config, deferred, model
 
 import json
 import pytest
+import requests
 
 from urlparse import urlparse
 from base64 import urlsafe_b64encode
@@ -26,15 +29,16 @@ class FlaskHTTPClient(HTTPClient):
     def __init__(self):
         self._flask_client = app.test_client()
 
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
 
         # Flask doesn't provide a straightforward way to do basic auth,
         # but it's not actually that complicated:
         auth_header = 'Basic ' + urlsafe_b64encode(username + ':' + password)
+        headers = dict(headers or {}, Authorization=auth_header)
 
         resp = self._flask_client.open(
             method=method,
-            headers={'Authorization': auth_header},
+            headers=headers,
             # flask expects just a path, and assumes
             # the host & scheme:
             path=urlparse(url).path,
@@ -278,6 +282,33 @@ class Test_ClientBase:
         y = x.object_url('abc', '123', 'xy23z')
         assert y == 'http://127.0.0.1:8000/abc/123/xy23z'
 
+    @pytest.mark.parametrize('pages', [
+        # As the server might order them with a case-insensitive collation:
+        ['["alpha", "Bravo"]', '["charlie", "Delta"]', '[]'],
+        ['{"alpha": 1, "Bravo": 2}', '{"charlie": 3, "Delta": 4}', '{}'],
+    ])
+    def test_paginate_server_order(self, pages):
+        """Pages are followed on from the server's last result.
+
+        That isn't necessarily the last one in Python's order.
+        """
+        afters = []
+
+        class PagingHTTPClient(HTTPClient):
+            """Serves `pages`, recording the `after` parameter of each."""
+
+            def request(self, method, url, data=None, params=None,
+                        headers=None):
+                afters.append(params.get('after'))
+                return HTTPResponse(status_code=200, headers={},
+                                    content=pages[len(afters) - 1])
+
+        results = list(ClientBase(ep, PagingHTTPClient())
+                       .paginate(ep + '/things', page_size=2))
+        assert afters == [None, 'Bravo', 'Delta']
+        assert [r[0] if isinstance(r, tuple) else r for r in results] == \
+            ['alpha', 'Bravo', 'charlie', 'Delta']
+
 
 class Test_node:
     """ Tests Node related client calls. """
@@ -295,6 +326,12 @@ class Test_node:
                 u'node-06', u'node-07', u'node-08', u'node-09'
                 ]
 
+    def test_iterate_nodes(self):
+        """Iterating over nodes fetches them all, a page at a time."""
+        assert list(C.node.iterate(page_size=2)) == C.node.list('all')
+        assert list(C.node.iterate('free', page_size=3)) == \
+            C.node.list('free')
+
     def test_node_register(self):
         """Test node_register"""
         assert C.node.register("dummy-node-01", "mock",
@@ -326,6 +363,43 @@ class Test_node:
                 u'name': u'node-07'
                 }
 
+    def test_show_node_not_modified(self):
+        """Showing a node again revalidates the earlier response."""
+        statuses = []
+
+        class RecordingHTTPClient(HTTPClient):
+            """Records the status of each response."""
+
+            def request(self, method, url, data=None, params=None,
+                        headers=None):
+                resp = http_client.request(method, url, data=data,
+                                           params=params, headers=headers)
+                statuses.append(resp.status_code)
+                return resp
+
+        node = Client(ep, RecordingHTTPClient(),
+                      cache_size=DEFAULT_CACHE_SIZE).node
+        first = node.show('node-07')
+        assert node.show('node-07') == first
+        assert statuses == [200, 304]
+        node.metadata_set('node-07', 'EK', 'pk')
+        assert node.show('node-07') != first
+        assert statuses == [200, 304, 200, 200]
+
+    def test_show_node_plain_http_client(self):
+        """By default, HTTPClients needn't support extra headers."""
+
+        class PlainHTTPClient(HTTPClient):
+            """An HTTPClient written before `headers` was added."""
+
+            def request(self, method, url, data=None, params=None):
+                # pylint: disable=arguments-differ
+                return http_client.request(method, url, data=data,
+                                           params=params)
+
+        node = Client(ep, PlainHTTPClient()).node
+        assert node.show('node-07') == node.show('node-07')
+
     def test_show_node_reserved_chars(self):
         """ test for catching illegal argument characters"""
         with pytest.raises(BadArgumentError):
@@ -610,6 +684,10 @@ class Test_switch:
                 u'brocade-01', u'dell-01', u'mock-01', u'nexus-01'
                 ]
 
+    def test_iterate_switches(self):
+        """Iterating over switches fetches them all, a page at a time."""
+        assert list(C.switch.iterate(page_size=3)) == C.switch.list()
+
     def test_show_switch(self):
         """(successful) call to show_switch"""
         assert C.switch.show('dell-01') == {
@@ -788,6 +866,26 @@ class Test_user:
         assert C.user.create('billy', 'pass1234', is_admin=True) is None
         assert C.user.create('bobby', 'pass1234', is_admin=False) is None
 
+    def test_etag_covers_access(self):
+        """Removing a user from a project invalidates their ETags.
+
+        Otherwise they could keep confirming that their copy of one of the
+        project's resources is current, without having access to it.
+        """
+        C.user.create('carl', 'pass1234', is_admin=False)
+        C.user.add('carl', 'proj-01')
+        client = app.test_client()
+        headers = {'Authorization':
+                   'Basic ' + urlsafe_b64encode('carl:pass1234')}
+        resp = client.get('/network/net-01', headers=headers)
+        assert resp.status_code == 200
+        headers['If-None-Match'] = resp.headers['ETag']
+        assert client.get('/network/net-01', headers=headers).status_code \
+            == 304
+        C.user.remove('carl', 'proj-01')
+        assert client.get('/network/net-01', headers=headers).status_code \
+            == 401
+
     def test_user_create_duplicate(self):
         """ Test duplicate user creation. """
         C.user.create('bill', 'pass1234', is_admin=False)
@@ -897,6 +995,11 @@ class Test_network:
                 u'net-05': {u'network_id': u'1005', u'projects': [u'proj-02']}
                 }
 
+    def test_iterate_networks(self):
+        """Iterating over networks yields (name, attributes) pairs."""
+        assert list(C.network.iterate(page_size=2)) == \
+            sorted(C.network.list().items())
+
     def test_list_network_attachments(self):
         """ Test list of network attachments """
         assert C.network.list_network_attachments("net-01", "all") == {}
@@ -1012,6 +1115,90 @@ class Test_extensions:
                 ]
 
 
+class Test_batch:
+    """Tests making several api calls in one request."""
+
+    def test_batch(self):
+        """Each call in a batch is made, and its response reported."""
+        results = C.batch.run([
+            ('PUT', '/project/proj-batch', None),
+            ('POST', '/project/proj-batch/connect_node',
+             {'node': 'node-06'}),
+            ('GET', '/project/proj-batch/nodes', None),
+            ('GET', '/node/node-99', None),
+            ('GET', '/nodes/free?limit=2', None),
+        ])
+        assert [r.status_code for r in results] == [200, 200, 200, 404, 200]
+        assert C.batch.check_response(results[2]) == ['node-06']
+        with pytest.raises(FailedAPICallException):
+            C.batch.check_response(results[3])
+        assert C.batch.check_response(results[4]) == ['node-07', 'node-08']
+        assert C.project.nodes_in('proj-batch') == ['node-06']
+
+    def test_batch_keeps_going(self):
+        """A failed call doesn't stop a batch that isn't atomic, and
+        doesn't undo the calls before it.
+        """
+        results = C.batch.run([
+            ('PUT', '/project/proj-batch', None),
+            ('PUT', '/project/proj-batch', None),
+            ('PUT', '/project/proj-batch2', None),
+        ])
+        assert [r.status_code for r in results] == [200, 409, 200]
+        assert {'proj-batch', 'proj-batch2'} <= set(C.project.list())
+
+    def test_batch_atomic(self):
+        """An atomic batch takes effect all at once, or not at all."""
+        results = C.batch.run([
+            ('PUT', '/project/proj-batch', None),
+            ('POST', '/project/proj-batch/connect_node',
+             {'node': 'node-06'}),
+            ('POST', '/project/proj-batch/connect_node',
+             {'node': 'node-99'}),
+            ('PUT', '/project/proj-batch2', None),
+        ], atomic=True)
+        assert [r.status_code for r in results] == [200, 200, 404]
+        assert 'proj-batch' not in C.project.list()
+        assert 'proj-batch2' not in C.project.list()
+        assert C.node.show('node-06')['project'] is None
+
+        results = C.batch.run([
+            ('PUT', '/project/proj-batch', None),
+            ('POST', '/project/proj-batch/connect_node',
+             {'node': 'node-06'}),
+        ], atomic=True)
+        assert [r.status_code for r in results] == [200, 200]
+        assert C.project.nodes_in('proj-batch') == ['node-06']
+
+    def test_batch_authenticates_once(self, monkeypatch):
+        """The calls in a batch aren't authenticated again."""
+        from hil import auth
+        authenticate = auth.authenticate
+        calls = []
+
+        def counting_authenticate():
+            """Count the calls to auth.authenticate."""
+            calls.append(None)
+            return authenticate()
+
+        monkeypatch.setattr(auth, 'authenticate', counting_authenticate)
+        results = C.batch.run([
+            ('PUT', '/project/proj-batch', None),
+            ('GET', '/project/proj-batch/nodes', None),
+        ])
+        assert [r.status_code for r in results] == [200, 200]
+        assert len(calls) == 1
+
+    def test_batch_not_nested(self):
+        """Batches can't be nested."""
+        results = C.batch.run([
+            ('POST', '/batch', {'calls': [{'method': 'PUT',
+                                           'path': '/project/proj-batch'}]}),
+        ])
+        assert [r.status_code for r in results] == [400]
+        assert 'proj-batch' not in C.project.list()
+
+
 class TestShowNetworkingAction:
     """Test calls to show networking action method"""
 
@@ -1038,3 +1225,119 @@ class TestShowNetworkingAction:
         """(unsuccessful) call to show_networking_action"""
         with pytest.raises(FailedAPICallException):
             C.node.show_networking_action('non-existent-entry')
+
+
+@pytest.fixture
+def flask_requests(monkeypatch):
+    """Send requests made with `requests.Session` to the flask app.
+
+    Returns a list, to which the method, path and authorization scheme of
+    each request are appended.
+    """
+    flask_client = app.test_client()
+    sent = []
+
+    # pylint: disable=too-many-arguments
+    def request(session, method, url, data=None, params=None, headers=None,
+                auth=None):
+        """Make the request with flask's test client."""
+        prepared = requests.Request(method, url,
+                                    headers=dict(session.headers,
+                                                 **(headers or {})),
+                                    auth=auth or session.auth).prepare()
+        sent.append((method, urlparse(url).path,
+                     prepared.headers['Authorization'].split()[0]))
+        resp = flask_client.open(method=method,
+                                 path=urlparse(url).path,
+                                 headers=dict(prepared.headers),
+                                 data=data,
+                                 query_string=params)
+        result = requests.Response()
+        result.status_code = resp.status_code
+        result.headers = resp.headers
+        result._content = resp.get_data()
+        return result
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+    return sent
+
+
+@pytest.mark.usefixtures('flask_requests')
+class Test_token_client:
+    """Tests RequestsHTTPClient's use of bearer tokens."""
+
+    def _client(self, token_url=ep + '/auth/token'):
+        """Return a client library instance which uses tokens."""
+        token_client = RequestsHTTPClient(token_url=token_url)
+        token_client.auth = (username, password)
+        return Client(ep, token_client), token_client
+
+    def test_token_reused(self, flask_requests):
+        """The credentials are exchanged for a token once, up front."""
+        client, _ = self._client()
+        client.project.list()
+        client.project.list()
+        assert flask_requests == [
+            ('POST', '/auth/token', 'Basic'),
+            ('GET', '/projects', 'Bearer'),
+            ('GET', '/projects', 'Bearer'),
+        ]
+
+    def test_token_refreshed(self, flask_requests):
+        """A new token is obtained when the old one is about to expire."""
+        client, token_client = self._client()
+        client.project.list()
+        token_client._token_refresh = 0
+        client.project.list()
+        assert [req[1] for req in flask_requests] == \
+            ['/auth/token', '/projects', '/auth/token', '/projects']
+
+    def test_token_forgotten(self, flask_requests):
+        """If the server refuses a token, a new one is obtained."""
+        client, _ = self._client()
+        client.project.list()
+        with app.app_context():
+            model.AuthToken.query.delete()
+            db.session.commit()
+        assert 'proj-01' in client.project.list()
+        assert [req[1] for req in flask_requests] == \
+            ['/auth/token', '/projects', '/projects', '/auth/token',
+             '/projects']
+
+    def test_no_token(self, flask_requests):
+        """If no token can be obtained, the credentials are used instead."""
+        client, _ = self._client(token_url=ep + '/no/such/call')
+        client.project.list()
+        client.project.list()
+        assert flask_requests == [
+            ('POST', '/no/such/call', 'Basic'),
+            ('GET', '/projects', 'Basic'),
+            ('GET', '/projects', 'Basic'),
+        ]
+
+    def test_token_transient_failure(self, flask_requests, monkeypatch):
+        """If obtaining a token fails for some other reason than the server
+        not issuing them, the credentials are used for that request only.
+        """
+        from hil import api
+        from hil.errors import ServerError
+        issue_token = api.issue_token
+        failures = []
+
+        def failing_issue_token():
+            """Fail the first time; then issue tokens as usual."""
+            if not failures:
+                failures.append(None)
+                raise ServerError('Try again later.')
+            return issue_token()
+
+        monkeypatch.setattr(api, 'issue_token', failing_issue_token)
+        client, _ = self._client()
+        client.project.list()
+        client.project.list()
+        assert flask_requests == [
+            ('POST', '/auth/token', 'Basic'),
+            ('GET', '/projects', 'Basic'),
+            ('POST', '/auth/token', 'Basic'),
+            ('GET', '/projects', 'Bearer'),
+        ]
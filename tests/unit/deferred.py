@@ -4,6 +4,8 @@ import pytest
 import tempfile
 import uuid
 
+from datetime import datetime, timedelta
+
 from hil import config, deferred, model, api
 from hil.model import db, Switch
 from hil.errors import SwitchError
@@ -11,6 +13,7 @@ from hil.test_common import config_testsuite, config_merge, \
                              fresh_database
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 fresh_database = pytest.fixture(fresh_database)
 
@@ -46,7 +49,8 @@ def configure():
 
     additional_config = {
         'extensions': {
-            'hil.ext.obm.mock': ''
+            'hil.ext.obm.mock': '',
+            'hil.ext.switches.mock': '',
             }
         }
 
@@ -304,3 +308,392 @@ def test_apply_networking(switch, network, fresh_database):
 
     local_db.session.commit()
     local_db.session.close()
+
+
+def test_apply_networking_workers(network, fresh_database):
+    """Test that apply_networking applies actions across several switches
+    when given more than one worker.
+    """
+    from hil.ext.switches.mock import MockSwitch, LOCAL_STATE
+
+    switches = [MockSwitch(label='sw%d' % i,
+                           hostname='switch-%d.example.com' % i,
+                           username='admin',
+                           password='admin',
+                           type=MockSwitch.api_name)
+                for i in range(3)]
+    for i, sw in enumerate(switches):
+        for j in range(2):
+            nic = new_nic('nic-%d-%d' % (i, j))
+            nic.port = model.Port(label='gi1/0/%d' % j, switch=sw)
+            db.session.add(model.NetworkingAction(nic=nic,
+                                                  new_network=network,
+                                                  channel='vlan/native',
+                                                  type='modify_port',
+                                                  uuid=str(uuid.uuid4()),
+                                                  status='PENDING'))
+    db.session.commit()
+
+    assert deferred.apply_networking(workers=2)
+    db.session.close()
+
+    assert model.NetworkingAction.query \
+        .filter_by(status='DONE').count() == 6
+    assert model.NetworkAttachment.query.count() == 6
+    for i in range(3):
+        for j in range(2):
+            assert LOCAL_STATE['sw%d' % i]['gi1/0/%d' % j] == \
+                {'vlan/native': '102'}
+
+    # The journal is now empty:
+    assert not deferred.apply_networking(workers=2)
+
+
+def test_apply_networking_claims(switch, network, fresh_database):
+    """Test that daemons don't apply actions claimed by another daemon,
+    unless the other daemon's lease has expired.
+    """
+    nic = new_nic('0')
+    nic.port = model.Port(label='gi1/0/0', switch=switch)
+    db.session.add(model.NetworkingAction(nic=nic,
+                                          new_network=network,
+                                          channel='vlan/native',
+                                          type='modify_port',
+                                          uuid=str(uuid.uuid4()),
+                                          status='PENDING'))
+    db.session.commit()
+
+    # Another daemon claims the action, and then goes away:
+    assert len(deferred._claim_pending_actions('other-daemon', 300)) == 1
+    assert not deferred.apply_networking(daemon_id='this-daemon')
+
+    action = model.NetworkingAction.query.one()
+    assert action.status == 'PENDING'
+    assert action.claimed_by == 'other-daemon'
+
+    # Once the lease expires, the action is up for grabs again:
+    action.lease_expiry = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert deferred.apply_networking(daemon_id='this-daemon')
+    db.session.close()
+
+    action = model.NetworkingAction.query.one()
+    assert action.status == 'DONE'
+    assert action.claimed_by == 'this-daemon'
+
+
+@pytest.mark.parametrize('name,version,expected', [
+    ('postgresql', (9, 3, 25), False),
+    ('postgresql', (9, 5), True),
+    ('postgresql', (10, 4), True),
+    ('sqlite', (3, 22, 0), False),
+])
+def test_supports_skip_locked(name, version, expected):
+    """SKIP LOCKED is only used where the database supports it."""
+    class FakeDialect(object):
+        """Just enough of a dialect for _supports_skip_locked."""
+        server_version_info = version
+    FakeDialect.name = name
+    assert deferred._supports_skip_locked(FakeDialect()) is expected
+
+
+def test_apply_networking_query_count(network, fresh_database):
+    """Test that the number of queries apply_networking makes to load the
+    journal doesn't grow with the number of actions.
+    """
+    from hil.ext.switches.mock import MockSwitch
+
+    sw = MockSwitch(label='sw0',
+                    hostname='switch.example.com',
+                    username='admin',
+                    password='admin',
+                    type=MockSwitch.api_name)
+
+    def count_selects(num_actions):
+        """Queue ``num_actions`` actions, and return the number of SELECTs
+        apply_networking needs to apply them all.
+        """
+        for _ in range(num_actions):
+            nic = new_nic(str(uuid.uuid4()))
+            nic.port = model.Port(label=str(uuid.uuid4()), switch=sw)
+            db.session.add(model.NetworkingAction(nic=nic,
+                                                  new_network=network,
+                                                  channel='vlan/native',
+                                                  type='modify_port',
+                                                  uuid=str(uuid.uuid4()),
+                                                  status='PENDING'))
+        db.session.commit()
+        db.session.close()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            """Record each statement executed."""
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            assert deferred.apply_networking()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        db.session.close()
+        return len([s for s in statements
+                    if s.lstrip().upper().startswith('SELECT')])
+
+    assert count_selects(2) == count_selects(10)
+    assert model.NetworkingAction.query.filter_by(status='DONE').count() == 12
+
+
+def test_apply_networking_coalesce(network, fresh_database, monkeypatch):
+    """Test that actions superseded by later actions in the journal are
+    marked done without being sent to the switch.
+    """
+    from hil.ext.switches.mock import MockSwitch
+
+    calls = []
+    monkeypatch.setattr(MockSwitch, 'modify_port',
+                        lambda self, port, channel, network_id:
+                        calls.append(('modify_port', port, channel,
+                                      network_id)))
+    monkeypatch.setattr(MockSwitch, 'revert_port',
+                        lambda self, port: calls.append(('revert_port', port)))
+
+    sw = MockSwitch(label='sw0',
+                    hostname='switch.example.com',
+                    username='admin',
+                    password='admin',
+                    type=MockSwitch.api_name)
+    nics = []
+    for i in range(3):
+        nic = new_nic(str(i))
+        nic.port = model.Port(label='gi1/0/%d' % i, switch=sw)
+        nics.append(nic)
+
+    db.session.add_all(nics)
+    db.session.flush()
+
+    def queue(nic, type, new_network=None, channel='vlan/native'):
+        """Queue a networking action.
+
+        The api only ever queues one action per nic at a time, and
+        ``Nic.current_action`` assumes as much, so we set ``nic_id``
+        directly rather than going through the relationship.
+        """
+        db.session.add(model.NetworkingAction(nic_id=nic.id,
+                                              new_network=new_network,
+                                              channel=channel,
+                                              type=type,
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+        db.session.flush()
+
+    # Connected and then detached again; nothing to do:
+    queue(nics[0], 'modify_port', network)
+    queue(nics[0], 'modify_port', None)
+    # Several modifications, followed by a revert; just revert:
+    queue(nics[1], 'modify_port', network)
+    queue(nics[1], 'modify_port', network, 'vlan/102')
+    queue(nics[1], 'revert_port', None, '')
+    # Detached and then connected elsewhere; just connect:
+    queue(nics[2], 'modify_port', None)
+    queue(nics[2], 'modify_port', network)
+    db.session.commit()
+
+    assert deferred.apply_networking()
+    db.session.close()
+
+    assert calls == [
+        ('revert_port', 'gi1/0/1'),
+        ('modify_port', 'gi1/0/2', 'vlan/native', '102'),
+    ]
+    assert model.NetworkingAction.query \
+        .filter_by(status='DONE').count() == 7
+    attachments = model.NetworkAttachment.query.all()
+    assert [(a.nic.label, a.channel) for a in attachments] == \
+        [('2', 'vlan/native')]
+
+
+class _PoolTestSession(object):
+    """A switch session for testing deferred.SessionPool.
+
+    Records what the pool does with it, in ``events``.
+    """
+
+    def __init__(self, switch, alive=True, reusable=True):
+        self.switch = switch
+        self.alive = alive
+        self.reusable = reusable
+        self.events = []
+
+    def release(self):
+        """Implement SwitchSession.release."""
+        self.events.append('release')
+        return self.reusable
+
+    def reuse(self, switch):
+        """Implement SwitchSession.reuse."""
+        self.events.append('reuse')
+        self.switch = switch
+        return self.alive
+
+    def disconnect(self):
+        """Implement SwitchSession.disconnect."""
+        self.events.append('disconnect')
+
+
+class _PoolTestSwitch(object):
+    """Stands in for a switch, as far as deferred.SessionPool cares."""
+
+    def __init__(self, label, **kwargs):
+        self.label = label
+        self.kwargs = kwargs
+        self.sessions = []
+
+    def session(self):
+        """Return a new _PoolTestSession."""
+        session = _PoolTestSession(self, **self.kwargs)
+        self.sessions.append(session)
+        return session
+
+
+def test_session_pool_reuse():
+    """Sessions are reused across batches, rather than reopened."""
+    pool = deferred.SessionPool()
+    switch = _PoolTestSwitch('sw0')
+    for _ in range(3):
+        session = pool.get(switch)
+        pool.put(switch.label, session)
+    assert len(switch.sessions) == 1
+    assert switch.sessions[0].events == \
+        ['release', 'reuse', 'release', 'reuse', 'release']
+
+    pool.close()
+    assert switch.sessions[0].events[-1] == 'disconnect'
+
+
+def test_session_pool_dead_session():
+    """Sessions which fail their health check are replaced."""
+    pool = deferred.SessionPool()
+    switch = _PoolTestSwitch('sw0', alive=False)
+    pool.put(switch.label, pool.get(switch))
+    pool.put(switch.label, pool.get(switch))
+    assert len(switch.sessions) == 2
+    assert switch.sessions[0].events == ['release', 'reuse', 'disconnect']
+
+
+def test_session_pool_not_reusable():
+    """Sessions which can't be reused are disconnected straight away."""
+    pool = deferred.SessionPool()
+    switch = _PoolTestSwitch('sw0', reusable=False)
+    pool.put(switch.label, pool.get(switch))
+    assert switch.sessions[0].events == ['release', 'disconnect']
+
+
+def test_session_pool_expiry():
+    """Sessions are closed once they are idle or old enough."""
+    switch = _PoolTestSwitch('sw0')
+
+    pool = deferred.SessionPool(idle_timeout=0)
+    pool.put(switch.label, pool.get(switch))
+    pool.reap()
+    assert switch.sessions[0].events == ['release', 'disconnect']
+
+    pool = deferred.SessionPool(max_age=0)
+    pool.put(switch.label, pool.get(switch))
+    pool.put(switch.label, pool.get(switch))
+    assert len(switch.sessions) == 3
+    assert switch.sessions[1].events == ['release', 'disconnect']
+
+
+def test_apply_networking_session_pool(network, fresh_database, monkeypatch):
+    """apply_networking keeps switch sessions in the pool it is given."""
+    from hil.ext.switches.mock import MockSwitch, LOCAL_STATE
+
+    opened = []
+    session = MockSwitch.session
+    monkeypatch.setattr(MockSwitch, 'session',
+                        lambda self: opened.append(self.label) or
+                        session(self))
+    monkeypatch.setattr(MockSwitch, 'release', lambda self: True,
+                        raising=False)
+    monkeypatch.setattr(MockSwitch, 'reuse', lambda self, switch: True,
+                        raising=False)
+
+    sw = MockSwitch(label='sw0',
+                    hostname='switch.example.com',
+                    username='admin',
+                    password='admin',
+                    type=MockSwitch.api_name)
+    pool = deferred.SessionPool()
+    for i in range(2):
+        nic = new_nic(str(i))
+        nic.port = model.Port(label='gi1/0/%d' % i, switch=sw)
+        db.session.add(model.NetworkingAction(nic=nic,
+                                              new_network=network,
+                                              channel='vlan/native',
+                                              type='modify_port',
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+        db.session.commit()
+        assert deferred.apply_networking(pool=pool)
+        db.session.close()
+
+    assert opened == ['sw0']
+    assert LOCAL_STATE['sw0']['gi1/0/1'] == {'vlan/native': '102'}
+    pool.close()
+
+
+def test_apply_networking_batch_by_port(network, fresh_database,
+                                        monkeypatch):
+    """Modify_port actions on the same port are sent to the switch
+    together.
+    """
+    from hil.ext.switches.mock import MockSwitch
+
+    calls = []
+    monkeypatch.setattr(MockSwitch, 'modify_port',
+                        lambda self, port, channel, network_id:
+                        calls.append((port, [(channel, network_id)])))
+    monkeypatch.setattr(MockSwitch, 'apply_port_changes',
+                        lambda self, port, changes:
+                        calls.append((port, changes)))
+
+    sw = MockSwitch(label='sw0',
+                    hostname='switch.example.com',
+                    username='admin',
+                    password='admin',
+                    type=MockSwitch.api_name)
+    trunked = model.Network(network.owner, [], True, '103', 'trunked')
+    nics = []
+    for i in range(2):
+        nic = new_nic(str(i))
+        nic.port = model.Port(label='gi1/0/%d' % i, switch=sw)
+        nics.append(nic)
+    db.session.add_all(nics)
+    db.session.flush()
+
+    # As in test_apply_networking_coalesce, the api won't queue more than
+    # one action per nic, so we go around it:
+    for nic, new_network, channel in [
+            (nics[0], network, 'vlan/native'),
+            (nics[1], network, 'vlan/native'),
+            (nics[0], trunked, 'vlan/103')]:
+        db.session.add(model.NetworkingAction(nic_id=nic.id,
+                                              new_network=new_network,
+                                              channel=channel,
+                                              type='modify_port',
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+    db.session.commit()
+
+    assert deferred.apply_networking()
+    db.session.close()
+
+    assert calls == [
+        ('gi1/0/0', [('vlan/native', '102'), ('vlan/103', '103')]),
+        ('gi1/0/1', [('vlan/native', '102')]),
+    ]
+    assert model.NetworkingAction.query \
+        .filter_by(status='DONE').count() == 3
+    assert model.NetworkAttachment.query.count() == 3
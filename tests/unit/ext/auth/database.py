@@ -3,10 +3,12 @@ from hil import api, model, config, errors
 from hil.test_common import config_testsuite, config_merge, fresh_database, \
     ModelTest, fail_on_log_warnings, server_init
 from hil.flaskapp import app
+from hil.auth import get_auth_backend
 from hil.model import db
 from hil.rest import init_auth, local
 import flask
 import pytest
+import sqlalchemy
 import unittest
 import json
 
@@ -95,6 +97,8 @@ class FakeAuthRequest(object):
     database auth plugin to work.
     """
 
+    headers = {}
+
     def __init__(self, username, password):
         self.username = username
         self.password = password
@@ -116,6 +120,7 @@ class FakeNoAuthRequest(object):
     unauthenticated.
     """
     authorization = None
+    headers = {}
 
 
 @pytest.fixture
@@ -164,12 +169,19 @@ class TestListUsers(DBAuthTestCase):
 
     def test_list_users(self):
         """Listing all users with database authentication"""
-        result = json.loads(self.dbauth.list_users())
+        result = json.load(self.dbauth.list_users())
         assert result == {
             u'alice': {u'is_admin': True, u'projects': [u'runway']},
             u'bob': {u'is_admin': False, u'projects': []},
             }
 
+    def test_list_users_paginated(self):
+        """list_users returns one page at a time when given a limit."""
+        result = json.load(self.dbauth.list_users(limit=1))
+        assert result.keys() == [u'alice']
+        result = json.load(self.dbauth.list_users(limit=1, after='alice'))
+        assert result.keys() == [u'bob']
+
 
 @use_fixtures('admin_auth')
 class TestUserCreateDelete(DBAuthTestCase):
@@ -401,3 +413,245 @@ def test_admin_noauth_fail(fn, args):
     fn = getattr(dbauth, fn)
     with pytest.raises(errors.AuthorizationError):
         fn(*args)
+
+
+@pytest.mark.usefixtures('configure', 'initial_db')
+class TestCredentialCache(object):
+    """Tests for the cache of verified passwords."""
+
+    @pytest.fixture(autouse=True)
+    def clock(self, dbauth, monkeypatch):
+        """Use a fresh cache, with a clock the test controls."""
+        now = [1000.0]
+        cache = dbauth._CredentialCache(clock=lambda: now[0])
+        monkeypatch.setattr(dbauth, '_verified', cache)
+        return now
+
+    @pytest.fixture
+    def verify(self, dbauth, monkeypatch):
+        """Count the calls to sha512_crypt.verify."""
+        calls = []
+        real_verify = dbauth.sha512_crypt.verify
+
+        def verify(password, hashed_password):
+            """Record the call, then verify the password as usual."""
+            calls.append(password)
+            return real_verify(password, hashed_password)
+        monkeypatch.setattr(dbauth.sha512_crypt, 'verify',
+                            staticmethod(verify))
+        return calls
+
+    def _alice(self, dbauth):
+        """Return alice's User object."""
+        return dbauth.User.query.filter_by(label='alice').one()
+
+    def test_cached(self, dbauth, verify):
+        """Verifying the same password again doesn't check the hash."""
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert alice.verify_password('secret')
+            assert alice.verify_password('secret')
+            assert verify == ['secret']
+
+    def test_wrong_password(self, dbauth, verify):
+        """Wrong passwords are never cached, or accepted from the cache."""
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert not alice.verify_password('wrong')
+            assert not alice.verify_password('wrong')
+            assert alice.verify_password('secret')
+            assert not alice.verify_password('wrong')
+            assert verify == ['wrong', 'wrong', 'secret', 'wrong']
+
+    def test_expiry(self, dbauth, verify, clock):
+        """Entries expire after the configured ttl."""
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert alice.verify_password('secret')
+            clock[0] += 59
+            assert alice.verify_password('secret')
+            clock[0] += 1
+            assert alice.verify_password('secret')
+            assert verify == ['secret', 'secret']
+
+    def test_set_password(self, dbauth, verify):
+        """Changing the password invalidates the cached one."""
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert alice.verify_password('secret')
+            alice.set_password('hunter2')
+            assert not alice.verify_password('secret')
+            assert alice.verify_password('hunter2')
+
+    def test_hash_changed_elsewhere(self, dbauth, verify):
+        """The cached password isn't used if the hash has changed.
+
+        e.g. because the password was changed by another process.
+        """
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert alice.verify_password('secret')
+            alice.hashed_password = dbauth.sha512_crypt.encrypt('hunter2')
+            assert not alice.verify_password('secret')
+            assert verify == ['secret', 'secret']
+
+    def test_user_delete(self, dbauth):
+        """Deleting a user drops their entry."""
+        with app.test_request_context():
+            init_auth()
+            local.auth = self._alice(dbauth)
+            bob = dbauth.User.query.filter_by(label='bob').one()
+            assert bob.verify_password('password')
+            assert dbauth._verified.check('bob', bob.hashed_password,
+                                          'password')
+            hashed_password = bob.hashed_password
+            dbauth.user_delete('bob')
+            assert not dbauth._verified.check('bob', hashed_password,
+                                              'password')
+
+    def test_size(self, dbauth):
+        """The least recently used entries are dropped first."""
+        config_merge({'hil.ext.auth.database': {
+            'credential_cache_size': '2',
+        }})
+        cache = dbauth._verified
+        cache.clear()
+        cache.put('a', 'hash-a', 'pw')
+        cache.put('b', 'hash-b', 'pw')
+        assert cache.check('a', 'hash-a', 'pw')
+        cache.put('c', 'hash-c', 'pw')
+        assert cache.check('a', 'hash-a', 'pw')
+        assert not cache.check('b', 'hash-b', 'pw')
+        assert cache.check('c', 'hash-c', 'pw')
+
+    @pytest.mark.parametrize('option', ['credential_cache_size',
+                                        'credential_cache_ttl'])
+    def test_disabled(self, dbauth, verify, option):
+        """Setting the size or ttl to 0 disables the cache."""
+        config_merge({'hil.ext.auth.database': {option: '0'}})
+        dbauth._verified.clear()
+        with app.app_context():
+            alice = self._alice(dbauth)
+            assert alice.verify_password('secret')
+            assert alice.verify_password('secret')
+            assert verify == ['secret', 'secret']
+
+
+@use_fixtures('runway_auth')
+def test_project_ids_fetched_once(dbauth):
+    """The user's projects are fetched once, however many are checked."""
+    projects = []
+    for i in range(5):
+        project = model.Project('project-%d' % i)
+        db.session.add(project)
+        projects.append(project)
+    bob = dbauth.User.query.filter_by(label='bob').one()
+    bob.projects.extend(projects[:2])
+    db.session.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        """Record each statement executed."""
+        statements.append(statement)
+
+    projects = model.Project.query.filter(model.Project.label != 'runway') \
+        .order_by(model.Project.label).all()
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        backend = get_auth_backend()
+        results = [backend.have_project_access(p) for p in projects]
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+    assert results == [True, True, False, False, False]
+    assert len([s for s in statements if 'user_projects' in s]) == 1
+
+
+class FakeBearerRequest(object):
+    """Fake request object, authenticated with a bearer token."""
+
+    authorization = None
+
+    def __init__(self, token):
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+
+@use_fixtures('admin_auth')
+class TestTokenRevocation(DBAuthTestCase):
+    """Tokens stop working when their user's access is taken away."""
+
+    def _token_for(self, username, password):
+        """Issue a token to `username`, then switch back to alice."""
+        from hil import auth
+        flask.request = FakeAuthRequest(username, password)
+        init_auth()
+        token = auth.issue_token()
+        flask.request = FakeAuthRequest('alice', 'secret')
+        init_auth()
+        return token
+
+    def _access(self, token, project='runway'):
+        """Return whether `token` works, has admin, and has `project`."""
+        from hil import auth
+        saved = flask.request
+        flask.request = FakeBearerRequest(token)
+        try:
+            if not auth.authenticate():
+                return None
+            backend = get_auth_backend()
+            project = model.Project.query.filter_by(label=project).first()
+            return (backend.have_admin(),
+                    project is not None and
+                    backend.have_project_access(project))
+        finally:
+            flask.request = saved
+            init_auth()
+
+    def test_delete_user(self):
+        """Deleting a user revokes their tokens, and only theirs."""
+        self.dbauth.user_create('charlie', 'foo', is_admin=True)
+        charlie = self._token_for('charlie', 'foo')
+        bob = self._token_for('bob', 'password')
+        assert self._access(charlie) == (True, True)
+        self.dbauth.user_delete('charlie')
+        assert self._access(charlie) is None
+        assert self._access(bob) == (False, False)
+
+    def test_demote_user(self):
+        """Taking away a user's admin status revokes their tokens."""
+        self.dbauth.user_create('charlie', 'foo', is_admin=True)
+        token = self._token_for('charlie', 'foo')
+        self.dbauth.user_set_admin('charlie', False)
+        assert self._access(token) is None
+        assert self._access(self._token_for('charlie', 'foo')) == \
+            (False, False)
+
+    def test_remove_project(self):
+        """Removing a user from a project revokes their tokens."""
+        self.dbauth.user_add_project('bob', 'runway')
+        token = self._token_for('bob', 'password')
+        assert self._access(token) == (False, True)
+        self.dbauth.user_remove_project('bob', 'runway')
+        assert self._access(token) is None
+
+    def test_set_password(self):
+        """Changing a user's password revokes their tokens."""
+        token = self._token_for('bob', 'password')
+        self.dbauth.User.query.filter_by(label='bob').one() \
+            .set_password('hunter2')
+        db.session.commit()
+        assert self._access(token) is None
+
+    def test_delete_project(self):
+        """Deleting a project revokes the tokens which grant access to it.
+
+        Otherwise, a project created later with the same id would be
+        accessible to them.
+        """
+        api.project_create('acme-corp')
+        self.dbauth.user_add_project('bob', 'acme-corp')
+        token = self._token_for('bob', 'password')
+        other = self._token_for('alice', 'secret')
+        api.project_delete('acme-corp')
+        assert self._access(token) is None
+        assert self._access(other) == (True, True)
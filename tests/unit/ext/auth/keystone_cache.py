@@ -0,0 +1,328 @@
+"""Tests for hil.ext.auth.keystone_cache, and the fake keystone server.
+
+keystonemiddleware isn't needed for these; `validating_filter` stands in for
+it, validating tokens directly with a `FakeKeystone`.
+
+The modules under test are imported where they are used, since importing
+anything from "hil.ext" at the top level pollutes the env of other tests.
+"""
+import json
+import time
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+
+def identity_app(environ, start_response):
+    """A wsgi app which responds with the identity of the request."""
+    from hil.ext.auth.keystone_cache import IDENTITY_KEYS
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(dict((key, environ.get(key)) for key in IDENTITY_KEYS))]
+
+
+def validating_filter(keystone, token_info=True):
+    """Return a filter which validates tokens like keystonemiddleware does.
+
+    Requests with valid tokens get the identity variables set, and (if
+    `token_info` is True) ``keystone.token_info``; others are refused.
+    """
+    from hil.ext.auth.keystone_cache import IDENTITY_KEYS
+
+    def auth_filter(app):
+        """Wrap `app` in token validation."""
+        def validate(environ, start_response):
+            """Validate the request's token, then pass it on to `app`."""
+            for key in IDENTITY_KEYS:
+                environ.pop(key, None)
+            data = keystone.validate_token(environ.get('HTTP_X_AUTH_TOKEN'))
+            if data is None:
+                start_response('401 Unauthorized', [])
+                return ['']
+            environ.update({
+                'HTTP_X_IDENTITY_STATUS': 'Confirmed',
+                'HTTP_X_PROJECT_ID': data['project']['id'],
+                'HTTP_X_ROLES': ','.join(r['name'] for r in data['roles']),
+                'HTTP_X_USER_NAME': data['user']['name'],
+            })
+            if token_info:
+                environ['keystone.token_info'] = {'token': data}
+            return app(environ, start_response)
+        return validate
+    return auth_filter
+
+
+@pytest.fixture
+def keystone():
+    """A FakeKeystone with a couple of users."""
+    from hil.ext.auth.fake_keystone import FakeKeystone
+    keystone = FakeKeystone(token_lifetime=30)
+    keystone.add_project('admin')
+    keystone.add_project('runway')
+    keystone.add_user('alice', 'secret', 'admin', roles=['admin'])
+    keystone.add_user('bob', 'password', 'runway', roles=['member'])
+    return keystone
+
+
+class FakeClock(object):
+    """A clock the test controls, starting at the current time."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+    def tick(self, seconds):
+        """Move the clock forward by `seconds`."""
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    """A FakeClock."""
+    return FakeClock()
+
+
+def make_middleware(keystone, clock, size=10, ttl=60):
+    """Return a CachingAuthMiddleware in front of `identity_app`."""
+    # pylint: disable=redefined-outer-name
+    from hil.ext.auth.keystone_cache import CachingAuthMiddleware, TokenCache
+    return CachingAuthMiddleware(identity_app,
+                                 validating_filter(keystone),
+                                 TokenCache(size, ttl, clock=clock),
+                                 clock=clock)
+
+
+def get(app, token, headers=None):
+    """Make a request to `app` with `token`.
+
+    Returns the status code and (if successful) the identity the request
+    was made with.
+    """
+    headers = dict(headers or {}, **{'X-Auth-Token': token})
+    resp = Client(app, BaseResponse).get('/', headers=headers)
+    if resp.status_code != 200:
+        return resp.status_code, None
+    return resp.status_code, json.loads(resp.get_data())
+
+
+def test_cache_hit(keystone, clock):
+    """A token is only validated once."""
+    app = make_middleware(keystone, clock)
+    token = keystone.issue_token('bob', 'password')
+    status, identity = get(app, token)
+    assert status == 200
+    assert identity['HTTP_X_IDENTITY_STATUS'] == 'Confirmed'
+    assert identity['HTTP_X_USER_NAME'] == 'bob'
+    assert identity['HTTP_X_ROLES'] == 'member'
+    assert get(app, token) == (status, identity)
+    assert keystone.validations == 1
+    assert (app.hits, app.misses) == (1, 1)
+
+
+def test_identity_not_injectable(keystone, clock):
+    """Requests answered from the cache get the cached identity only."""
+    app = make_middleware(keystone, clock)
+    token = keystone.issue_token('bob', 'password')
+    _, identity = get(app, token)
+    assert get(app, token, {'X-Roles': 'admin',
+                            'X-User-Name': 'alice'}) == (200, identity)
+
+
+def test_tokens_distinct(keystone, clock):
+    """Each token gets its own identity."""
+    app = make_middleware(keystone, clock)
+    alice = keystone.issue_token('alice', 'secret')
+    bob = keystone.issue_token('bob', 'password')
+    for _ in range(2):
+        assert get(app, alice)[1]['HTTP_X_USER_NAME'] == 'alice'
+        assert get(app, bob)[1]['HTTP_X_USER_NAME'] == 'bob'
+    assert keystone.validations == 2
+
+
+def test_invalid_not_cached(keystone, clock):
+    """Invalid tokens are validated (and refused) every time."""
+    app = make_middleware(keystone, clock)
+    assert get(app, 'bogus') == (401, None)
+    assert get(app, 'bogus') == (401, None)
+    assert keystone.validations == 2
+
+
+def test_ttl(keystone, clock):
+    """Entries expire after the cache's ttl."""
+    app = make_middleware(keystone, clock, ttl=10)
+    token = keystone.issue_token('bob', 'password')
+    get(app, token)
+    clock.tick(9)
+    get(app, token)
+    assert keystone.validations == 1
+    clock.tick(1)
+    get(app, token)
+    assert keystone.validations == 2
+
+
+def test_token_expiry(keystone, clock):
+    """Entries don't outlive their tokens."""
+    app = make_middleware(keystone, clock, ttl=60)
+    token = keystone.issue_token('bob', 'password')
+    get(app, token)
+    clock.tick(31)
+    get(app, token)
+    assert keystone.validations == 2
+
+
+def test_lru(keystone, clock):
+    """The least recently used entries are dropped first."""
+    app = make_middleware(keystone, clock, size=2)
+    tokens = [keystone.issue_token('bob', 'password') for _ in range(3)]
+    get(app, tokens[0])
+    get(app, tokens[1])
+    get(app, tokens[0])
+    get(app, tokens[2])
+    assert keystone.validations == 3
+    get(app, tokens[0])
+    get(app, tokens[2])
+    assert keystone.validations == 3
+    get(app, tokens[1])
+    assert keystone.validations == 4
+
+
+class FakeMemcacheClient(object):
+    """Just enough of ``memcache.Client``, backed by a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        """Return the value of `key`, or None."""
+        return self.data.get(key, (None, None))[0]
+
+    def set(self, key, value, time=0):
+        """Set the value of `key`, to expire after `time` seconds."""
+        # pylint: disable=redefined-outer-name
+        self.data[key] = (value, time)
+
+
+def make_memcached_middleware(keystone, clock, memcache):
+    """Return a CachingAuthMiddleware caching tokens in `memcache`."""
+    # pylint: disable=redefined-outer-name
+    from hil.ext.auth.keystone_cache import CachingAuthMiddleware, \
+        MemcachedTokenCache
+    return CachingAuthMiddleware(identity_app,
+                                 validating_filter(keystone),
+                                 MemcachedTokenCache(memcache, 60, 'secret'),
+                                 clock=clock)
+
+
+def test_memcached(keystone, clock):
+    """Tokens may be cached in memcached instead."""
+    from hil.ext.auth.keystone_cache import MemcachedTokenCache
+    memcache = FakeMemcacheClient()
+    app = make_memcached_middleware(keystone, clock, memcache)
+    token = keystone.issue_token('bob', 'password')
+    _, identity = get(app, token)
+    assert get(app, token) == (200, identity)
+    assert keystone.validations == 1
+    [(key, (value, ttl))] = memcache.data.items()
+    assert key.startswith(MemcachedTokenCache.KEY_PREFIX)
+    assert token not in key
+    assert token not in value
+    assert 29 <= ttl <= 30
+
+
+def test_memcached_tampering(keystone, clock):
+    """Entries not signed with the secret key are ignored."""
+    from hil.ext.auth.keystone_cache import IDENTITY_KEYS, \
+        MemcachedTokenCache, _cache_key
+    memcache = FakeMemcacheClient()
+    app = make_memcached_middleware(keystone, clock, memcache)
+    token = keystone.issue_token('bob', 'password')
+    get(app, token)
+    [(key, (value, ttl))] = memcache.data.items()
+
+    # Changing the identity in an entry invalidates it:
+    mac, _, identity = value.partition(':')
+    identity = json.loads(identity)
+    identity['HTTP_X_ROLES'] = 'admin'
+    memcache.data[key] = (mac + ':' + json.dumps(identity), ttl)
+    assert get(app, token)[1]['HTTP_X_ROLES'] == 'member'
+    assert keystone.validations == 2
+
+    # An entry planted for a made up token, even under the right memcached
+    # key, is no good without the right signature:
+    wrong = MemcachedTokenCache(memcache, 60, 'guess')
+    forged = dict((k, 'Confirmed') for k in IDENTITY_KEYS)
+    wrong.set(_cache_key('bogus'), json.dumps(forged), 60)
+    planted = memcache.data.pop(wrong._memcached_key(_cache_key('bogus')))
+    memcache.data[app.cache._memcached_key(_cache_key('bogus'))] = planted
+    assert get(app, 'bogus') == (401, None)
+
+
+def test_unknown_expiry(keystone, clock):
+    """Tokens whose expiry isn't reported aren't cached."""
+    from hil.ext.auth.keystone_cache import CachingAuthMiddleware, TokenCache
+    app = CachingAuthMiddleware(identity_app,
+                                validating_filter(keystone, token_info=False),
+                                TokenCache(10, 60, clock=clock),
+                                clock=clock)
+    token = keystone.issue_token('bob', 'password')
+    assert get(app, token)[0] == 200
+    assert get(app, token)[0] == 200
+    assert keystone.validations == 2
+
+
+@pytest.mark.parametrize('info,expected', [
+    ({'token': {'expires_at': '1970-01-02T00:00:00.000000Z'}}, 86400),
+    ({'token': {'expires_at': '1970-01-02T00:00:00Z'}}, 86400),
+    ({'access': {'token': {'expires': '1970-01-02T00:00:10Z'}}}, 86410),
+    ({'token': {}}, None),
+    (None, None),
+])
+def test_token_expiry_parsing(info, expected):
+    """token_expiry understands keystone's token formats."""
+    from hil.ext.auth.keystone_cache import token_expiry
+    environ = {}
+    if info is not None:
+        environ['keystone.token_info'] = info
+    assert token_expiry(environ) == expected
+
+
+def test_fake_keystone(keystone):
+    """The fake keystone issues and validates tokens over HTTP."""
+    client = Client(keystone, BaseResponse)
+
+    def authenticate(name, password):
+        """Ask for a token for `name`."""
+        return client.post('/v3/auth/tokens', data=json.dumps({'auth': {
+            'identity': {
+                'methods': ['password'],
+                'password': {'user': {'name': name, 'password': password}},
+            },
+        }}))
+
+    assert authenticate('bob', 'wrong').status_code == 401
+    resp = authenticate('bob', 'password')
+    assert resp.status_code == 201
+    bob = resp.headers['X-Subject-Token']
+    assert json.loads(resp.get_data())['token']['user']['name'] == 'bob'
+    alice = authenticate('alice', 'secret').headers['X-Subject-Token']
+
+    resp = client.get('/v3/auth/tokens', headers={'X-Auth-Token': alice,
+                                                  'X-Subject-Token': bob})
+    assert resp.status_code == 200
+    token = json.loads(resp.get_data())['token']
+    assert token['project']['name'] == 'runway'
+    assert [r['name'] for r in token['roles']] == ['member']
+
+    keystone.revoke_token(bob)
+    resp = client.get('/v3/auth/tokens', headers={'X-Auth-Token': alice,
+                                                  'X-Subject-Token': bob})
+    assert resp.status_code == 404
+    resp = client.get('/v3/auth/tokens', headers={'X-Auth-Token': bob,
+                                                  'X-Subject-Token': alice})
+    assert resp.status_code == 401
+
+    assert client.get('/').status_code == 300
+    assert json.loads(client.get('/v3').get_data())['version']['id'] \
+        .startswith('v3')
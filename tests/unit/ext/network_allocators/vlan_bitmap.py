@@ -0,0 +1,192 @@
+"""Test the vlan_bitmap network allocator."""
+from hil.config import load_extensions
+from hil.flaskapp import app
+from hil.model import db
+from hil.migrations import create_db
+from hil.network_allocator import get_network_allocator
+from hil import api, errors
+from hil.test_common import fail_on_log_warnings, with_request_context, \
+    fresh_database, config_testsuite, config_merge, server_init
+from hil import model
+import pytest
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+with_request_context = pytest.yield_fixture(with_request_context)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+VLANS = [100, 101, 102, 103, 104, 300, 702]
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.network_allocators.null': None,
+            'hil.ext.network_allocators.vlan_bitmap': ''
+        },
+        'hil.ext.network_allocators.vlan_bitmap': {
+            'vlans': '300, 100-104, 702',  # Arbitrary list
+        },
+    })
+    load_extensions()
+
+
+default_fixtures = ['fail_on_log_warnings',
+                    'configure',
+                    'fresh_database',
+                    'server_init',
+                    'with_request_context']
+
+pytestmark = pytest.mark.usefixtures(*default_fixtures)
+
+
+def free_vlans():
+    """Return a sorted list of the free vlans."""
+    from hil.ext.network_allocators.vlan_bitmap import _read_state
+    free = _read_state().free
+    return [vlan for vlan in range(free.bit_length()) if free & (1 << vlan)]
+
+
+def test_allocation():
+    """Vlans are handed out lowest first, until there are none left."""
+    allocator = get_network_allocator()
+    assert free_vlans() == VLANS
+    allocated = [allocator.get_new_network_id() for _ in VLANS]
+    assert allocated == [str(vlan) for vlan in VLANS]
+    assert allocator.get_new_network_id() is None
+
+    allocator.free_network_id('300')
+    assert free_vlans() == [300]
+    assert allocator.get_new_network_id() == '300'
+
+
+def test_pool_membership():
+    """is_network_id_in_pool reflects the configured vlans."""
+    allocator = get_network_allocator()
+    for vlan in VLANS:
+        assert allocator.is_network_id_in_pool(vlan)
+    for vlan in 1, 99, 105, 4096:
+        assert not allocator.is_network_id_in_pool(vlan)
+
+
+def test_claim():
+    """Claimed vlans are not handed out, and can't be claimed twice."""
+    allocator = get_network_allocator()
+    allocator.claim_network_id('100')
+    with pytest.raises(errors.BlockedError):
+        allocator.claim_network_id('100')
+    assert allocator.get_new_network_id() == '101'
+
+    # Vlans outside the pool are not tracked:
+    allocator.claim_network_id('1511')
+    allocator.claim_network_id('1511')
+    assert free_vlans() == [102, 103, 104, 300, 702]
+
+
+def test_concurrent_update():
+    """An allocation which loses a race retries, with the new state."""
+    from hil.ext.network_allocators import vlan_bitmap
+    allocator = get_network_allocator()
+    read_state = vlan_bitmap._read_state
+    raced = []
+
+    def racing_read_state():
+        """Read the state, then allocate a vlan behind the caller's back."""
+        state = read_state()
+        if not raced:
+            raced.append(True)
+            assert vlan_bitmap._write_free(state, state.free & ~(1 << 100))
+        return state
+
+    vlan_bitmap._read_state = racing_read_state
+    try:
+        assert allocator.get_new_network_id() == '101'
+    finally:
+        vlan_bitmap._read_state = read_state
+    assert free_vlans() == [102, 103, 104, 300, 702]
+
+
+def test_populate_dirty_db():
+    """Re-running populate() leaves the state of existing vlans alone."""
+    allocator = get_network_allocator()
+    allocator.get_new_network_id()
+    db.session.commit()
+    create_db()
+    assert free_vlans() == VLANS[1:]
+
+
+def test_populate_new_vlans():
+    """populate() adds new vlans, unless networks already use them."""
+    allocator = get_network_allocator()
+    allocator.get_new_network_id()
+    api.network_create('hammernet', 'admin', '', 1511)
+    db.session.commit()
+
+    config_merge({
+        'hil.ext.network_allocators.vlan_bitmap': {
+            'vlans': '100-104, 300, 702, 1510-1512',
+        },
+    })
+    with app.app_context():
+        allocator.populate()
+        db.session.commit()
+    assert free_vlans() == VLANS[1:] + [1510, 1512]
+    assert allocator.is_network_id_in_pool(1511)
+
+
+def test_vlanid_for_admin_network():
+    """
+    Test for valid vlanID for administrator-owned networks.
+    """
+    with pytest.raises(errors.BadArgumentError):
+        api.network_create('hammernet', 'admin', '', 'yes')
+    with pytest.raises(errors.BadArgumentError):
+        api.network_create('nailnet', 'admin', '', '5023')
+    with pytest.raises(errors.BadArgumentError):
+        api.network_create('nailnet', 'admin', '', '-2')
+
+
+def test_networks():
+    """Networks get, and give back, vlans from the pool."""
+    api.project_create('nuggets')
+    api.network_create('hammernet', 'nuggets', 'nuggets', '')
+    network = api.get_or_404(model.Network, 'hammernet')
+    assert network.network_id == '100'
+    assert network.allocated is True
+
+    api.network_create('nailnet', 'admin', '', 103)
+    assert api.get_or_404(model.Network, 'nailnet').allocated is True
+    with pytest.raises(errors.BlockedError):
+        api.network_create('redbone', 'admin', '', 103)
+    with pytest.raises(errors.BlockedError):
+        api.network_create('redbone', 'admin', '', 100)
+
+    api.network_create('starfish', 'admin', '', 1511)
+    network = api.get_or_404(model.Network, 'starfish')
+    assert network.allocated is False
+
+    api.network_delete('hammernet')
+    api.network_delete('nailnet')
+    api.network_create('redbone', 'admin', '', 103)
+    api.network_create('nailnet', 'admin', '', 100)
+    assert free_vlans() == [101, 102, 104, 300, 702]
+
+
+@pytest.mark.parametrize('vlans', ['700-500', '0-5', '4090-4097', '1-2-3',
+                                   'seven'])
+def test_invalid_vlans(vlans):
+    """Ranges which are reversed or outside 1-4096 are rejected."""
+    from hil.ext.network_allocators.vlan_bitmap import get_vlans, setup
+    config_merge({
+        'hil.ext.network_allocators.vlan_bitmap': {
+            'vlans': '100-104, ' + vlans,
+        },
+    })
+    with pytest.raises(ValueError) as e:
+        get_vlans()
+    assert repr(vlans) in str(e.value)
+    with pytest.raises(SystemExit):
+        setup()
@@ -1,9 +1,11 @@
 """Tests for the brocade switch driver"""
 
 import pytest
+import requests
 import requests_mock
 
 from hil import model
+from hil.errors import SwitchError
 from hil.test_common import fail_on_log_warnings
 
 fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
@@ -97,6 +99,40 @@ TRUNK_VLAN_PAYLOAD = '<vlan><add>102</vlan></vlan>'
 
 TRUNK_REMOVE_VLAN_PAYLOAD = '<vlan><remove>102</remove></vlan>'
 
+# A response to a GET on the interface collection, as from a switch which
+# ignores the Resource-Depth header; this just has links to the interfaces.
+INTERFACES_RESPONSE_SHALLOW = """
+<collection xmlns:y="http://brocade.com/ns/rest"
+            y:self="/rest/config/running/interface/TenGigabitEthernet">
+  <tengigabitethernet xmlns="urn:brocade.com:mgmt:brocade-interface"
+                      y:self="/rest/config/running/interface/TenGigabitEthernet/%22104/0/10%22">  # noqa
+    <name>104/0/10</name>
+  </tengigabitethernet>
+</collection>
+"""
+
+INTERFACES_RESPONSE = """
+<collection xmlns:y="http://brocade.com/ns/rest"
+            y:self="/rest/config/running/interface/TenGigabitEthernet">
+  <tengigabitethernet xmlns="urn:brocade.com:mgmt:brocade-interface"
+                      y:self="/rest/config/running/interface/TenGigabitEthernet/%22104/0/10%22">  # noqa
+    <name>104/0/10</name>
+    <switchport>
+      <mode><vlan-mode>trunk</vlan-mode></mode>
+      <trunk>
+        <allowed><vlan><add>4001,4025</add></vlan></allowed>
+        <native-vlan>10</native-vlan>
+      </trunk>
+    </switchport>
+  </tengigabitethernet>
+  <tengigabitethernet xmlns="urn:brocade.com:mgmt:brocade-interface"
+                      y:self="/rest/config/running/interface/TenGigabitEthernet/%22104/0/18%22">  # noqa
+    <name>104/0/18</name>
+    <switchport/>
+  </tengigabitethernet>
+</collection>
+"""
+
 INTERFACE1 = '104/0/10'
 INTERFACE2 = '104/0/18'
 INTERFACE3 = '104/0/20'
@@ -166,6 +202,9 @@ class TestBrocade(object):
             PORT2 = model.Port(label=INTERFACE2, switch=switch)
             PORT3 = model.Port(label=INTERFACE3, switch=switch)
 
+            mock.get('http://example.com/rest/config/running/interface/'
+                     'TenGigabitEthernet',
+                     text=INTERFACES_RESPONSE_SHALLOW)
             mock.get(switch._construct_url(INTERFACE1, suffix='trunk'),
                      text=TRUNK_NATIVE_VLAN_RESPONSE_WITH_VLANS)
             mock.get(switch._construct_url(INTERFACE2, suffix='trunk'),
@@ -189,6 +228,25 @@ class TestBrocade(object):
                         ('vlan/4050', '4050')]
             }
 
+    def test_get_port_networks_snapshot(self, switch):
+        """Test that get_port_networks reads the interfaces all at once"""
+        with requests_mock.mock() as mock:
+            PORT1 = model.Port(label=INTERFACE1, switch=switch)
+            PORT2 = model.Port(label=INTERFACE2, switch=switch)
+
+            mock.get('http://example.com/rest/config/running/interface/'
+                     'TenGigabitEthernet',
+                     text=INTERFACES_RESPONSE)
+            response = switch.get_port_networks([PORT1, PORT2])
+            assert response == {
+                PORT1: [('vlan/native', '10'),
+                        ('vlan/4001', '4001'),
+                        ('vlan/4025', '4025')],
+                PORT2: [],
+            }
+            assert mock.call_count == 1
+            assert mock.request_history[0].headers['Resource-Depth'] == '5'
+
     def test_get_mode(self, switch):
         """Test the _get_mode helper method"""
         with requests_mock.mock() as mock:
@@ -296,6 +354,61 @@ class TestBrocade(object):
             assert mock.call_count == 1
             assert mock.request_history[0].text == TRUNK_REMOVE_VLAN_PAYLOAD
 
+    def test_apply_port_changes(self, switch, nic):
+        """Test that apply_port_changes adds several vlans at once"""
+        port = model.Port(label=INTERFACE1, switch=switch)
+        port.nic = nic
+
+        with requests_mock.mock() as mock:
+            url_switch = switch._construct_url(INTERFACE1)
+            mock.post(url_switch)
+            url_mode = switch._construct_url(INTERFACE1,
+                                             suffix='mode')
+            mock.put(url_mode)
+            url_trunk = switch._construct_url(INTERFACE1,
+                                              suffix='trunk/allowed/vlan')
+            mock.put(url_trunk)
+
+            switch.apply_port_changes(INTERFACE1, [('vlan/102', '102'),
+                                                   ('vlan/103', '103'),
+                                                   ('vlan/104', None)])
+
+            assert mock.call_count == 4
+            assert mock.request_history[2].text == \
+                '<vlan><add>102,103</vlan></vlan>'
+            assert mock.request_history[3].text == \
+                '<vlan><remove>104</remove></vlan>'
+
+    def test_http_session(self, switch):
+        """Test that requests share a session until disconnect"""
+        url = switch._construct_url(INTERFACE1, suffix='mode')
+        with requests_mock.mock() as mock:
+            mock.get(url, text=MODE_RESPONSE_TRUNK)
+            switch._get_mode(INTERFACE1)
+            http = switch._http
+            switch._get_mode(INTERFACE1)
+            assert switch._http is http
+            assert mock.request_history[0].timeout == (10, 300)
+
+        switch.disconnect()
+        assert switch._http is None
+
+    def test_request_timeout(self, switch):
+        """Test that a request timing out raises a SwitchError"""
+        url = switch._construct_url(INTERFACE1, suffix='mode')
+        with requests_mock.mock() as mock:
+            mock.get(url, exc=requests.exceptions.ConnectTimeout)
+            with pytest.raises(SwitchError):
+                switch._get_mode(INTERFACE1)
+
+    def test_remove_all_vlans_timeout(self, switch):
+        """Removing all vlans from a trunk can time out too"""
+        url = switch._construct_url(INTERFACE1, suffix='trunk/allowed/vlan')
+        with requests_mock.mock() as mock:
+            mock.put(url, exc=requests.exceptions.ReadTimeout)
+            with pytest.raises(SwitchError):
+                switch._remove_all_vlans_from_trunk(INTERFACE1)
+
     def test_construct_url(self, switch):
         """Test the _construct_url helper method"""
         assert switch._construct_url('1/0/4') == (
@@ -23,7 +23,11 @@ def configure():
         },
         'hil.ext.switches.dell': {
             'save': 'False'
-        }
+        },
+        'hil.ext.switches.dellnos9': {
+            'connect_timeout': '5',
+            'max_connections': '2',
+        },
     })
     config.load_extensions()
 
@@ -40,6 +44,27 @@ def test_parse_vlans():
             '12', '21', '22', '23', '24', '250', '511', '512', '513', '514']
 
 
+def test_merge_trunk_changes():
+    """Test merge_trunk_changes"""
+    from hil.ext.switches.common import merge_trunk_changes
+    assert merge_trunk_changes([
+        ('vlan/native', '10'),
+        ('vlan/11', '11'),
+        ('vlan/12', '12'),
+        ('vlan/13', None),
+        ('vlan/14', None),
+        ('vlan/15', '15'),
+        ('vlan/native', None),
+    ]) == [
+        ('native', '10'),
+        ('add', ['11', '12']),
+        ('remove', ['13', '14']),
+        ('add', ['15']),
+        ('native', None),
+    ]
+    assert merge_trunk_changes([]) == []
+
+
 def test_should_save(configure):
     """Test should save method"""
     from hil.ext.switches.brocade import Brocade
@@ -51,3 +76,23 @@ def test_should_save(configure):
 
     assert should_save(brocade) is True
     assert should_save(dell) is False
+
+
+def test_http_session(configure):
+    """Test http_session and http_timeout"""
+    from hil.ext.switches.brocade import Brocade
+    from hil.ext.switches.dellnos9 import DellNOS9
+    from hil.ext.switches.common import http_session, http_timeout
+
+    brocade = Brocade()
+    dellnos9 = DellNOS9()
+
+    assert http_timeout(brocade) == (10, 300)
+    assert http_timeout(dellnos9) == (5, 300)
+
+    session = http_session(dellnos9, ('admin', 'secret'))
+    assert session.auth == ('admin', 'secret')
+    adapter = session.get_adapter('https://example.com')
+    assert adapter._pool_maxsize == 2
+    assert adapter._pool_block
+    session.close()
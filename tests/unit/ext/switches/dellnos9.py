@@ -172,3 +172,87 @@ def test_get_vlans():
         ('vlan/12', '12'), ('vlan/13', '13')]
     # just in case if the switch returns a 2 vlan range.
     assert switch._get_vlans('10-11') == [('vlan/10', '10'), ('vlan/11', '11')]
+
+
+def test_port_state_cache():
+    """Check that interface state is only read once per change"""
+    import requests_mock
+    from hil.ext.switches.dellnos9 import DellNOS9
+
+    switch = DellNOS9(label='sw0',
+                      hostname='http://example.com',
+                      username='admin',
+                      password='admin',
+                      interface_type='GigabitEthernet')
+    port_info = u"<output>show interfaces switchport GigabitEthernet1/3 " \
+        u"Name: GigabitEthernet1/3 Vlan membership: Q Vlans U 1512 " \
+        u"T 1511 Native Vlan Id: 1512. MOC-Dell-S3048-ON#</output>"
+    port_on = "<interface xmlns='http://www.dell.com/ns/dell:0.1/root'>" \
+        "<shutdown>false</shutdown></interface>"
+
+    with requests_mock.mock() as mock:
+        mock.get(requests_mock.ANY, text=port_on)
+        mock.put(switch._construct_url('1/3'))
+        mock.post(switch._construct_url(), text=port_info)
+
+        def reads():
+            """Return the number of requests reading interface state."""
+            return len([r for r in mock.request_history
+                        if r.method == 'GET' or 'show-command' in r.text])
+
+        assert switch._get_native_vlan('1/3') == ('vlan/native', '1512')
+        assert switch._get_vlans('1/3') == [('vlan/1511', '1511')]
+        assert reads() == 2
+
+        # Changes to the switch invalidate the cache:
+        switch.revert_port('1/3')
+        assert reads() == 2
+        assert switch._get_vlans('1/3') == [('vlan/1511', '1511')]
+        assert reads() == 4
+    switch.disconnect()
+
+
+def test_get_port_networks():
+    """Check that get_port_networks reads the running config once"""
+    import requests_mock
+    from hil.ext.switches.dellnos9 import DellNOS9
+
+    switch = DellNOS9(label='sw0',
+                      hostname='http://example.com',
+                      username='admin',
+                      password='admin',
+                      interface_type='GigabitEthernet')
+    ports = [model.Port(label=label, switch=switch)
+             for label in ('1/3', '1/4', '1/6', '1/8')]
+    running_config = "<output><command>show running-config\r\n" \
+        "!\r\n" \
+        "interface GigabitEthernet 1/3\r\n" \
+        " no ip address\r\n" \
+        " portmode hybrid\r\n" \
+        " switchport\r\n" \
+        " no shutdown\r\n" \
+        "!\r\n" \
+        "interface GigabitEthernet 1/8\r\n" \
+        " no ip address\r\n" \
+        " shutdown\r\n" \
+        "!\r\n" \
+        "interface Vlan 1511\r\n" \
+        " no ip address\r\n" \
+        " tagged GigabitEthernet 1/3,1/5-1/7\r\n" \
+        " tagged TenGigabitEthernet 1/4\r\n" \
+        "!\r\n" \
+        "interface Vlan 1512\r\n" \
+        " no ip address\r\n" \
+        " untagged GigabitEthernet 1/3,1/8\r\n" \
+        "!\r\n" \
+        "MOC-Dell-S3048-ON#</command></output>"
+
+    with requests_mock.mock() as mock:
+        mock.post(switch._construct_url(), text=running_config)
+        assert switch.get_port_networks(ports) == {
+            ports[0]: [('vlan/1511', '1511'), ('vlan/native', '1512')],
+            ports[1]: [],
+            ports[2]: [('vlan/1511', '1511')],
+            ports[3]: [],
+        }
+        assert mock.call_count == 1
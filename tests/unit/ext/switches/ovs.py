@@ -0,0 +1,46 @@
+"""Unit tests for the openvswitch driver"""
+
+import json
+import pytest
+
+from hil import model
+from hil.test_common import fail_on_log_warnings
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+
+
+def test_get_port_networks(monkeypatch):
+    """Check that get_port_networks lists all of the ports at once"""
+    from hil.ext.switches import ovs
+
+    commands = []
+
+    def check_output(args):
+        """Stand in for subprocess.check_output."""
+        commands.append(args)
+        return json.dumps({
+            'headings': ['name', 'tag', 'trunks'],
+            'data': [
+                ['veth-0', 102, ['set', [103, 104]]],
+                ['veth-1', ['set', []], 105],
+                ['veth-2', ['set', []], ['set', []]],
+            ],
+        })
+
+    monkeypatch.setattr(ovs.subprocess, 'check_output', check_output)
+
+    switch = ovs.Ovs(label='sw0',
+                     hostname='br0',
+                     username='admin',
+                     password='admin')
+    ports = [model.Port(label=label, switch=switch)
+             for label in ('veth-0', 'veth-1', 'veth-2', 'veth-3')]
+    assert switch.get_port_networks(ports) == {
+        ports[0]: [('vlan/103', '103'),
+                   ('vlan/104', '104'),
+                   ('vlan/native', '102')],
+        ports[1]: [('vlan/105', '105')],
+        ports[2]: [],
+        ports[3]: [],
+    }
+    assert len(commands) == 1
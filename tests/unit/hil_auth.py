@@ -4,10 +4,14 @@ This module is called `hil_auth` because pytest is lousy about namespacing;
 if we call it `auth`, it chokes on the fact that there's a file `api/auth.py`
 as well. grr.
 """
+import json
 import pytest
-from hil import config
-from hil.auth import get_auth_backend
-from hil.rest import app
+from datetime import datetime, timedelta
+from hil import api, config, model
+from hil.auth import get_auth_backend, get_user, issue_token
+from hil.errors import AuthorizationError
+from hil.model import db
+from hil.rest import app, init_auth
 from hil.test_common import config_testsuite, config_merge, fresh_database, \
     fail_on_log_warnings, server_init
 
@@ -49,3 +53,164 @@ def test_require_auth():
     client = app.test_client()
     resp = client.get('/node/free')
     assert resp.status_code == 401
+
+
+def _issue_token(admin=False, project=None):
+    """Issue a token to a request with the given (mock) access."""
+    with app.test_request_context():
+        init_auth()
+        get_auth_backend().set_admin(admin)
+        if project is not None:
+            get_auth_backend().set_project(
+                model.Project.query.filter_by(label=project).one())
+        return issue_token()
+
+
+def _bearer(token):
+    """Return headers for authenticating with `token`."""
+    return {'Authorization': 'Bearer ' + token}
+
+
+@pytest.fixture
+def projects(configure, fresh_database, server_init):
+    """Create a couple of projects."""
+    # pylint: disable=unused-argument,redefined-outer-name
+    with app.app_context():
+        db.session.add(model.Project('runway'))
+        db.session.add(model.Project('manhattan'))
+        db.session.commit()
+
+
+def test_token_create():
+    """POST /auth/token issues a token, which authenticates requests."""
+    client = app.test_client()
+    resp = client.post('/auth/token')
+    assert resp.status_code == 200
+    result = json.loads(resp.get_data())
+    assert result['expires_in'] == 3600
+
+    get_auth_backend().set_auth_success(False)
+    assert client.get('/nodes/free').status_code == 401
+    resp = client.get('/nodes/free', headers=_bearer(result['token']))
+    assert resp.status_code == 200
+
+
+def test_token_stored_hashed():
+    """Tokens themselves are not stored."""
+    token = _issue_token()
+    with app.app_context():
+        row = model.AuthToken.query.one()
+        assert token not in (row.token_hash, row.project_ids, row.user)
+        assert row.user == 'user'
+
+
+def test_token_admin():
+    """A token issued to an admin has admin access."""
+    admin_token = _issue_token(admin=True)
+    user_token = _issue_token()
+    client = app.test_client()
+    resp = client.get('/active_extensions', headers=_bearer(admin_token))
+    assert resp.status_code == 200
+    resp = client.get('/active_extensions', headers=_bearer(user_token))
+    assert resp.status_code == 401
+
+
+@pytest.mark.usefixtures('projects')
+def test_token_projects():
+    """A token has access to the projects of the request it was issued to."""
+    token = _issue_token(project='runway')
+    client = app.test_client()
+    resp = client.get('/project/runway/nodes', headers=_bearer(token))
+    assert resp.status_code == 200
+    resp = client.get('/project/manhattan/nodes', headers=_bearer(token))
+    assert resp.status_code == 401
+
+
+def test_token_user():
+    """get_user reports the user a token was issued to."""
+    token = _issue_token()
+    with app.test_request_context(headers=_bearer(token)):
+        assert init_auth() is None
+        assert get_user() == 'user'
+        assert get_auth_backend().have_admin() is False
+
+
+def test_bad_token():
+    """Requests with invalid tokens are not authenticated.
+
+    This is so even if the backend would otherwise authenticate them.
+    """
+    _issue_token()
+    client = app.test_client()
+    resp = client.get('/nodes/free', headers=_bearer('bogus'))
+    assert resp.status_code == 401
+
+
+def test_expired_token():
+    """Expired tokens are refused, and deleted when a new one is issued."""
+    token = _issue_token()
+    with app.app_context():
+        row = model.AuthToken.query.one()
+        row.expires = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+    client = app.test_client()
+    assert client.get('/nodes/free', headers=_bearer(token)).status_code \
+        == 401
+    _issue_token()
+    with app.app_context():
+        assert model.AuthToken.query.count() == 1
+
+
+def test_token_for_token():
+    """A token cannot be used to obtain another one."""
+    token = _issue_token(admin=True)
+    client = app.test_client()
+    assert client.post('/auth/token', headers=_bearer(token)).status_code \
+        == 401
+    with app.test_request_context(headers=_bearer(token)):
+        init_auth()
+        with pytest.raises(AuthorizationError):
+            api.token_create()
+
+
+@pytest.mark.usefixtures('projects')
+def test_decisions_memoized(monkeypatch):
+    """The backend is asked about each thing at most once per request."""
+    backend = get_auth_backend()
+    calls = []
+
+    def record(name):
+        """Wrap the backend's method `name` to record its calls."""
+        method = getattr(backend, name)
+
+        def wrapper(*args):
+            """Record the call, and pass it on."""
+            calls.append((name, args))
+            return method(*args)
+        monkeypatch.setattr(backend, name, wrapper)
+    record('_have_admin')
+    record('_have_project_access')
+
+    with app.test_request_context():
+        init_auth()
+        runway = model.Project.query.filter_by(label='runway').one()
+        manhattan = model.Project.query.filter_by(label='manhattan').one()
+        backend.set_project(runway)
+        for _ in range(3):
+            assert backend.have_project_access(runway)
+            assert not backend.have_project_access(manhattan)
+            assert not backend.have_admin()
+        assert calls == [('_have_admin', ()),
+                         ('_have_project_access', (runway,)),
+                         ('_have_project_access', (manhattan,))]
+
+        # Changing the request's access forgets the old decisions:
+        backend.set_admin(True)
+        assert backend.have_project_access(manhattan)
+        assert len(calls) == 4
+
+    # ...as does a new request:
+    with app.test_request_context():
+        init_auth()
+        assert not backend.have_admin()
+        assert len(calls) == 5
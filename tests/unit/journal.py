@@ -0,0 +1,131 @@
+"""Tests for hil/journal.py"""
+
+import os
+import pytest
+import socket
+import tempfile
+import uuid
+
+from hil import config, model, journal
+from hil.model import db
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database
+
+fresh_database = pytest.fixture(fresh_database)
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL.
+
+    If the configuration specifies an in-memory sqlite database, we use a
+    temporary file instead, since notifications for sqlite need a database
+    on disk.
+    """
+    config_testsuite()
+    additional_config = {
+        'extensions': {
+            'hil.ext.obm.mock': '',
+        },
+    }
+    uri = config.cfg.get('database', 'uri')
+    if uri == 'sqlite:///:memory:':
+        with tempfile.NamedTemporaryFile() as temp_db:
+            additional_config['database'] = {
+                'uri': 'sqlite:///' + temp_db.name,
+            }
+            config_merge(additional_config)
+            config.load_extensions()
+            yield
+    else:
+        config_merge(additional_config)
+        config.load_extensions()
+        yield
+
+
+@pytest.fixture
+def listener():
+    """Get a journal.Listener, and close it when we're done."""
+    ret = journal.Listener()
+    yield ret
+    ret.close()
+
+
+pytestmark = pytest.mark.usefixtures('configure', 'fresh_database')
+
+
+def _queue_action():
+    """Add a networking action to the session (without committing)."""
+    from hil.ext.obm.mock import MockObm
+    node = model.Node(
+        label=str(uuid.uuid4()),
+        obm=MockObm(type=MockObm.api_name,
+                    host='ipmihost',
+                    user='root',
+                    password='tapeworm'))
+    nic = model.Nic(node, 'eth0', '00:11:22:33:44:55')
+    db.session.add(model.NetworkingAction(nic=nic,
+                                          new_network=None,
+                                          channel='vlan/native',
+                                          type='modify_port',
+                                          uuid=str(uuid.uuid4()),
+                                          status='PENDING'))
+
+
+def test_wakeup_on_commit(listener):
+    """Committing a new networking action wakes up the listener."""
+    assert listener.enabled()
+    assert not listener.wait(0)
+    _queue_action()
+    db.session.commit()
+    assert listener.wait(5)
+    # All of the notifications should have been consumed:
+    assert not listener.wait(0)
+
+
+def test_no_wakeup_on_rollback(listener):
+    """Rolled back networking actions do not wake up the listener."""
+    _queue_action()
+    db.session.flush()
+    db.session.rollback()
+    assert not listener.wait(0)
+
+
+def _require_socket():
+    """Skip the test unless notifications are sent over a unix socket."""
+    if journal.socket_path() is None or \
+            db.engine.dialect.name == 'postgresql':
+        pytest.skip('notifications are not sent over a unix socket')
+
+
+def test_stale_socket(listener):
+    """A socket file left over by a dead daemon is replaced."""
+    _require_socket()
+    listener.close()
+    # Leave a bound socket file behind, as a daemon which died would:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(journal.socket_path())
+    sock.close()
+
+    new_listener = journal.Listener()
+    try:
+        assert new_listener.enabled()
+        _queue_action()
+        db.session.commit()
+        assert new_listener.wait(5)
+    finally:
+        new_listener.close()
+    assert not os.path.exists(journal.socket_path())
+
+
+def test_live_socket(listener):
+    """A second listener leaves a live daemon's socket alone."""
+    _require_socket()
+    second = journal.Listener()
+    try:
+        assert not second.enabled()
+    finally:
+        second.close()
+    _queue_action()
+    db.session.commit()
+    assert listener.wait(5)
@@ -0,0 +1,305 @@
+"""Tests for hil.layout"""
+import json
+from os.path import dirname, join
+
+import pytest
+from schema import Schema
+
+from hil import api, config, errors, layout, model
+from hil.auth import get_auth_backend
+from hil.model import db
+from hil.test_common import config_testsuite, config_merge, fresh_database, \
+    fail_on_log_warnings, with_request_context, server_init
+
+MOCK_SWITCH_TYPE = 'http://schema.massopencloud.org/haas/v0/switches/mock'
+OBM_TYPE_MOCK = 'http://schema.massopencloud.org/haas/v0/obm/mock'
+EXAMPLE = join(dirname(__file__), '..', '..', 'examples', 'layout.json')
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.auth.null': None,
+            'hil.ext.auth.mock': '',
+            'hil.ext.switches.mock': '',
+            'hil.ext.switches.dell': '',
+            'hil.ext.obm.mock': '',
+            'hil.ext.obm.ipmi': '',
+            'hil.ext.network_allocators.null': None,
+            'hil.ext.network_allocators.vlan_pool': '',
+        },
+        'hil.ext.network_allocators.vlan_pool': {
+            'vlans': '1001-1040',
+        },
+    })
+    config.load_extensions()
+
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+with_request_context = pytest.yield_fixture(with_request_context)
+
+
+pytestmark = pytest.mark.usefixtures('configure',
+                                     'fresh_database',
+                                     'server_init',
+                                     'with_request_context')
+
+
+@pytest.fixture
+def admin(configure, fresh_database, server_init, with_request_context):
+    """Run the test with admin access."""
+    # pylint: disable=unused-argument,redefined-outer-name
+    get_auth_backend().set_admin(True)
+
+
+def mock_obm(host):
+    """Return the layout of a mock obm."""
+    return {'type': OBM_TYPE_MOCK, 'host': host, 'user': 'user',
+            'password': 'password'}
+
+
+def mock_switch(label, ports=()):
+    """Return the layout of a mock switch."""
+    return {'switch': label, 'type': MOCK_SWITCH_TYPE, 'hostname': label,
+            'username': 'user', 'password': 'password', 'ports': list(ports)}
+
+
+def load(data):
+    """Validate `data` and import it."""
+    layout.import_layout(Schema(layout.LAYOUT_SCHEMA).validate(data))
+
+
+def export():
+    """Return the exported layout, decoded."""
+    return json.load(layout.export_layout())
+
+
+@pytest.mark.usefixtures('admin')
+def test_import_example():
+    """The example layout.json can be imported."""
+    with open(EXAMPLE) as f:
+        load(json.load(f))
+
+    node = api._lookup(model.Node, 'node-1')
+    assert node.project.label == 'runway'
+    assert node.obm.host == '192.168.1.1'
+    assert sorted((nic.label, nic.mac_addr, nic.port.owner.label,
+                   nic.port.label) for nic in node.nics) == [
+        ('nic1', 'de:ad:be:ef:20:14', 'dell-0', 'gi1/0/1'),
+        ('nic2', 'de:ad:be:ef:20:15', 'dell-1', 'gi1/0/2'),
+    ]
+    assert sorted(p.label for p in
+                  api._lookup(model.Switch, 'dell-1').ports) == \
+        ['gi1/0/2', 'gi1/0/3', 'gi1/0/4']
+    assert json.loads(api.show_node('node-2'))['metadata'] == {'EK': '"pk"'}
+    assert json.loads(api.show_network('pxe'))['channels'] == \
+        ['vlan/native', 'vlan/1001']
+    runway_net = json.loads(api.show_network('runway-net'))
+    assert runway_net['owner'] == 'runway'
+    assert runway_net['access'] == ['runway']
+
+
+def test_round_trip():
+    """Exporting a layout, and importing it into an empty database,
+    recreates the same objects.
+    """
+    data = {
+        'projects': ['manhattan', 'runway'],
+        'switches': [mock_switch('sw0', ['gi1/0/9'])],
+        'nodes': [{
+            'name': 'node-%d' % i,
+            'obm': mock_obm('10.0.0.%d' % i),
+            'nics': [{'name': 'eth0', 'mac': '00:00:00:00:00:%02d' % i,
+                      'switch': 'sw0', 'port': 'gi1/0/%d' % i},
+                     {'name': 'ipmi', 'mac': '00:00:00:00:01:%02d' % i}],
+        } for i in range(4)],
+        'networks': [
+            {'network': 'pub', 'owner': 'admin', 'access': [],
+             'net_id': '7'},
+            {'network': 'net', 'owner': 'runway',
+             'access': ['manhattan', 'runway']},
+        ],
+    }
+    data['nodes'][1]['project'] = 'runway'
+    data['nodes'][2]['metadata'] = {'a': [1, 2], 'b': {'c': None}}
+    load(data)
+
+    exported = export()
+    assert exported['projects'] == ['manhattan', 'runway']
+    assert exported['switches'] == [mock_switch(
+        'sw0', ['gi1/0/0', 'gi1/0/1', 'gi1/0/2', 'gi1/0/3', 'gi1/0/9'])]
+    assert exported['nodes'] == sorted(data['nodes'],
+                                       key=lambda node: node['name'])
+    net_id = exported['networks'][0].pop('net_id')
+    assert 1001 <= int(net_id) <= 1040
+    assert exported['networks'] == [
+        {'network': 'net', 'owner': 'runway',
+         'access': ['manhattan', 'runway']},
+        {'network': 'pub', 'owner': 'admin', 'access': [], 'net_id': '7'},
+    ]
+
+    # Re-importing the export into a clean database gives the same result:
+    exported = export()
+    db.session.rollback()
+    for table in reversed(db.metadata.sorted_tables):
+        if table.name == 'vlan':
+            db.session.execute(table.update().values(available=True))
+        else:
+            db.session.execute(table.delete())
+    db.session.commit()
+    assert export() == {'networks': [], 'nodes': [], 'projects': [],
+                        'switches': []}
+    load(exported)
+    assert export() == exported
+
+
+@pytest.mark.usefixtures('admin')
+def test_import_existing():
+    """Layouts may refer to objects which already exist."""
+    load({'projects': ['runway'],
+          'switches': [mock_switch('sw0', ['gi1/0/1'])]})
+    load({'nodes': [{'name': 'node-0', 'obm': mock_obm('h'),
+                     'project': 'runway',
+                     'nics': [{'name': 'eth0', 'mac': 'm0', 'switch': 'sw0',
+                               'port': 'gi1/0/1'},
+                              {'name': 'eth1', 'mac': 'm1', 'switch': 'sw0',
+                               'port': 'gi1/0/2'}]}],
+          'networks': [{'network': 'net', 'owner': 'runway',
+                        'access': ['runway']}]})
+    node = json.loads(api.show_node('node-0'))
+    assert node['project'] == 'runway'
+    assert sorted((nic['label'], nic['port']) for nic in node['nics']) == \
+        [('eth0', 'gi1/0/1'), ('eth1', 'gi1/0/2')]
+
+
+@pytest.mark.parametrize('data,error', [
+    # Duplicates, in the layout or the database:
+    ({'projects': ['runway', 'runway']}, errors.DuplicateError),
+    ({'projects': ['existing']}, errors.DuplicateError),
+    ({'switches': [mock_switch('existing-sw')]}, errors.DuplicateError),
+    ({'switches': [mock_switch('sw', ['gi1/0/1', 'gi1/0/1'])]},
+     errors.DuplicateError),
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'),
+                 'nics': [{'name': 'eth0', 'mac': 'm'},
+                          {'name': 'eth0', 'mac': 'm'}]}]},
+     errors.DuplicateError),
+    # Two nics on one port, or on a port which is already in use:
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'),
+                 'nics': [{'name': 'eth0', 'mac': 'm', 'switch': 'existing-sw',
+                           'port': 'gi1/0/2'},
+                          {'name': 'eth1', 'mac': 'm', 'switch': 'existing-sw',
+                           'port': 'gi1/0/2'}]}]},
+     errors.DuplicateError),
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'),
+                 'nics': [{'name': 'eth0', 'mac': 'm', 'switch': 'existing-sw',
+                           'port': 'gi1/0/1'}]}]},
+     errors.DuplicateError),
+    # References to things that don't exist:
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'), 'project': 'nope'}]},
+     errors.NotFoundError),
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'),
+                 'nics': [{'name': 'eth0', 'mac': 'm', 'switch': 'nope',
+                           'port': 'gi1/0/1'}]}]},
+     errors.NotFoundError),
+    ({'networks': [{'network': 'net', 'owner': 'admin',
+                    'access': ['nope']}]},
+     errors.NotFoundError),
+    # Invalid arguments:
+    ({'switches': [dict(mock_switch('sw'), hostname=7)]},
+     errors.BadArgumentError),
+    ({'switches': [dict(mock_switch('sw'), type='bogus')]},
+     errors.BadArgumentError),
+    ({'switches': [mock_switch('sw', ['bogus-port'])]},
+     errors.BadArgumentError),
+    ({'nodes': [{'name': 'n', 'obm': {'type': OBM_TYPE_MOCK}}]},
+     errors.BadArgumentError),
+    ({'nodes': [{'name': 'n', 'obm': mock_obm('h'),
+                 'nics': [{'name': 'eth0', 'mac': 'm',
+                           'switch': 'existing-sw'}]}]},
+     errors.BadArgumentError),
+    ({'networks': [{'network': 'net', 'owner': 'existing',
+                    'access': []}]},
+     errors.BadArgumentError),
+    ({'networks': [{'network': 'net', 'owner': 'admin',
+                    'net_id': 'bogus'}]},
+     errors.BadArgumentError),
+    ({'networks': [{'network': 'net', 'owner': 'admin',
+                    'net_id': 'existing-net-id'}]},
+     errors.BlockedError),
+])
+def test_import_invalid(data, error):
+    """Invalid layouts are rejected, and none of them is imported."""
+    load({'projects': ['existing'],
+          'switches': [mock_switch('existing-sw')],
+          'nodes': [{'name': 'existing-node', 'obm': mock_obm('h'),
+                     'nics': [{'name': 'eth0', 'mac': 'm',
+                               'switch': 'existing-sw',
+                               'port': 'gi1/0/1'}]}],
+          'networks': [{'network': 'existing-net', 'owner': 'admin'}]})
+    before = export()
+    if data.get('networks', [{}])[0].get('net_id') == 'existing-net-id':
+        data['networks'][0]['net_id'] = before['networks'][0]['net_id']
+    # Add something valid as well, to check that it doesn't stick:
+    data = dict(data, projects=data.get('projects', []) + ['new'])
+    with pytest.raises(error):
+        load(data)
+    db.session.rollback()
+    assert export() == before
+
+
+def test_import_query_count():
+    """The number of queries an import makes doesn't depend on its size."""
+    def count_queries(size, prefix):
+        """Import a layout with `size` nodes, and count the queries."""
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            """Record the statement."""
+            # pylint: disable=unused-argument
+            statements.append(statement)
+        data = {
+            'switches': [mock_switch(prefix + 'sw')],
+            'nodes': [{'name': '%snode-%d' % (prefix, i),
+                       'obm': mock_obm('h'),
+                       'nics': [{'name': 'eth0', 'mac': 'm',
+                                 'switch': prefix + 'sw',
+                                 'port': 'gi1/0/%d' % i}]}
+                      for i in range(size)],
+        }
+        engine = db.get_engine(db.get_app())
+        db.event.listen(engine, 'before_cursor_execute', before_execute)
+        try:
+            load(data)
+        finally:
+            db.event.remove(engine, 'before_cursor_execute', before_execute)
+        return len(statements)
+
+    # Warm up first, so anything done only once doesn't skew the counts:
+    count_queries(1, 'warm-up-')
+    # OBMs are inserted a row at a time, to get their ids; everything else
+    # is done in bulk:
+    assert count_queries(20, 'b') - count_queries(10, 'a') == 10
+
+
+@pytest.mark.usefixtures('admin')
+def test_rest_calls():
+    """The layout api calls import and export layouts."""
+    api_layout = {'projects': ['runway'], 'switches': [mock_switch('sw0')]}
+    layout.layout_import(**api_layout)
+    assert json.load(layout.layout_export()) == {
+        'networks': [], 'nodes': [], 'projects': ['runway'],
+        'switches': [mock_switch('sw0')],
+    }
+
+
+def test_rest_calls_require_admin():
+    """Only admins can import and export layouts."""
+    with pytest.raises(errors.AuthorizationError):
+        layout.layout_import(projects=['runway'])
+    with pytest.raises(errors.AuthorizationError):
+        layout.layout_export()
@@ -264,7 +264,12 @@ def get_db_state():
         schema = inspector.get_columns(name)
         tbl = db.Table(name, metadata)
         inspector.reflecttable(tbl, None)
-        rows = db.session.query(tbl).all()
+        if name == 'generation':
+            # The generations count writes, which differ depending on how
+            # the database got to its current state, not what that state is.
+            rows = []
+        else:
+            rows = db.session.query(tbl).all()
 
         # the inspector gives us the schema as a list, and the rows
         # as a list of tuples. the columns in each row are matched
@@ -8,7 +8,8 @@
 # to make sure it isn't throwing an exception.
 
 from hil.model import Node, Nic, Project, Headnode, Hnic, Network, \
-    NetworkingAction, Metadata
+    NetworkingAction, Metadata, db, get_generations, Generation, \
+    UNTRACKED_TABLES, bump_generations, seed_generations
 from hil import config
 
 from hil.test_common import fresh_database, config_testsuite, ModelTest, \
@@ -117,3 +118,63 @@ class TestNetworkingAction(ModelTest):
         return NetworkingAction(nic=nic,
                                 new_network=network,
                                 channel='null')
+
+
+def test_generations():
+    """Writes through the session bump the generations of their tables."""
+    def generations():
+        """Return the current generations of the project and node tables."""
+        return get_generations(['project', 'node'])
+
+    assert generations() == {'project': 0, 'node': 0}
+    project = Project('anvil-nextgen')
+    db.session.add(project)
+    db.session.commit()
+    assert generations() == {'project': 1, 'node': 0}
+    project.label = 'runway'
+    db.session.commit()
+    assert generations() == {'project': 2, 'node': 0}
+    Project.query.filter_by(label='runway').delete()
+    db.session.commit()
+    assert generations() == {'project': 3, 'node': 0}
+
+
+def test_generations_bumped_on_commit():
+    """Generations are bumped once the writing transaction commits, and
+    not by flushes, or transactions which are rolled back.
+
+    The generation rows are then never locked by the writing transaction.
+    """
+    db.session.add(Project('anvil-nextgen'))
+    db.session.flush()
+    assert Generation.query.get('project').value == 0
+    db.session.rollback()
+    assert get_generations(['project']) == {'project': 0}
+
+    db.session.add(Project('anvil-nextgen'))
+    db.session.flush()
+    db.session.add(Project('runway'))
+    db.session.commit()
+    assert get_generations(['project']) == {'project': 1}
+
+
+def test_generations_seeded():
+    """Every tracked table has a generation row from the start.
+
+    Bumping a generation is then always an UPDATE, so concurrent first
+    writers to a table can't both try to create its row.
+    """
+    names = set(name for (name,) in db.session.query(Generation.table_name))
+    assert names == set(db.metadata.tables) - UNTRACKED_TABLES
+    seed_generations()
+    db.session.commit()
+    assert Generation.query.count() == len(names)
+
+
+def test_untracked_tables():
+    """Writes to untracked tables don't bump (or create) generations."""
+    bump_generations(['networking_action', 'project'])
+    db.session.commit()
+    assert Generation.query.get('networking_action') is None
+    assert get_generations(['networking_action', 'project']) == \
+        {'networking_action': 0, 'project': 1}
@@ -16,8 +16,11 @@ from abc import ABCMeta, abstractmethod
 import unittest
 import json
 import logging
+import sys
+import types
+from collections import OrderedDict
 
-from schema import Schema, Optional, Use
+from schema import Schema, Optional, Use, And, SchemaError
 import pytest
 
 from hil.test_common import config_testsuite, fail_on_log_warnings
@@ -238,6 +241,165 @@ class TestNoneReturnValue(HttpTest):
         assert resp.get_data() == ''
 
 
+@pytest.fixture()
+def json_codec():
+    """Fixture restoring the JSON codec after the test changes it."""
+    saved = rest._json_dumps, rest._json_loads
+    yield
+    rest.set_json_codec(*saved)
+
+
+@pytest.fixture()
+def stdlib_json(json_codec):
+    """Fixture using the standard library's json module for the test.
+
+    Other codecs may not space their output the same way, so this is needed
+    for tests which compare against `json.dumps` byte-for-byte.
+    """
+    # pylint: disable=unused-argument
+    rest.set_json_codec(rest._stdlib_json_dumps, json.loads)
+
+
+@pytest.mark.usefixtures('stdlib_json')
+class TestJSONStreamReturnValue(HttpTest):
+    """Test returning a JSONStream from API calls."""
+
+    def setUp(self):
+        HttpTest.setUp(self)
+
+        @rest.rest_call('GET', '/array', Schema({}))
+        # pylint: disable=unused-variable
+        def array():
+            """Return a streamed array"""
+            return rest.json_array(str(i) for i in range(3))
+
+        @rest.rest_call('GET', '/object', Schema({}))
+        # pylint: disable=unused-variable
+        def obj():
+            """Return a streamed object"""
+            return rest.json_object([('a', {'y': 1, 'x': None}), ('b', [])])
+
+    def test_stream_return(self):
+        """A JSONStream is sent as the body, encoded like json.dumps."""
+        resp = self.client.get('/array')
+        assert resp.status_code == 200
+        assert resp.get_data() == json.dumps(['0', '1', '2'])
+
+        resp = self.client.get('/object')
+        assert resp.status_code == 200
+        assert resp.get_data() == json.dumps({'a': {'y': 1, 'x': None},
+                                              'b': []},
+                                             sort_keys=True)
+
+    def test_stream_chunks(self):
+        """Large streams are sent in more than one chunk."""
+        def stream():
+            """Return a stream of about 200KiB."""
+            return rest.json_array('x' * 1024 for _ in range(200))
+        assert len(list(stream())) > 1
+        assert json.load(stream()) == ['x' * 1024] * 200
+
+    def test_nested_streams(self):
+        """JSONStreams may be nested in one another."""
+        stream = rest.json_object([
+            ('a', rest.json_array(rest.json_array([i]) for i in range(2))),
+            ('b', rest.json_object([])),
+            ('c', {'d': 1}),
+        ])
+        assert stream.read() == json.dumps({'a': [[0], [1]], 'b': {},
+                                            'c': {'d': 1}}, sort_keys=True)
+
+
+def test_json_dumps_sorted():
+    """json_dumps sorts keys, whichever codec is in use."""
+    data = {'b': [{'z': 1, 'y': 2}], 'a': {'d': None, 'c': u'\u2603/'}}
+    encoded = rest.json_dumps(data)
+    assert json.loads(encoded) == data
+    assert encoded.index('"a"') < encoded.index('"b"')
+    assert encoded.index('"c"') < encoded.index('"d"')
+    assert encoded.index('"y"') < encoded.index('"z"')
+    assert rest.json_loads(encoded) == data
+
+
+def test_set_json_codec(client, json_codec):
+    """API calls encode and decode JSON with the codec set by
+    set_json_codec.
+    """
+    # pylint: disable=unused-argument
+    calls = []
+
+    def dumps(obj):
+        """Record the call, then encode with the standard library."""
+        calls.append(('dumps', obj))
+        return json.dumps(obj, sort_keys=True)
+
+    def loads(data):
+        """Record the call, then decode with the standard library."""
+        calls.append(('loads', data))
+        return json.loads(data)
+
+    rest.set_json_codec(dumps, loads)
+
+    @rest.rest_call('POST', '/codec', Schema({'value': int}))
+    # pylint: disable=unused-variable
+    def codec(value):
+        """Echo `value` back, in a streamed array."""
+        return rest.json_array([{'value': value}])
+
+    resp = client.post('/codec', data=json.dumps({'value': 7}))
+    assert resp.status_code == 200
+    assert json.loads(resp.get_data()) == [{'value': 7}]
+    assert calls == [('loads', '{"value": 7}'), ('dumps', {'value': 7})]
+
+
+def test_find_json_codec_fallback(monkeypatch):
+    """Without any faster library, the standard library is used."""
+    monkeypatch.setitem(sys.modules, 'ujson', None)
+    monkeypatch.setitem(sys.modules, 'simplejson', None)
+    dumps, loads = rest._find_json_codec()
+    assert dumps is rest._stdlib_json_dumps
+    assert loads is json.loads
+
+
+def _fake_ujson(dumps):
+    """Return a module standing in for ujson, encoding with `dumps`."""
+    module = types.ModuleType('ujson')
+    module.dumps = dumps
+    module.loads = json.loads
+    return module
+
+
+def test_find_json_codec_probe(monkeypatch):
+    """A faster library is used only if it encodes correctly."""
+    monkeypatch.setitem(sys.modules, 'simplejson', None)
+
+    def good_dumps(obj, sort_keys, escape_forward_slashes):
+        """Encode like the standard library."""
+        assert sort_keys and not escape_forward_slashes
+        return json.dumps(obj, sort_keys=True)
+    monkeypatch.setitem(sys.modules, 'ujson', _fake_ujson(good_dumps))
+    dumps, loads = rest._find_json_codec()
+    assert dumps is not rest._stdlib_json_dumps
+    assert loads is json.loads
+    assert dumps({'b': 1, 'a': 2}) == '{"a": 2, "b": 1}'
+
+    def unsorted_dumps(obj, **kwargs):
+        """Encode without sorting keys."""
+        # pylint: disable=unused-argument
+        return json.dumps(OrderedDict(sorted(obj.items(), reverse=True)))
+    monkeypatch.setitem(sys.modules, 'ujson', _fake_ujson(unsorted_dumps))
+    assert rest._find_json_codec()[0] is rest._stdlib_json_dumps
+
+    def overflowing_dumps(obj, **kwargs):
+        """Fail on wide integers, like some versions of ujson."""
+        # pylint: disable=unused-argument
+        raise OverflowError('long too big to convert')
+    monkeypatch.setitem(sys.modules, 'ujson', _fake_ujson(overflowing_dumps))
+    dumps = rest._find_json_codec()[0]
+    assert dumps is not rest._stdlib_json_dumps
+    assert dumps({'a': 2**70}) == json.dumps({'a': 2**70})
+
+
 @pytest.fixture()
 def validation_setup():
     """Fixture registering of api calls with a variety of arguments/results."""
@@ -608,3 +770,57 @@ def test_dont_log(client, caplog):
             "An error occured handling the request!"
         for record in caplog.records:
             assert 'sensitive info' not in record.getMessage()
+
+
+_COMPILED_SCHEMA = Schema({
+    'name': basestring,
+    'count': int,
+    'flag': bool,
+    'anything': object,
+    Optional('extra'): basestring,
+    Optional('number'): Use(int),
+    Optional('choice'): lambda x: x in ('a', 'b'),
+})
+
+
+@pytest.mark.parametrize('data', [
+    {'name': 'x', 'count': 1, 'flag': True, 'anything': None},
+    {u'name': u'x', u'count': 1, u'flag': False, u'anything': [1]},
+    {'name': 'x', 'count': True, 'flag': True, 'anything': {}},
+    {'name': 'x', 'count': 1, 'flag': True, 'anything': 1, 'extra': 'y',
+     'number': '42', 'choice': 'a'},
+    # Invalid:
+    {'name': 1, 'count': 1, 'flag': True, 'anything': None},
+    {'name': 'x', 'count': 'one', 'flag': True, 'anything': None},
+    {'name': 'x', 'count': 1, 'flag': 1, 'anything': None},
+    {'name': 'x', 'count': 1, 'flag': True},
+    {'name': 'x', 'count': 1, 'flag': True, 'anything': None, 'bogus': 1},
+    {'name': 'x', 'count': 1, 'flag': True, 'anything': None,
+     'number': 'forty-two'},
+    {'name': 'x', 'count': 1, 'flag': True, 'anything': None,
+     'choice': 'c'},
+    {},
+    ['name', 'count'],
+    None,
+])
+def test_compile_schema(data):
+    """A compiled schema accepts and rejects the same things as the
+    original, and returns the same result.
+    """
+    compiled = rest.compile_schema(_COMPILED_SCHEMA)
+    assert compiled is not _COMPILED_SCHEMA
+    try:
+        expected = _COMPILED_SCHEMA.validate(data)
+    except SchemaError:
+        with pytest.raises(SchemaError):
+            compiled.validate(data)
+    else:
+        assert compiled.validate(data) == expected
+
+
+def test_compile_schema_fallback():
+    """Schemas which can't be compiled are used as-is."""
+    for schema in [Schema({basestring: int}),
+                   Schema({'a': int}, error='custom error'),
+                   Schema(And(dict, len))]:
+        assert rest.compile_schema(schema) is schema
@@ -0,0 +1,72 @@
+"""Micro-benchmark for request validation in `hil.rest`.
+
+Measures how long `_do_validation` takes per request for a few
+representative API calls, once with each call's schema used as-is (as
+`rest_call` used to) and once compiled by `compile_schema` (as it does now).
+
+This isn't a test; run it directly::
+
+    python tests/validation_benchmark.py
+"""
+
+import json
+import timeit
+
+from schema import Schema, Optional
+
+from hil import rest
+
+# (description, method, path, query string, body, url arguments, schema)
+CASES = [
+    ('node_connect_network', 'POST', '/node/node-1/nic/eth0/connect_network',
+     None, {'network': 'pxe', 'channel': 'vlan/native'},
+     {'node': 'node-1', 'nic': 'eth0'},
+     Schema({
+         'node': basestring,
+         'nic': basestring,
+         'network': basestring,
+         Optional('channel'): basestring,
+     })),
+    ('node_register', 'PUT', '/node/node-1',
+     None, {'obm': {'type': 'mock', 'host': 'h', 'user': 'u',
+                    'password': 'p'},
+            'obmd': {'uri': 'http://obmd/node-1', 'admin_token': 'secret'}},
+     {'node': 'node-1'},
+     Schema({
+         'node': basestring,
+         Optional('obm'): dict,
+         Optional('obmd'): dict,
+     })),
+    ('list_nodes', 'GET', '/nodes/free',
+     'project=runway&limit=100&after=node-1', None,
+     {'is_free': 'free'},
+     Schema({
+         'is_free': basestring,
+         Optional('project'): basestring,
+         Optional('switch'): basestring,
+         Optional('limit'): basestring,
+         Optional('after'): basestring,
+     })),
+]
+
+NUMBER = 20000
+
+
+def main():
+    """Run the benchmark, and print the results."""
+    print('%-24s %12s %12s' % ('call', 'as-is (us)', 'compiled (us)'))
+    for name, method, path, query, body, kwargs, schema in CASES:
+        data = '' if body is None else json.dumps(body)
+        with rest.app.test_request_context(path, method=method,
+                                           query_string=query, data=data):
+            times = []
+            for validator in schema, rest.compile_schema(schema):
+                elapsed = timeit.timeit(
+                    lambda: rest._do_validation(validator, dict(kwargs)),
+                    number=NUMBER)
+                times.append(elapsed / NUMBER * 1e6)
+        print('%-24s %12.2f %12.2f' % (name, times[0], times[1]))
+
+
+if __name__ == '__main__':
+    main()